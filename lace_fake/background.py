@@ -0,0 +1,121 @@
+""" Background cosmology (H(z) and dv/dX) for a simulation, computed from
+the parameters in its Gadget file without calling CAMB.
+
+Includes photons, massless and massive neutrinos (with the exact
+Fermi-Dirac energy density), curvature and dark energy with constant w. """
+
+import os
+import numpy as np
+from lace_fake import read_gadget
+
+# Omega_gamma h^2 for T_CMB = 2.7255 K
+OMEGA_GAMMA_H2=2.47282e-5
+# k_B * T_nu0 (in eV) for T_CMB = 2.7255 K, with T_nu0 = (4/11)^(1/3) T_CMB
+KT_NU0_EV=8.617333e-5*2.7255*(4.0/11.0)**(1.0/3.0)
+# cached backgrounds, keyed by (paramfile,mtime)
+_background_cache={}
+
+def get_nu_density_ratio(y,n_x=2000,x_max=40.0):
+    """Energy density of a neutrino species with m/(k T_nu) = y, relative to
+        that of a massless species (vectorized over y)"""
+
+    # integrate x^2 sqrt(x^2+y^2) / (exp(x)+1) in a fixed grid
+    x=np.linspace(0.0,x_max,n_x+1)[1:]
+    dx=x[0]
+    fermi=x**2/(np.exp(x)+1.0)
+    y=np.asarray(y,dtype=float)
+    integrand=np.sqrt(x**2+y[...,np.newaxis]**2)*fermi
+    # massless limit is 7 pi^4 / 120
+    return np.sum(integrand,axis=-1)*dx/(7.0*np.pi**4/120.0)
+
+
+class Background(object):
+    """Expansion history of a cosmology, evaluated for arrays of redshifts"""
+
+    def __init__(self,cosmo_params,m_nu=None,T_cmb=2.7255,N_eff=3.046):
+        """Setup from dictionary with CAMB-like parameters (H0, omch2, ombh2,
+            mnu, omk, w), as returned by read_gadget.camb_from_gadget.
+            m_nu are the masses (in eV) of the three neutrino species, by
+            default degenerate masses that add up to mnu."""
+
+        self.H0=cosmo_params['H0']
+        self.h=self.H0/100.0
+        h2=self.h**2
+        self.w=cosmo_params.get('w',-1)
+        self.Omega_k=cosmo_params.get('omk',0.0)
+        self.Omega_cb=(cosmo_params['omch2']+cosmo_params['ombh2'])/h2
+
+        if m_nu is None:
+            m_nu=[cosmo_params.get('mnu',0.0)/3.0]*3
+        self.m_nu=np.array(m_nu,dtype=float)
+
+        # radiation, and neutrinos (N_eff split between three species)
+        T_fac=(T_cmb/2.7255)
+        self.Omega_gamma=OMEGA_GAMMA_H2*T_fac**4/h2
+        self.Omega_nu_rel=self.Omega_gamma*7.0/8.0*(4.0/11.0)**(4.0/3.0)*N_eff/3.0
+        self.kT_nu0=KT_NU0_EV*T_fac
+
+        # dark energy closes the budget
+        self.Omega_de=1.0-self.Omega_k-self.Omega_cb-self.Omega_gamma
+        self.Omega_de-=self.Omega_nu(0.0)
+
+        # snapshot redshifts, if set up from a paramfile
+        self.zs=None
+
+
+    def Omega_nu(self,z):
+        """Neutrino energy density, relative to critical density today"""
+
+        a=1.0/(1.0+np.asarray(z,dtype=float))
+        y=self.m_nu*a[...,np.newaxis]/self.kT_nu0
+        ratio=np.sum(get_nu_density_ratio(y),axis=-1)
+        return self.Omega_nu_rel*ratio/a**4
+
+
+    def E_z(self,z):
+        """H(z)/H0, vectorized over z"""
+
+        zp1=1.0+np.asarray(z,dtype=float)
+        E2=self.Omega_cb*zp1**3+self.Omega_gamma*zp1**4+self.Omega_nu(z)
+        E2+=self.Omega_k*zp1**2+self.Omega_de*zp1**(3.0*(1.0+self.w))
+        return np.sqrt(E2)
+
+
+    def H_z(self,z):
+        """Hubble parameter in km/s/Mpc"""
+
+        return self.H0*self.E_z(z)
+
+
+    def dkms_dMpc(self,z):
+        """Conversion factor from comoving Mpc to km/s, H(z)/(1+z)"""
+
+        return self.H_z(z)/(1.0+np.asarray(z,dtype=float))
+
+
+def get_background(paramfile):
+    """Background cosmology and snapshot redshifts of a simulation, using
+        its SimulationConfig (results are cached while the file does not
+        change)."""
+
+    key=(os.path.abspath(paramfile),os.path.getmtime(paramfile))
+    if key in _background_cache:
+        return _background_cache[key]
+
+    sim_config=read_gadget.get_simulation_config(paramfile)
+    config=sim_config.config
+    background=Background(sim_config.camb_params(),
+                m_nu=[config['MNue'],config['MNum'],config['MNut']])
+    background.zs=sim_config.zs
+    background.dkms_dMpc_zs=background.dkms_dMpc(background.zs)
+
+    _background_cache[key]=background
+    return background
+
+
+def dkms_dMpc_snapshots(paramfile):
+    """Redshifts and dv/dX (in km/s/Mpc) for all snapshots of a simulation"""
+
+    background=get_background(paramfile)
+
+    return background.zs, background.dkms_dMpc_zs
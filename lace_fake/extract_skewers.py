@@ -2,17 +2,122 @@ import numpy as np
 import sys
 import os
 import json
-import fake_spectra.tempdens as tdr
-import fake_spectra.griddedspectra as grid_spec 
 import time
 # our modules
 from lace_fake import read_gadget
-try:
-    from lace.cosmo import camb_cosmo
-    use_camb=True
-except:
-    print('will not be able to use CAMB')
-    use_camb=False
+from lace_fake import thermal_cache
+from lace_fake import background
+
+# default memory (in MB) used to keep particle data, see ParticleDataCache
+MAX_PARTICLE_CACHE_MB=4096.0
+
+class ParticleDataCache(object):
+    """Keep in memory the particle data read from a snapshot, so that it
+        can be shared by several GriddedSpectra objects (e.g., with different
+        temperature rescalings). Only raw blocks read with get_data are
+        cached: derived quantities (like rescaled temperatures) are still
+        computed by each object. Copies are returned, since fake_spectra
+        might modify the arrays in place."""
+
+    def __init__(self,max_cache_MB=None):
+        """Setup empty cache, using at most max_cache_MB of memory (by
+            default MAX_PARTICLE_CACHE_MB). Blocks that do not fit are not
+            cached, and are read again every time: all temperature models
+            read blocks in the same order, so evicting older blocks would
+            only replace blocks that are about to be reused."""
+
+        if max_cache_MB is None:
+            max_cache_MB=MAX_PARTICLE_CACHE_MB
+        self.max_cache_MB=max_cache_MB
+        self.data={}
+        self.nbytes=0
+        self.n_reads=0
+        self.n_hits=0
+
+
+    def attach(self,snapshot_set):
+        """Make snapshot_set (from fake_spectra) read blocks through cache"""
+
+        read_data=snapshot_set.get_data
+
+        def get_data(part_type,blockname,segment=None,**kwargs):
+            key=(part_type,blockname,segment)+tuple(sorted(kwargs.items()))
+            if key in self.data:
+                self.n_hits+=1
+                return np.copy(self.data[key])
+            if segment is None:
+                block=read_data(part_type,blockname,**kwargs)
+            else:
+                block=read_data(part_type,blockname,segment=segment,**kwargs)
+            self.n_reads+=1
+            nbytes=np.asarray(block).nbytes
+            if self.nbytes+nbytes <= self.max_cache_MB*1024**2:
+                self.data[key]=np.copy(block)
+                self.nbytes+=nbytes
+            return block
+
+        snapshot_set.get_data=get_data
+
+
+    def clear(self):
+        """Release all cached particle data"""
+
+        self.data={}
+        self.nbytes=0
+
+
+    def to_shared_memory(self):
+        """Copy cached blocks to shared memory, to be used by other processes.
+            Returns the shared memory segments (to be closed and unlinked by
+            the caller) and a description of each block (key, name of shared
+            memory segment, shape and dtype) that can be sent to workers."""
+
+        from multiprocessing import shared_memory
+
+        segments=[]
+        shared_blocks=[]
+        for key,block in self.data.items():
+            shm=shared_memory.SharedMemory(create=True,size=max(1,block.nbytes))
+            shared=np.ndarray(block.shape,dtype=block.dtype,buffer=shm.buf)
+            shared[...]=block
+            segments.append(shm)
+            shared_blocks.append((key,shm.name,block.shape,block.dtype.str))
+
+        return segments, shared_blocks
+
+
+    @classmethod
+    def from_shared_memory(cls,shared_blocks):
+        """Setup cache using blocks in shared memory (from to_shared_memory),
+            without copying them. Returns the cache and the shared memory
+            segments, that should be closed (not unlinked) when done."""
+
+        cache=cls()
+        segments=[]
+        for key,name,shape,dtype in shared_blocks:
+            shm=attach_shared_memory(name)
+            block=np.ndarray(shape,dtype=dtype,buffer=shm.buf)
+            block.flags.writeable=False
+            cache.data[key]=block
+            cache.nbytes+=block.nbytes
+            segments.append(shm)
+
+        return cache, segments
+
+
+def attach_shared_memory(name):
+    """Attach to existing shared memory segment, created by another process
+        that is responsible for unlinking it"""
+
+    from multiprocessing import shared_memory
+
+    try:
+        return shared_memory.SharedMemory(name=name,track=False)
+    except TypeError:
+        # before python 3.13 the segment is registered again, but workers
+        # of a process pool share the resource tracker of the parent
+        return shared_memory.SharedMemory(name=name)
+
 
 def get_skewers_filename(num,n_skewers,width_Mpc,scale_T0=None,
             scale_gamma=None):
@@ -37,28 +142,27 @@ def get_snapshot_json_filename(num,n_skewers,width_Mpc):
     return filename 
 
 
-def dkms_dMpc_z(raw_dir,num):
-    """Setup cosmology from Gadget config file, and compute dv/dX"""
+def dkms_dMpc_z(raw_dir,num,use_camb=False):
+    """Setup cosmology from Gadget config file, and compute dv/dX.
+        By default use the background engine (cached per simulation), with
+        use_camb=True compute it with CAMB instead."""
 
     paramfile=raw_dir+'/paramfile.gadget'
-    zs=read_gadget.redshifts_from_paramfile(paramfile)
-    z=zs[num]
-    # read cosmology information from Gadget file
-    cosmo_params=read_gadget.camb_from_gadget(paramfile)
     if use_camb:
+        from lace.cosmo import camb_cosmo
+        sim_config=read_gadget.get_simulation_config(paramfile)
+        z=sim_config.zs[num]
         # setup CAMB object from dictionary with parameters
+        cosmo_params=sim_config.camb_params()
         cosmo=camb_cosmo.get_cosmology_from_dictionary(cosmo_params)
         # convert kms to Mpc (should be around 75 km/s/Mpc at z=3)
         dkms_dMpc=camb_cosmo.dkms_dMpc(cosmo,z=z)
     else:
-        # read from cosmo dictionary
-        H0=cosmo_params['H0']
-        # for now can not handle neutrinos
-        assert cosmo_params['mnu'] ==0, 'implement neutrinos'
-        Om=(cosmo_params['omch2']+cosmo_params['ombh2'])/(H0/100)**2
-        Hz=H0*np.sqrt(Om*(1+z)**3+(1-Om))
-        dkms_dMpc=Hz/(1+z)
-        print(z,'; H(z) =',Hz,'; dv/dX =',dkms_dMpc)
+        # all snapshots are computed at once, when first called
+        zs,dkms_dMpc_zs=background.dkms_dMpc_snapshots(paramfile)
+        z=zs[num]
+        dkms_dMpc=dkms_dMpc_zs[num]
+        print(z,'; dv/dX =',dkms_dMpc)
 
     return dkms_dMpc,z
 
@@ -79,8 +183,19 @@ def thermal_broadening_Mpc(T_0,dkms_dMpc):
 
 
 def rescale_write_skewers_z(raw_dir,post_dir,num,n_skewers=50,
-            width_Mpc=0.1,axis=None,scales_T0=None,scales_gamma=None):
-    """Extract skewers for a given snapshot, for different temperatures."""
+            width_Mpc=0.1,axis=None,scales_T0=None,scales_gamma=None,
+            reuse_particle_data=False,max_cache_MB=None,n_workers=None,
+            td_fraction=None):
+    """Extract skewers for a given snapshot, for different temperatures.
+        If reuse_particle_data, particle data is read from the snapshot only
+        once and shared by all temperature rescalings, using up to
+        max_cache_MB of memory (see ParticleDataCache). Otherwise, particle
+        data is read again (one segment at a time) for each rescaling.
+        If n_workers > 1, the particle data read for the first temperature
+        model is placed in shared memory, and the other models are computed
+        in a pool of n_workers processes.
+        If td_fraction is set, the temperature-density relation is fitted
+        on that fraction of the gas particles (with bootstrap errors)."""
 
     # don't rescale unless asked to
     if scales_T0 is None:
@@ -95,17 +210,22 @@ def rescale_write_skewers_z(raw_dir,post_dir,num,n_skewers=50,
     Hz = dkms_dMpc * (1+z)
 
 
-    # figure out temperature-density before scalings
+    # figure out temperature-density before scalings (fit only once)
     t0=time.time()
-    T0_ini, gamma_ini = tdr.fit_td_rel_plot(num,raw_dir+'/output/',plot=False)
+    td_fit = thermal_cache.get_thermal_entry(raw_dir,post_dir,num,
+                fraction=td_fraction,verbose=True)
+    T0_ini, gamma_ini = td_fit['T0'], td_fit['gamma']
     t1=time.time()
-    print('measured temp-dens relation in in {} seconds'.format(t1-t0))
+    print('got temp-dens relation in in {} seconds'.format(t1-t0))
 
     sim_info={'raw_dir':raw_dir, 'post_dir':post_dir, 'axis':axis,
                 'z':z, 'snap_num':num, 'n_skewers':n_skewers, 
                 'width_Mpc':width_Mpc, 'width_kms':width_kms,
                 'T0_ini':T0_ini, 'gamma_ini':gamma_ini,
                 'scales_T0':scales_T0, 'scales_gamma':scales_gamma}
+    if td_fit.get('sigma_T0') is not None:
+        sim_info['T0_ini_err']=td_fit['sigma_T0']
+        sim_info['gamma_ini_err']=td_fit['sigma_gamma']
 
     # make sure output directory exists (will write skewers there)
     if axis is not None:
@@ -119,49 +239,46 @@ def rescale_write_skewers_z(raw_dir,post_dir,num,n_skewers=50,
 
     os.makedirs(skewers_dir,exist_ok=True)
 
-    # will also store measured values
-    sim_T0=[]
-    sim_gamma=[]
-    sim_sigT_Mpc=[]
-    sim_mf=[]
-    sim_scale_T0=[]
-    sim_scale_gamma=[]
-    sk_files=[]
-
+    # list of temperature models, and settings shared by all of them
+    models=[]
     for scale_T0 in scales_T0:
         for scale_gamma in scales_gamma:
-            T0=T0_ini*scale_T0
-            gamma=gamma_ini*scale_gamma
-            sk_filename=get_skewers_filename(num,n_skewers,width_Mpc,
-                                    scale_T0,scale_gamma)
-
-            # avoid (if possible) to use set_T0, might break fake_spectra
-            if (scale_T0==1.0) and (scale_gamma==1.0):
-                skewers=get_skewers_snapshot(raw_dir,skewers_dir,num,
-                            n_skewers=n_skewers,width_kms=width_kms,
-                            axis=axis,skewers_filename=sk_filename,Hz=Hz)
-            else:
-                skewers=get_skewers_snapshot(raw_dir,skewers_dir,num,
-                            n_skewers=n_skewers,width_kms=width_kms,
-                            set_T0=T0,set_gamma=gamma,
-                            axis=axis,skewers_filename=sk_filename,Hz=Hz)
-
-            # call mean flux, so that the skewers are really computed
-            t0=time.time()
-            mf=skewers.get_mean_flux()
-            t1=time.time()
-            print('extracted skewers in {} seconds'.format(t1-t0))
-            skewers.save_file()
-
-            sim_mf.append(mf)
-            # store temperature information
-            sim_T0.append(T0)
-            sim_gamma.append(gamma)
-            sim_sigT_Mpc.append(thermal_broadening_Mpc(T0,dkms_dMpc))
-            sim_scale_T0.append(scale_T0)
-            sim_scale_gamma.append(scale_gamma)
-            # store file name
-            sk_files.append(sk_filename)
+            models.append({'scale_T0':scale_T0,'scale_gamma':scale_gamma,
+                    'T0':T0_ini*scale_T0,'gamma':gamma_ini*scale_gamma,
+                    'sk_filename':get_skewers_filename(num,n_skewers,
+                            width_Mpc,scale_T0,scale_gamma)})
+    settings={'raw_dir':raw_dir,'skewers_dir':skewers_dir,'num':num,
+            'n_skewers':n_skewers,'width_kms':width_kms,'axis':axis,'Hz':Hz}
+
+    # particle data shared by all temperature rescalings
+    if reuse_particle_data or (n_workers and n_workers>1):
+        particle_cache=ParticleDataCache(max_cache_MB=max_cache_MB)
+    else:
+        particle_cache=None
+
+    if n_workers and n_workers>1 and len(models)>1:
+        # first model read particle data, that is then shared with workers
+        sim_mf=[extract_thermal_model(models[0],settings,particle_cache)]
+        sim_mf+=extract_thermal_models_parallel(models[1:],settings,
+                    particle_cache,n_workers)
+    else:
+        sim_mf=[extract_thermal_model(model,settings,particle_cache)
+                    for model in models]
+
+    if particle_cache is not None:
+        print('read {} particle blocks, reused {} ({:.1f} MB cached)'.format(
+                particle_cache.n_reads,particle_cache.n_hits,
+                particle_cache.nbytes/1024**2))
+        particle_cache.clear()
+
+    # store temperature information
+    sim_T0=[model['T0'] for model in models]
+    sim_gamma=[model['gamma'] for model in models]
+    sim_sigT_Mpc=[thermal_broadening_Mpc(T0,dkms_dMpc) for T0 in sim_T0]
+    sim_scale_T0=[model['scale_T0'] for model in models]
+    sim_scale_gamma=[model['scale_gamma'] for model in models]
+    # store file names
+    sk_files=[model['sk_filename'] for model in models]
 
     sim_info['sim_T0']=sim_T0
     sim_info['sim_gamma']=sim_gamma
@@ -180,6 +297,82 @@ def rescale_write_skewers_z(raw_dir,post_dir,num,n_skewers=50,
     return sim_info
 
 
+def extract_thermal_model(model,settings,particle_cache=None):
+    """Extract and save skewers for a temperature model (a dictionary with
+        T0, gamma, their scalings and the skewers filename). settings
+        contains the options shared by all models in the snapshot.
+        Returns the mean flux in the skewers."""
+
+    # avoid (if possible) to use set_T0, might break fake_spectra
+    if (model['scale_T0']==1.0) and (model['scale_gamma']==1.0):
+        skewers=get_skewers_snapshot(settings['raw_dir'],
+                    settings['skewers_dir'],settings['num'],
+                    n_skewers=settings['n_skewers'],
+                    width_kms=settings['width_kms'],axis=settings['axis'],
+                    skewers_filename=model['sk_filename'],Hz=settings['Hz'])
+    else:
+        skewers=get_skewers_snapshot(settings['raw_dir'],
+                    settings['skewers_dir'],settings['num'],
+                    n_skewers=settings['n_skewers'],
+                    width_kms=settings['width_kms'],
+                    set_T0=model['T0'],set_gamma=model['gamma'],
+                    axis=settings['axis'],
+                    skewers_filename=model['sk_filename'],Hz=settings['Hz'])
+    if particle_cache is not None:
+        particle_cache.attach(skewers.snapshot_set)
+
+    # call mean flux, so that the skewers are really computed
+    t0=time.time()
+    mf=skewers.get_mean_flux()
+    t1=time.time()
+    print('extracted skewers in {} seconds'.format(t1-t0))
+    skewers.save_file()
+
+    return mf
+
+
+def extract_thermal_model_shared(model,settings,shared_blocks):
+    """Extract and save skewers for a temperature model, using particle
+        data in shared memory. Defined at module level so that it can run
+        in a process pool."""
+
+    particle_cache,segments=ParticleDataCache.from_shared_memory(shared_blocks)
+    try:
+        mf=extract_thermal_model(model,settings,particle_cache)
+    finally:
+        particle_cache.clear()
+        for shm in segments:
+            shm.close()
+
+    return mf
+
+
+def extract_thermal_models_parallel(models,settings,particle_cache,n_workers):
+    """Extract skewers for several temperature models in a pool of
+        n_workers processes, sharing the particle data already read in
+        particle_cache (without a copy per worker).
+        Returns the mean flux of each model, in the same order."""
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    segments,shared_blocks=particle_cache.to_shared_memory()
+    print('shared {} particle blocks with {} processes'.format(
+                len(shared_blocks),n_workers))
+    # release private copy of the particle data
+    particle_cache.clear()
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            sim_mf=list(executor.map(extract_thermal_model_shared,models,
+                        [settings]*len(models),
+                        [shared_blocks]*len(models)))
+    finally:
+        for shm in segments:
+            shm.close()
+            shm.unlink()
+
+    return sim_mf
+
+
 def get_skewers_snapshot(raw_dir,skewers_dir,snap_num,n_skewers=50,width_kms=10,
                 axis=1,set_T0=None,set_gamma=None,skewers_filename=None,Hz=None):
     """Extract skewers for a particular snapshot"""
@@ -198,6 +391,9 @@ def get_skewers_snapshot(raw_dir,skewers_dir,snap_num,n_skewers=50,width_kms=10,
     if os.path.exists(skewers_dir+'/'+skewers_filename):
         print(skewers_filename,'already exists in',skewers_dir)
 
+    # import here, to keep the import of this module light
+    import fake_spectra.griddedspectra as grid_spec
+
     # fake_spectra will set n_pix=int(L_kms/pix_kms), rounded down
     tweaked_width_kms=0.99999*width_kms
 
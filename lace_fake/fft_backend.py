@@ -0,0 +1,97 @@
+""" Select the FFT library (and number of threads) used to measure power.
+
+Available backends are:
+ - 'numpy': numpy.fft (single-threaded)
+ - 'scipy': scipy.fft, using several workers
+ - 'pyfftw': pyFFTW interfaces, using several threads and cached plans
+
+The backend can be set in each call, or with the environment variable
+LACE_FAKE_FFT_BACKEND. The number of threads can be set in each call, or
+with LACE_FAKE_FFT_WORKERS, otherwise it follows OMP_NUM_THREADS,
+SLURM_CPUS_PER_TASK or the cores available to the process. """
+
+import os
+import numpy as np
+
+BACKEND_ENV='LACE_FAKE_FFT_BACKEND'
+WORKERS_ENV='LACE_FAKE_FFT_WORKERS'
+BACKENDS=['numpy','scipy','pyfftw']
+
+
+def get_fft_workers(workers=None):
+    """ Number of threads to use in FFTs, by default set by the job """
+
+    if workers:
+        return int(workers)
+    for env in [WORKERS_ENV,'OMP_NUM_THREADS','SLURM_CPUS_PER_TASK']:
+        if os.environ.get(env):
+            return max(1,int(os.environ[env]))
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def get_fft_backend(backend=None):
+    """ Name of the FFT backend to use. By default use scipy if available """
+
+    if backend is None:
+        backend=os.environ.get(BACKEND_ENV)
+    if backend is None:
+        try:
+            import scipy.fft
+            backend='scipy'
+        except ImportError:
+            backend='numpy'
+    if backend not in BACKENDS:
+        raise ValueError('unknown FFT backend '+backend)
+    return backend
+
+
+def _get_pyfftw_interface():
+    """ Import pyFFTW numpy-like interface, with cache of FFTW plans """
+
+    import pyfftw
+    import pyfftw.interfaces.numpy_fft
+    pyfftw.interfaces.cache.enable()
+    return pyfftw.interfaces.numpy_fft
+
+
+def _transform(name,a,backend,workers,**kwargs):
+    """ Call FFT function name (rfft, fft, rfftn, ...) from chosen backend """
+
+    backend=get_fft_backend(backend)
+    if backend=='numpy':
+        return getattr(np.fft,name)(a,**kwargs)
+
+    workers=get_fft_workers(workers)
+    if backend=='scipy':
+        import scipy.fft
+        return getattr(scipy.fft,name)(a,workers=workers,**kwargs)
+    else:
+        interface=_get_pyfftw_interface()
+        return getattr(interface,name)(a,threads=workers,**kwargs)
+
+
+def rfft(a,axis=-1,backend=None,workers=None):
+    """ 1D FFT of real input, along axis """
+
+    return _transform('rfft',a,backend,workers,axis=axis)
+
+
+def fft(a,axis=-1,backend=None,workers=None):
+    """ 1D FFT of complex input, along axis """
+
+    return _transform('fft',a,backend,workers,axis=axis)
+
+
+def rfftn(a,backend=None,workers=None):
+    """ N-dimensional FFT of real input """
+
+    return _transform('rfftn',a,backend,workers)
+
+
+def fftn(a,backend=None,workers=None):
+    """ N-dimensional FFT of complex input """
+
+    return _transform('fftn',a,backend,workers)
@@ -2,9 +2,6 @@
 import os
 import json
 import numpy as np
-import matplotlib.pyplot as plt
-import scipy.optimize as spo
-import fake_spectra.abstractsnapshot as absn
 from lace_fake import read_gadget
 from lace_fake import flux_real_genpk
 
@@ -12,105 +9,282 @@ def power_spectrum_model(k, A, n, kF):
     return A * (k ** n) * np.exp(-1. * ((k /kF) ** 2))
 
 
-def fit_filtering_length(simdir, kmax_Mpc=None,verbose=False,run_genpk=False,
+def stack_spectra(k_Mpc,Pk3,kmax_Mpc):
+    """Stack spectra (possibly with different number of wavenumbers) into
+        2D arrays, with a mask selecting the wavenumbers to fit"""
+
+    n_spec=len(k_Mpc)
+    n_k=max(len(k) for k in k_Mpc)
+    k_stack=np.ones((n_spec,n_k))
+    P_stack=np.ones((n_spec,n_k))
+    mask=np.zeros((n_spec,n_k),dtype=bool)
+    kmax_Mpc=np.broadcast_to(kmax_Mpc,(n_spec,))
+    for i in range(n_spec):
+        n=len(k_Mpc[i])
+        k_stack[i,:n]=k_Mpc[i]
+        P_stack[i,:n]=Pk3[i]
+        # log-space fit needs positive values
+        mask[i,:n]=(k_Mpc[i]>0)&(k_Mpc[i]<kmax_Mpc[i])&(Pk3[i]>0)
+
+    return k_stack,P_stack,mask
+
+
+def fit_filtering_length_batch(k_Mpc,Pk3,kmax_Mpc,n_gauss_newton=5):
+    """Fit power_spectrum_model to several spectra at once.
+        In log space the model is linear in (log A, n, 1/kF^2), and it is
+        solved in closed form (weighted least squares). The fit is then
+        polished with n_gauss_newton steps minimizing the residuals of the
+        power itself (as curve_fit did), and covariances are computed as in
+        curve_fit. k_Mpc and Pk3 are lists of arrays (one per spectrum),
+        kmax_Mpc can be a number or an array with one value per spectrum.
+        Returns a dictionary with arrays A, n, kF_Mpc and covariance
+        (of A, n, kF_Mpc, shape (n_spec,3,3)). Spectra with 3 or fewer
+        wavenumbers to fit get NaN values (with a warning)."""
+
+    k,P,mask=stack_spectra(k_Mpc,Pk3,kmax_Mpc)
+    w=mask.astype(float)
+    n_data=w.sum(axis=1)
+    valid=n_data>3
+    if not np.all(valid):
+        print('WARNING: not enough wavenumbers to fit filtering length of',
+                    'spectra',np.flatnonzero(~valid))
+        n_spec=len(valid)
+        fits={'A':np.full(n_spec,np.nan),'n':np.full(n_spec,np.nan),
+                    'kF_Mpc':np.full(n_spec,np.nan),
+                    'covariance':np.full((n_spec,3,3),np.nan)}
+        if np.any(valid):
+            use=np.flatnonzero(valid)
+            kmax_Mpc=np.broadcast_to(kmax_Mpc,(n_spec,))
+            valid_fits=fit_filtering_length_batch([k_Mpc[i] for i in use],
+                        [Pk3[i] for i in use],kmax_Mpc[use],
+                        n_gauss_newton=n_gauss_newton)
+            for key in fits:
+                fits[key][use]=valid_fits[key]
+        return fits
+
+    # design matrix for log P = log A + n log k - c k^2, with c = 1/kF^2
+    # (logs only of fitted values, since masked ones can be zero)
+    k=np.where(mask,k,1.0)
+    P=np.where(mask,P,1.0)
+    logk=np.log(k)
+    X=np.stack([np.ones_like(k),logk,-k**2],axis=-1)
+    y=np.log(P)
+    XtWX=np.einsum('ski,sk,skj->sij',X,w,X)
+    XtWy=np.einsum('ski,sk,sk->si',X,w,y)
+    theta=np.linalg.solve(XtWX,XtWy[...,np.newaxis])[...,0]
+
+    def get_residuals(theta):
+        model=np.exp(theta[:,0,np.newaxis]+theta[:,1,np.newaxis]*logk
+                    -theta[:,2,np.newaxis]*k**2)
+        return model,(P-model)*w
+
+    # Gauss-Newton steps in linear space, halving steps that do not improve
+    model,res=get_residuals(theta)
+    chi2=np.sum(res**2,axis=1)
+    for it in range(n_gauss_newton):
+        J=model[...,np.newaxis]*X*w[...,np.newaxis]
+        JtJ=np.einsum('ski,skj->sij',J,J)
+        Jtr=np.einsum('ski,sk->si',J,res)
+        step=np.linalg.solve(JtJ,Jtr[...,np.newaxis])[...,0]
+        todo=np.ones(len(theta),dtype=bool)
+        for halving in range(10):
+            trial=np.where(todo[:,np.newaxis],theta+step,theta)
+            trial_model,trial_res=get_residuals(trial)
+            trial_chi2=np.sum(trial_res**2,axis=1)
+            better=todo&(trial_chi2<=chi2)
+            theta[better]=trial[better]
+            model[better]=trial_model[better]
+            res[better]=trial_res[better]
+            chi2[better]=trial_chi2[better]
+            todo&=~better
+            if not np.any(todo):
+                break
+            step*=0.5
+
+    # covariance of (log A, n, c), scaled by residual variance (as curve_fit)
+    if n_gauss_newton>0:
+        J=model[...,np.newaxis]*X*w[...,np.newaxis]
+        JtJ=np.einsum('ski,skj->sij',J,J)
+        s2=chi2/(n_data-3)
+    else:
+        JtJ=XtWX
+        log_res=(y-np.einsum('ski,si->sk',X,theta))*w
+        s2=np.sum(log_res**2,axis=1)/(n_data-3)
+    cov_theta=np.linalg.inv(JtJ)*s2[:,np.newaxis,np.newaxis]
+
+    # translate to (A, n, kF)
+    A=np.exp(theta[:,0])
+    c=theta[:,2]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        kF_Mpc=np.where(c>0,1.0/np.sqrt(c),np.nan)
+    D=np.zeros_like(cov_theta)
+    D[:,0,0]=A
+    D[:,1,1]=1.0
+    with np.errstate(divide='ignore',invalid='ignore'):
+        D[:,2,2]=-0.5*kF_Mpc**3
+    covariance=np.einsum('sij,sjk,slk->sil',D,cov_theta,D)
+
+    return {'A':A,'n':theta[:,1],'kF_Mpc':kF_Mpc,'covariance':covariance}
+
+
+def read_flux_real_power(simdir,num,L_Mpc):
+    """Read "flux real" power measured by GenPk in a snapshot, and return
+        wavenumbers (in 1/Mpc) and dimensionless power (P*k**3)"""
+
+    genpk_filename=flux_real_genpk.flux_real_genpk_filename(simdir,num)
+    genpk_file = np.loadtxt(genpk_filename)
+    k_box_units = genpk_file[:, 0]
+    # dimensionless power spectrum (P*k**3)
+    Pk3 = ((k_box_units * 1.) ** 3) * genpk_file[:, 1]
+    # normalize wavenumbers
+    k_0_Mpc = 2. * np.pi / L_Mpc
+    k_Mpc = k_box_units * k_0_Mpc
+
+    return k_Mpc, Pk3
+
+
+def plot_filtering_length(k_Mpc,Pk3,kmax_Mpc,opt_params,z,genpk_plot=None):
+    """Plot measured "flux real" power and best fit model"""
+
+    import matplotlib.pyplot as plt
+
+    fit_kF_Mpc=opt_params[2]
+    plt.figure()
+    plt.plot(k_Mpc, Pk3, label=r'Simulation')
+    mask=(k_Mpc < kmax_Mpc)
+    Pk_model=power_spectrum_model(k_Mpc[mask],*opt_params)
+    plt.plot(k_Mpc[mask], Pk_model, ls='--',
+            label=r'Best-fit model, $k_F$ = %.2f 1/Mpc'%fit_kF_Mpc)
+    plt.axvline(x = kmax_Mpc, ls=':', color='black')
+    plt.xscale('log')
+    plt.yscale('log')
+    plt.ylim([np.min(Pk3) / 5., np.max(Pk3) * 5.])
+    plt.legend()
+    plt.xlabel(r'k [1 / Mpc]')
+    plt.ylabel(r'Dimensionless power')
+    plt.title(r'Real-space flux, z = %.3f'%z)
+    if genpk_plot:
+        plt.savefig(genpk_plot)
+
+
+def fit_filtering_length_suite(simdirs, kmax_Mpc=None,verbose=False,
+                run_genpk=False,
                 genpk_full_path='/home/dc-font1/Codes/GenPK_Keir/gen-pk',
-                write_json=True,show_plots=False,store_plots=False):
-    """For each snapshot fit filtering length from measured "flux real" power"""
+                write_json=True,show_plots=False,store_plots=False,
+                n_gauss_newton=5,n_genpk_workers=4,genpk_max_retries=1):
+    """Fit filtering length for all snapshots in several simulations, from
+        measured "flux real" power, solving all fits at once.
+        If run_genpk, GenPk is first run for all snapshots missing it, with
+        up to n_genpk_workers processes at once.
+        Returns a list with the results for each simulation."""
 
-    # figure out snapshots in simulation
-    paramfile=simdir+'/paramfile.gadget'
-    if verbose: print('read GADGET config file',paramfile)
-    zs=read_gadget.redshifts_from_paramfile(paramfile)
-    Nsnap=len(zs)
-
-    # measured "flux real" power stored here
-    genpkdir=simdir+'/genpk/'
-    os.makedirs(genpkdir,exist_ok=True)
-
-    # snapshot outputs are here
-    outdir=simdir+'/output/'
-
-    # store filtering lengths here
-    kF_Mpc=[]
-
-    for num in range(Nsnap):
-        # make sure that GenPk has been run for this snapshot
-        genpk_filename=flux_real_genpk.flux_real_genpk_filename(simdir,num)
-        if not os.path.exists(genpk_filename):
-            if verbose: print('genpk not ran yet',genpk_filename)
-            if run_genpk:
-                flux_real_genpk.compute_flux_real_power(simdir,snap_num,num,
-                            verbose=False,genpk_full_path=genpk_full_path)
-        else:
-            if verbose: print('genpk already ran',genpk_filename)
-
-        # snapshot redshift
-        z=zs[num]
-        # extra information from snapshot
-        snap=absn.AbstractSnapshotFactory(num,outdir,Tscale=1.0,gammascale=1.0)
-        # normalized Hubble parameter h ~ 0.7)
-        hubble = snap.get_header_attr("HubbleParam")
-        # box size in kpc/h
-        L_hkpc= snap.get_header_attr("BoxSize")
-        L_Mpc=L_hkpc/1000.0/hubble
-
-        # fit filtering length from measured "flux real" power
-        genpk_file = np.loadtxt(genpk_filename)
-        k_box_units = genpk_file[:, 0]
-        # dimensionless power spectrum (P*k**3)
-        Pk3 = ((k_box_units * 1.) ** 3) * genpk_file[:, 1]
-        # normalize wavenumbers
+    if run_genpk:
+        tasks=[]
+        for simdir in simdirs:
+            paramfile=simdir+'/paramfile.gadget'
+            Nsnap=read_gadget.get_simulation_config(paramfile).n_snapshots
+            tasks+=[(simdir,num) for num in range(Nsnap)]
+        results,failed=flux_real_genpk.run_genpk_tasks(tasks,genpk_full_path,
+                    n_workers=n_genpk_workers,max_retries=genpk_max_retries,
+                    verbose=verbose)
+        if failed:
+            raise RuntimeError('GenPk failed for {} snapshots: {}'.format(
+                        len(failed),failed))
+
+    # collect spectra from all snapshots in all simulations
+    spectra=[]
+    sims=[]
+    for simdir in simdirs:
+        # figure out snapshots in simulation
+        paramfile=simdir+'/paramfile.gadget'
+        if verbose: print('read GADGET config file',paramfile)
+        sim_config=read_gadget.get_simulation_config(paramfile)
+        zs=sim_config.zs
+        Nsnap=sim_config.n_snapshots
+        # box size from GenIC file, same for all snapshots
+        L_Mpc=sim_config.L_Mpc
         k_0_Mpc = 2. * np.pi / L_Mpc
-        k_Mpc = k_box_units * k_0_Mpc
-        #P_Mpc = Pk3 / k_Mpc**3
+
+        # measured "flux real" power stored here
+        genpkdir=simdir+'/genpk/'
+        os.makedirs(genpkdir,exist_ok=True)
 
         # fit wavenumbers below this one
-        if not kmax_Mpc:
-            kmax_Mpc = 120. * k_0_Mpc 
-            if verbose: print('use kmax_Mpc =',kmax_Mpc)
-        # get optimised parameters and covariance
-        params_bounds = (np.array([-np.inf, -np.inf, 0.]), np.inf)
-        opt_params, params_cov = spo.curve_fit(power_spectrum_model, 
-                    k_Mpc[k_Mpc<kmax_Mpc], Pk3[k_Mpc<kmax_Mpc], 
-                    bounds=params_bounds)
-
-        if verbose:
-            print('A = %e ; n = %e ; k_F = %.4f 1/Mpc'%tuple(opt_params))
-            print('Paramater covariance =', params_cov)
-
-        fit_kF_Mpc=opt_params[2]
-        kF_Mpc.append(fit_kF_Mpc)
-
-        if store_plots or show_plots:
-            plt.figure()
-            plt.plot(k_Mpc, Pk3, label=r'Simulation')
-            mask=(k_Mpc < kmax_Mpc)
-            Pk_model=power_spectrum_model(k_Mpc[mask],*opt_params)
-            plt.plot(k_Mpc[mask], Pk_model, ls='--',
-                    label=r'Best-fit model, $k_F$ = %.2f 1/Mpc'%fit_kF_Mpc)
-            plt.axvline(x = kmax_Mpc, ls=':', color='black')
-            plt.xscale('log')
-            plt.yscale('log')
-            plt.ylim([np.min(Pk3) / 5., np.max(Pk3) * 5.])
-            plt.legend()
-            plt.xlabel(r'k [1 / Mpc]')
-            plt.ylabel(r'Dimensionless power')
-            plt.title(r'Real-space flux, z = %.3f'%z)
-            if store_plots:
-                genpk_plot=genpkdir+'kF_'+str(num)+'.png'
-                plt.savefig(genpk_plot)
-
-    if show_plots: 
+        if kmax_Mpc:
+            sim_kmax_Mpc = kmax_Mpc
+        else:
+            sim_kmax_Mpc = 120. * k_0_Mpc
+            if verbose: print('use kmax_Mpc =',sim_kmax_Mpc)
+
+        for num in range(Nsnap):
+            k_Mpc,Pk3=read_flux_real_power(simdir,num,L_Mpc)
+            spectra.append({'k_Mpc':k_Mpc,'Pk3':Pk3,'kmax_Mpc':sim_kmax_Mpc,
+                        'z':zs[num],'genpk_plot':genpkdir+'kF_'+str(num)+'.png'})
+        sims.append({'simdir':simdir,'zs':zs,'kmax_Mpc':sim_kmax_Mpc,
+                    'Nsnap':Nsnap})
+
+    # fit all spectra at once
+    fits=fit_filtering_length_batch([spec['k_Mpc'] for spec in spectra],
+                [spec['Pk3'] for spec in spectra],
+                np.array([spec['kmax_Mpc'] for spec in spectra]),
+                n_gauss_newton=n_gauss_newton)
+
+    results=[]
+    i0=0
+    for sim in sims:
+        kF_Mpc=[]
+        kF_Mpc_err=[]
+        for num in range(sim['Nsnap']):
+            i=i0+num
+            opt_params=(fits['A'][i],fits['n'][i],fits['kF_Mpc'][i])
+            params_cov=fits['covariance'][i]
+            if verbose:
+                print('A = %e ; n = %e ; k_F = %.4f 1/Mpc'%opt_params)
+                print('Paramater covariance =', params_cov)
+            kF_Mpc.append(float(opt_params[2]))
+            kF_Mpc_err.append(float(np.sqrt(params_cov[2,2])))
+            if store_plots or show_plots:
+                spec=spectra[i]
+                if store_plots:
+                    genpk_plot=spec['genpk_plot']
+                else:
+                    genpk_plot=None
+                plot_filtering_length(spec['k_Mpc'],spec['Pk3'],
+                            spec['kmax_Mpc'],opt_params,spec['z'],
+                            genpk_plot=genpk_plot)
+        i0+=sim['Nsnap']
+
+        simdir=sim['simdir']
+        kF_data = {'simdir':simdir, 'kF_Mpc':kF_Mpc,
+                    'kmax_kF_Mpc':sim['kmax_Mpc']}
+        kF_data['kF_Mpc_err']=kF_Mpc_err
+        kF_data['kF_zs']=sim['zs'].tolist()
+        results.append(kF_data)
+
+        # store information in json file
+        if write_json:
+            json_filename=simdir+'/filtering_length.json'
+            json_file = open(json_filename,"w")
+            json.dump(kF_data,json_file)
+            json_file.close()
+
+    if show_plots:
+        import matplotlib.pyplot as plt
         plt.show()
 
-    # store information in json file
-    json_filename=simdir+'/filtering_length.json'
-    kF_data = {'simdir':simdir, 'kF_Mpc':kF_Mpc, 'kmax_kF_Mpc':kmax_Mpc}
-    kF_data['kF_zs']=zs.tolist()
+    return results
 
-    json_file = open(json_filename,"w")
-    json.dump(kF_data,json_file)
-    json_file.close()
 
-    return
+def fit_filtering_length(simdir, kmax_Mpc=None,verbose=False,run_genpk=False,
+                genpk_full_path='/home/dc-font1/Codes/GenPK_Keir/gen-pk',
+                write_json=True,show_plots=False,store_plots=False,
+                n_gauss_newton=5,n_genpk_workers=4):
+    """For each snapshot fit filtering length from measured "flux real" power"""
 
+    fit_filtering_length_suite([simdir],kmax_Mpc=kmax_Mpc,verbose=verbose,
+                run_genpk=run_genpk,genpk_full_path=genpk_full_path,
+                write_json=write_json,show_plots=show_plots,
+                store_plots=store_plots,n_gauss_newton=n_gauss_newton,
+                n_genpk_workers=n_genpk_workers)
+
+    return
@@ -1,4 +1,6 @@
 import os
+import time
+import subprocess
 import numpy as np
 
 def flux_real_genpk_filename(simdir, snap_num):
@@ -7,28 +9,125 @@ def flux_real_genpk_filename(simdir, snap_num):
     return genpkdir+'/PK-by-PART_'+snap_tag
 
 
-def compute_flux_real_power(simdir, snap_num,verbose=False,
-                genpk_full_path='/home/chrisp/Codes/GenPK_Keir/gen-pk'):
-    """Measure power spectrum of exp(-tau_noRSD), using GenPk"""
+def get_genpk_command(simdir, snap_num, genpk_full_path):
+    """List of arguments to run GenPk on a snapshot"""
 
-    # will store measured "flux real" power here
     genpkdir=simdir+'/genpk/'
-    os.makedirs(genpkdir,exist_ok=True)
+    snap_tag=str(snap_num).rjust(3,'0')
+    snap_dir=os.path.join(simdir,'output',"PART_"+snap_tag)
+    return [genpk_full_path,'-i',snap_dir,'-o',genpkdir]
 
-    # snapshot outputs are here
-    outdir=simdir+'/output/'
 
-    snap_tag=str(snap_num).rjust(3,'0')
+def validate_genpk_output(simdir, snap_num):
+    """Check that GenPk output for a snapshot exists, and that it can be
+        parsed as a table of (at least) k and P(k) with finite values"""
+
     genpk_filename=flux_real_genpk_filename(simdir,snap_num)
-    if os.path.exists(genpk_filename):
-        if verbose: print('GenPk was alreay run')
-    else:
-        snap_dir=os.path.join(outdir,"PART_"+snap_tag)
-        info_file=genpkdir+'/info_genpk_'+snap_tag
-        cmd=genpk_full_path+' -i '+snap_dir+' -o '+genpkdir
-        cmd+=' > '+info_file
-        if verbose: print('run genpk, cmd =',cmd)
-        os.system(cmd)
+    if not os.path.isfile(genpk_filename):
+        return False
+    try:
+        genpk_file=np.loadtxt(genpk_filename,ndmin=2)
+    except ValueError:
+        return False
 
-    return
+    if genpk_file.shape[0]==0 or genpk_file.shape[1]<2:
+        return False
+    return bool(np.all(np.isfinite(genpk_file)))
+
+
+def run_genpk(simdir, snap_num, genpk_full_path, timeout=None):
+    """Run GenPk on a snapshot (stdout goes to info file), and return a
+        dictionary with return code, stderr, run time and whether the
+        output is valid."""
+
+    genpkdir=simdir+'/genpk/'
+    os.makedirs(genpkdir,exist_ok=True)
+    snap_tag=str(snap_num).rjust(3,'0')
+    info_file=genpkdir+'/info_genpk_'+snap_tag
+    cmd=get_genpk_command(simdir,snap_num,genpk_full_path)
+
+    result={'simdir':simdir,'snap_num':snap_num}
+    t0=time.time()
+    try:
+        with open(info_file,'w') as info:
+            process=subprocess.run(cmd,stdout=info,stderr=subprocess.PIPE,
+                        text=True,timeout=timeout)
+        result['returncode']=process.returncode
+        result['stderr']=process.stderr
+    except subprocess.TimeoutExpired:
+        result['returncode']=None
+        result['stderr']='timeout after {} s'.format(timeout)
+    except OSError as error:
+        result['returncode']=None
+        result['stderr']=str(error)
+    result['time']=time.time()-t0
+    result['valid']=(result['returncode']==0
+                and validate_genpk_output(simdir,snap_num))
 
+    return result
+
+
+def run_genpk_tasks(tasks, genpk_full_path, n_workers=4, max_retries=1,
+                timeout=None, verbose=False):
+    """Run GenPk for a list of (simdir,snap_num) tasks, with at most
+        n_workers GenPk processes at once. Snapshots with valid output are
+        skipped, and failed runs (non-zero return code, or missing / broken
+        output) are retried up to max_retries times.
+        Returns a list with the result of the last attempt of each task
+        that was run (see run_genpk), and the list of failed tasks."""
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    todo=[]
+    for simdir,snap_num in tasks:
+        if validate_genpk_output(simdir,snap_num):
+            if verbose: print('GenPk was already run',simdir,snap_num)
+        else:
+            todo.append((simdir,snap_num))
+
+    results={}
+    for attempt in range(max_retries+1):
+        if len(todo)==0:
+            break
+        if verbose:
+            print(time.asctime(),'run GenPk for {} snapshots'.format(len(todo)),
+                    '(attempt {})'.format(attempt+1))
+        # threads only wait for the GenPk processes
+        with ThreadPoolExecutor(max_workers=max(1,n_workers)) as executor:
+            futures=[executor.submit(run_genpk,simdir,snap_num,
+                        genpk_full_path,timeout) for simdir,snap_num in todo]
+            for task,future in zip(todo,futures):
+                results[task]=future.result()
+
+        failed=[]
+        for task in todo:
+            result=results[task]
+            if result['valid']:
+                continue
+            if result['returncode']==0:
+                print('GenPk output for',task,'is missing or broken')
+            else:
+                print('GenPk failed for',task,', return code',
+                        result['returncode'],':',result['stderr'].strip())
+            # remove broken output, so that it is not used later
+            genpk_filename=flux_real_genpk_filename(*task)
+            if os.path.exists(genpk_filename):
+                os.remove(genpk_filename)
+            failed.append(task)
+        todo=failed
+
+    return list(results.values()), todo
+
+
+def compute_flux_real_power(simdir, snap_num,verbose=False,
+                genpk_full_path='/home/chrisp/Codes/GenPK_Keir/gen-pk',
+                max_retries=0):
+    """Measure power spectrum of exp(-tau_noRSD), using GenPk"""
+
+    results,failed=run_genpk_tasks([(simdir,snap_num)],genpk_full_path,
+                n_workers=1,max_retries=max_retries,verbose=verbose)
+    if failed:
+        raise RuntimeError('GenPk failed for snapshot {} in {}'.format(
+                snap_num,simdir))
+
+    return
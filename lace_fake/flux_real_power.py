@@ -0,0 +1,215 @@
+""" Measure the power spectrum of the real-space flux (exp(-tau) without
+redshift-space distortions) directly from the gas particles, as an
+alternative to the patched GenPk binary.
+
+EXPERIMENTAL: this engine has not been compared with GenPk outputs, and it
+is not used to fit the filtering length. The optical depth of particles is
+normalized to a fixed mean, the flux of each cell is mass-weighted and
+empty cells are set to the mean flux. Since the flux is a non-linear
+function of tau, these choices (that might differ from those in GenPk)
+change the shape of the flux power, not only its amplitude.
+
+Particles are assigned to a mesh (NGP, CIC or TSC), reading one snapshot
+file (segment) at a time so that memory is set by the mesh, and the power
+is corrected for the mass assignment window and binned in |k|. The output
+file has the same format as GenPk output (columns k in units of the
+fundamental mode, P(k) in units of the box volume, number of modes), but
+it is written in a different directory (see flux_real_power_filename). """
+
+import os
+import time
+import numpy as np
+# our modules
+from lace_fake import fft_backend
+
+# order of the mass assignment schemes
+ASSIGNMENT_ORDER={'ngp':1,'cic':2,'tsc':3}
+
+
+def get_assignment_weights(x,order):
+    """ Index of first cell, and weights of the order cells that a particle
+        at (grid units) x contributes to, along one axis. Cell i is centered
+        at x=i. """
+
+    if order==1:
+        first=np.floor(x+0.5).astype(np.int64)
+        return first,[np.ones_like(x)]
+    elif order==2:
+        first=np.floor(x).astype(np.int64)
+        d=x-first
+        return first,[1.0-d,d]
+    elif order==3:
+        # distance to center of the closest cell
+        closest=np.floor(x+0.5).astype(np.int64)
+        d=x-closest
+        return closest-1,[0.5*(0.5-d)**2,0.75-d**2,0.5*(0.5+d)**2]
+    raise ValueError('unknown assignment order '+str(order))
+
+
+def assign_to_mesh(meshes,pos,values,box,scheme='tsc'):
+    """ Add to each (n_mesh^3) mesh the particles at pos (in units of box)
+        weighted by the corresponding array in values, with periodic
+        boundary conditions """
+
+    order=ASSIGNMENT_ORDER[scheme]
+    n_mesh=meshes[0].shape[0]
+    x=np.asarray(pos,dtype=float)*(n_mesh/box)
+    first=[]
+    weights=[]
+    for axis in range(3):
+        axis_first,axis_weights=get_assignment_weights(x[:,axis],order)
+        first.append(axis_first)
+        weights.append(axis_weights)
+
+    # cells and weights of all particles, for the order^3 neighbours
+    shift=np.arange(order)[:,np.newaxis]
+    ix,iy,iz=[(axis_first+shift)%n_mesh for axis_first in first]
+    wx,wy,wz=[np.array(axis_weights) for axis_weights in weights]
+    index=((ix[:,None,None]*n_mesh+iy[None,:,None])*n_mesh
+                +iz[None,None,:]).ravel()
+    w=(wx[:,None,None]*wy[None,:,None])*wz[None,None,:]
+
+    # a single bincount per mesh (much faster than np.add.at)
+    for mesh,value in zip(meshes,values):
+        mesh+=np.bincount(index,weights=(w*value).ravel(),
+                    minlength=n_mesh**3).reshape(mesh.shape)
+
+
+def get_window_correction(n_mesh,scheme='tsc'):
+    """ Square of the assignment window for each mode of rfftn(mesh) """
+
+    order=ASSIGNMENT_ORDER[scheme]
+    k=np.fft.fftfreq(n_mesh)
+    kz=np.fft.rfftfreq(n_mesh)
+    # np.sinc(x) = sin(pi x) / (pi x)
+    wx=np.sinc(k)**(2*order)
+    wz=np.sinc(kz)**(2*order)
+    return wx[:,None,None]*wx[None,:,None]*wz[None,None,:]
+
+
+def measure_mesh_power(delta,scheme='tsc',fft_backend_name=None,
+            fft_workers=None):
+    """ Power spectrum of the contrast field delta (in units of the box
+        volume), corrected for the assignment window and averaged in bins
+        of |k| of width one fundamental mode, up to the Nyquist frequency.
+        Returns k (in units of fundamental mode), P(k) and number of modes."""
+
+    n_mesh=delta.shape[0]
+    delta_k=fft_backend.rfftn(delta,backend=fft_backend_name,
+                workers=fft_workers)
+    power=np.abs(delta_k)**2/float(n_mesh)**6
+    power/=get_window_correction(n_mesh,scheme)
+
+    # integer wavenumbers, and number of times each mode appears
+    k=np.fft.fftfreq(n_mesh,d=1.0/n_mesh)
+    kz=np.fft.rfftfreq(n_mesh,d=1.0/n_mesh)
+    k_mod=np.sqrt(k[:,None,None]**2+k[None,:,None]**2+kz[None,None,:]**2)
+    n_modes=np.full(kz.shape,2.0)
+    n_modes[0]=1.0
+    if n_mesh%2==0:
+        n_modes[-1]=1.0
+    n_modes=np.broadcast_to(n_modes,k_mod.shape)
+
+    k_bin=np.rint(k_mod).astype(np.int64).ravel()
+    n_bins=n_mesh//2+1
+    mask=k_bin<n_bins
+    counts=np.bincount(k_bin[mask],weights=n_modes.ravel()[mask],
+                minlength=n_bins)
+    sum_k=np.bincount(k_bin[mask],weights=(n_modes*k_mod).ravel()[mask],
+                minlength=n_bins)
+    sum_power=np.bincount(k_bin[mask],weights=(n_modes*power).ravel()[mask],
+                minlength=n_bins)
+
+    # skip k=0, and empty bins
+    use=counts>0
+    use[0]=False
+    return sum_k[use]/counts[use], sum_power[use]/counts[use], counts[use]
+
+
+def read_hi_density(snap,segment):
+    """ Neutral hydrogen density of gas particles in a segment (arbitrary
+        units), used to compute their optical depth """
+
+    density=snap.get_data(0,"Density",segment=segment)
+    fraction=snap.get_data(0,"NeutralHydrogenFraction",segment=segment)
+    return density*fraction
+
+
+def flux_real_power_filename(simdir,snap_num):
+    """ Output of compute_flux_real_power, kept apart from GenPk output """
+
+    snap_tag=str(snap_num).rjust(3,'0')
+    return simdir+'/flux_real_power/PK-by-PART_'+snap_tag
+
+
+def compute_flux_real_power(simdir,snap_num,n_mesh=256,scheme='tsc',
+            tau_scale=1.0,max_particles=2**19,fft_backend_name=None,
+            fft_workers=None,verbose=False):
+    """ EXPERIMENTAL (not compared with GenPk, see module docstring).
+        Measure power of the real-space flux in a snapshot, and write it
+        to flux_real_power_filename. The optical depth of each particle is
+        proportional to its neutral hydrogen density, normalized so that the
+        mean over particles is tau_scale. The flux in each cell is the
+        mass-weighted mean over the particles assigned to it.
+        Particles are read one segment at a time, and assigned in batches
+        of at most max_particles."""
+
+    # import here, to keep the import of this module light
+    import fake_spectra.abstractsnapshot as absn
+
+    if scheme not in ASSIGNMENT_ORDER:
+        raise ValueError('unknown assignment scheme '+scheme)
+
+    outdir=simdir+'/output/'
+    snap=absn.AbstractSnapshotFactory(snap_num,outdir,Tscale=1.0,
+                gammascale=1.0)
+    box=snap.get_header_attr("BoxSize")
+    n_segments=snap.get_n_segments()
+
+    # first pass: mean neutral hydrogen density, to normalize optical depth
+    sum_hi=0.0
+    n_part=0
+    for segment in range(n_segments):
+        hi_density=read_hi_density(snap,segment)
+        sum_hi+=np.sum(hi_density,dtype=np.float64)
+        n_part+=len(hi_density)
+    if n_part==0:
+        raise ValueError('no gas particles in snapshot {}'.format(snap_num))
+    tau_norm=tau_scale*n_part/sum_hi
+
+    # second pass: assign mass and mass-weighted flux to mesh
+    mass_mesh=np.zeros((n_mesh,n_mesh,n_mesh))
+    flux_mesh=np.zeros((n_mesh,n_mesh,n_mesh))
+    t0=time.time()
+    for segment in range(n_segments):
+        pos=snap.get_data(0,"Position",segment=segment)
+        mass=snap.get_data(0,"Mass",segment=segment)
+        flux=np.exp(-tau_norm*read_hi_density(snap,segment))
+        for i0 in range(0,len(pos),max_particles):
+            i1=i0+max_particles
+            assign_to_mesh([mass_mesh,flux_mesh],pos[i0:i1],
+                        [mass[i0:i1],mass[i0:i1]*flux[i0:i1]],box,scheme)
+    if verbose:
+        print(time.asctime(),'assigned {} particles to mesh in {:.1f} s'.format(
+                    n_part,time.time()-t0))
+
+    # flux in each cell, with empty cells set to the mean flux
+    filled=mass_mesh>0
+    mean_flux=np.sum(flux_mesh)/np.sum(mass_mesh)
+    flux_mesh[filled]/=mass_mesh[filled]
+    flux_mesh[~filled]=mean_flux
+    del mass_mesh
+    delta=flux_mesh/np.mean(flux_mesh)-1.0
+    del flux_mesh
+
+    k,power,counts=measure_mesh_power(delta,scheme=scheme,
+                fft_backend_name=fft_backend_name,fft_workers=fft_workers)
+
+    power_filename=flux_real_power_filename(simdir,snap_num)
+    os.makedirs(os.path.dirname(power_filename),exist_ok=True)
+    np.savetxt(power_filename,np.array([k,power,counts]).T)
+    if verbose:
+        print('mean flux {:.4f}, power written to {}'.format(mean_flux,
+                    power_filename))
+
+    return power_filename
@@ -1,9 +1,11 @@
-import matplotlib.pyplot as plt
 import numpy as np
-import scipy.stats as spt
 import sys
 import os
 import time
+# our modules
+from lace_fake import p3d_binning
+from lace_fake import fft_backend
+from lace_fake import skewers_reader
 
 def get_transmitted_flux_fraction(skewers,scale_tau):
     """ Read optical depth from skewers object, and rescale it with scale_tau"""
@@ -12,14 +14,16 @@ def get_transmitted_flux_fraction(skewers,scale_tau):
     return np.exp(-scale_tau*tau)
 
 
-def measure_p1d_Mpc(field,L_Mpc):
-    """ Compute 1D power spectrum for input array, using L_Mpc to normalize. """
+def measure_p1d_Mpc(field,L_Mpc,fft_backend_name=None,fft_workers=None):
+    """ Compute 1D power spectrum for input array, using L_Mpc to normalize.
+        FFT backend and number of threads are set as in fft_backend. """
 
     # get dimensions of input array
     (nspec, npix) = np.shape(field)
 
     # get 1D Fourier modes for each skewer
-    fourier = np.fft.rfft(field, axis=1)
+    fourier = fft_backend.rfft(field, axis=1, backend=fft_backend_name,
+                workers=fft_workers)
 
     # compute amplitude of Fourier modes
     power_skewer = np.abs(fourier)**2
@@ -32,119 +36,344 @@ def measure_p1d_Mpc(field,L_Mpc):
     # white noise power should be P=sigma^2*dx
     p1d_Mpc = mean_power * L_Mpc / npix**2
 
+    # get wavenumbers in 1/Mpc
+    k_Mpc = get_p1d_k_Mpc(npix,L_Mpc)
+
+    return k_Mpc, p1d_Mpc
+
+
+def get_p1d_k_Mpc(npix,L_Mpc):
+    """ Wavenumbers (in 1/Mpc) of the 1D power for skewers with npix pixels"""
+
     # get frequencies from numpy.fft
     k = np.fft.rfftfreq(npix)
 
     # normalize using box size (first wavenumber should be 2 pi / L_Mpc)
-    k_Mpc = k * (2.0*np.pi) * npix / L_Mpc
+    return k * (2.0*np.pi) * npix / L_Mpc
+
+
+def get_p1d_chunk_size(npix,n_scales=1,max_chunk_MB=256.0):
+    """ Number of skewers to process at once, so that the temporary arrays
+        used for n_scales tau rescalings stay below max_chunk_MB"""
+
+    # flux (float64) and its Fourier modes (complex128) per skewer and scaling
+    bytes_per_skewer = n_scales * npix * (8 + 16)
+    return max(1,int(max_chunk_MB*1024**2/bytes_per_skewer))
+
+
+def get_jackknife_weights(nspec,n_jk_side=4):
+    """ Assign each skewer to one of n_jk_side^2 spatial regions of the grid
+        of skewers. Returns (n_regions,nspec) array with 1 if the skewer is
+        in the region, and 0 otherwise."""
+
+    n_xy=int(np.sqrt(nspec))
+    ispec=np.arange(nspec)
+    if n_xy**2 == nspec:
+        # square patches in the (x,y) grid of skewers
+        ix, iy = np.divmod(ispec,n_xy)
+        region=(ix*n_jk_side//n_xy)*n_jk_side + iy*n_jk_side//n_xy
+    else:
+        # consecutive blocks of skewers
+        region=ispec*n_jk_side**2//nspec
+    n_regions=n_jk_side**2
+
+    return (region==np.arange(n_regions)[:,np.newaxis]).astype(np.uint8)
+
+
+def get_bootstrap_weights(nspec,n_boot=100,seed=0):
+    """ Poisson bootstrap weights for each skewer, (n_boot,nspec) array """
+
+    rng=np.random.default_rng(seed)
+    weights=rng.poisson(1.0,size=(n_boot,nspec))
+    return np.minimum(weights,np.iinfo(np.uint8).max).astype(np.uint8)
+
+
+def get_group_weights(nspec,cov_method,n_jk_side=4,n_boot=100,seed=0):
+    """ Weights of each skewer in the subgroups used to compute covariance
+        (cov_method should be 'jackknife' or 'bootstrap') """
+
+    if cov_method=='jackknife':
+        return get_jackknife_weights(nspec,n_jk_side=n_jk_side)
+    elif cov_method=='bootstrap':
+        return get_bootstrap_weights(nspec,n_boot=n_boot,seed=seed)
+    else:
+        raise ValueError('unknown covariance method '+cov_method)
+
+
+def accumulate_flux_power(tau,scales_tau,chunk_size=None,
+            fft_backend_name=None,fft_workers=None,group_weights=None):
+    """ Loop over chunks of skewers and accumulate, for each tau rescaling,
+        the total transmitted flux and the sum over skewers of |rfft(F)|^2.
+        tau can be any array-like object that supports slicing of skewers.
+        If group_weights (n_groups,nspec) is provided, accumulate also
+        weighted sums for each subgroup of skewers.
+        Returns sum_F, sum_power and group_sums (None if no weights)."""
+
+    scales_tau=np.atleast_1d(np.asarray(scales_tau,dtype=float))
+    n_scales=len(scales_tau)
+    (nspec, npix) = tau.shape
+    if chunk_size is None:
+        chunk_size=get_p1d_chunk_size(npix,n_scales)
+
+    sum_F=np.zeros(n_scales)
+    sum_power=np.zeros((n_scales,npix//2+1))
+    if group_weights is not None:
+        n_groups=group_weights.shape[0]
+        group_sums={'sum_F':np.zeros((n_groups,n_scales)),
+                'sum_power':np.zeros((n_groups,n_scales,npix//2+1)),
+                'n_skewers':np.sum(group_weights,axis=1,dtype=float)}
+    else:
+        group_sums=None
+
+    for i0 in range(0,nspec,chunk_size):
+        tau_chunk=np.asarray(tau[i0:i0+chunk_size])
+        # flux for all tau rescalings at once, shape (n_scales,chunk,npix)
+        F=np.exp(-scales_tau[:,np.newaxis,np.newaxis]*tau_chunk)
+        F_skewer=np.sum(F,axis=2)
+        sum_F+=np.sum(F_skewer,axis=1)
+        fourier=fft_backend.rfft(F,axis=2,backend=fft_backend_name,
+                    workers=fft_workers)
+        del F
+        power=fourier.real**2+fourier.imag**2
+        del fourier
+        sum_power+=np.sum(power,axis=1)
+        if group_sums is not None:
+            accumulate_group_power(group_sums,
+                    group_weights[:,i0:i0+chunk_size],F_skewer,power)
+
+    return sum_F, sum_power, group_sums
+
+
+def accumulate_group_power(group_sums,weights,F_skewer,power):
+    """ Add weighted sums of flux and power of a chunk of skewers to the sums
+        of each subgroup. weights has shape (n_groups,chunk), F_skewer has
+        shape (n_scales,chunk) and power (n_scales,chunk,nk)."""
+
+    weights=weights.astype(float)
+    group_sums['sum_F']+=np.dot(weights,F_skewer.T)
+    group_sums['sum_power']+=np.tensordot(weights,power,axes=([1],[1]))
+
+
+def normalize_flux_power(sum_F,sum_power,nspec,npix,L_Mpc):
+    """ Convert sums from accumulate_flux_power into mean flux and 1D power
+        of delta_F = F/mF - 1, for each tau rescaling. """
+
+    mF = sum_F / (nspec*npix)
+    # power of delta_F equals power of F/mF, except for the k=0 mode
+    mean_power = sum_power / mF[:,np.newaxis]**2
+    mean_power[:,0] -= nspec*npix**2
+    mean_power /= nspec
+
+    # normalize power spectrum using cosmology convention
+    p1d_Mpc = mean_power * L_Mpc / npix**2
+
+    return p1d_Mpc, mF
+
+
+def get_p1d_covariance(sum_F,sum_power,group_sums,nspec,npix,L_Mpc,
+            cov_method):
+    """ Covariance of P1D for each tau rescaling, from the sums accumulated
+        for subgroups of skewers (jackknife regions or bootstrap weights).
+        Each subsample uses its own mean flux to compute delta_F.
+        Returns array with shape (n_scales,nk,nk)."""
+
+    n_groups=len(group_sums['n_skewers'])
+    p1d_groups=[]
+    for ig in range(n_groups):
+        if cov_method=='jackknife':
+            # leave one region out
+            g_sum_F=sum_F-group_sums['sum_F'][ig]
+            g_sum_power=sum_power-group_sums['sum_power'][ig]
+            g_nspec=nspec-group_sums['n_skewers'][ig]
+        else:
+            g_sum_F=group_sums['sum_F'][ig]
+            g_sum_power=group_sums['sum_power'][ig]
+            g_nspec=group_sums['n_skewers'][ig]
+        p1d_groups.append(normalize_flux_power(g_sum_F,g_sum_power,
+                    g_nspec,npix,L_Mpc)[0])
+    p1d_groups=np.array(p1d_groups)
+
+    diff=p1d_groups-np.mean(p1d_groups,axis=0)
+    cov=np.einsum('gak,gaq->akq',diff,diff)
+    if cov_method=='jackknife':
+        cov*=(n_groups-1)/n_groups
+    else:
+        cov/=(n_groups-1)
+
+    return cov
+
+
+def measure_tau_p1d_Mpc_batch(tau,scales_tau,L_Mpc,chunk_size=None,
+            fft_backend_name=None,fft_workers=None,cov_method=None,
+            n_jk_side=4,n_boot=100,seed=0):
+    """ Measure 1D power spectrum of delta_F for a list of tau rescalings,
+        for an array-like optical depth that can be sliced in skewers
+        (e.g., an HDF5 dataset, that will be read in chunks).
+        Returns k_Mpc, and arrays with p1d_Mpc and mF for each rescaling.
+        If cov_method is 'jackknife' (n_jk_side^2 regions) or 'bootstrap'
+        (n_boot realizations), returns also the covariance of p1d_Mpc for
+        each rescaling, computed in the same pass."""
+
+    (nspec, npix) = np.shape(tau)
+
+    if cov_method:
+        group_weights=get_group_weights(nspec,cov_method,n_jk_side=n_jk_side,
+                    n_boot=n_boot,seed=seed)
+    else:
+        group_weights=None
+
+    sum_F, sum_power, group_sums = accumulate_flux_power(tau,scales_tau,
+                chunk_size=chunk_size,fft_backend_name=fft_backend_name,
+                fft_workers=fft_workers,group_weights=group_weights)
+    p1d_Mpc, mF = normalize_flux_power(sum_F,sum_power,nspec,npix,L_Mpc)
+    k_Mpc = get_p1d_k_Mpc(npix,L_Mpc)
+
+    if cov_method:
+        p1d_cov = get_p1d_covariance(sum_F,sum_power,group_sums,nspec,npix,
+                    L_Mpc,cov_method)
+        return k_Mpc, p1d_Mpc, mF, p1d_cov
+
+    return k_Mpc, p1d_Mpc, mF
+
+
+def measure_F_p1d_Mpc_batch(skewers,scales_tau,L_Mpc,chunk_size=None,
+            fft_backend_name=None,fft_workers=None,cov_method=None,
+            n_jk_side=4,n_boot=100,seed=0):
+    """ Measure 1D power spectrum of delta_F for a list of tau rescalings,
+        reading the optical depth only once (in chunks, for SkewersReader).
+        Returns k_Mpc, and arrays with p1d_Mpc and mF for each rescaling
+        (and P1D covariance if cov_method is set, as in
+        measure_tau_p1d_Mpc_batch)."""
+
+    tau = skewers_reader.get_tau_array(skewers)
+
+    return measure_tau_p1d_Mpc_batch(tau,scales_tau,L_Mpc,
+                chunk_size=chunk_size,fft_backend_name=fft_backend_name,
+                fft_workers=fft_workers,cov_method=cov_method,
+                n_jk_side=n_jk_side,n_boot=n_boot,seed=seed)
+
+
+def measure_F_p1d_Mpc_batch_from_file(sk_filename,scales_tau,L_Mpc,
+            chunk_size=None,fft_backend_name=None,fft_workers=None,
+            cov_method=None,n_jk_side=4,n_boot=100,seed=0):
+    """ Measure 1D power spectrum of delta_F for a list of tau rescalings,
+        streaming chunks of skewers from the HDF5 file with the skewers.
+        Peak memory is set by chunk_size (number of skewers per chunk).
+        Returns k_Mpc, and arrays with p1d_Mpc and mF for each rescaling
+        (and P1D covariance if cov_method is set, as in
+        measure_tau_p1d_Mpc_batch)."""
+
+    with skewers_reader.SkewersReader(sk_filename) as skewers:
+        return measure_tau_p1d_Mpc_batch(skewers.tau,scales_tau,L_Mpc,
+                    chunk_size=chunk_size,fft_backend_name=fft_backend_name,
+                    fft_workers=fft_workers,cov_method=cov_method,
+                    n_jk_side=n_jk_side,n_boot=n_boot,seed=seed)
 
-    return k_Mpc, p1d_Mpc
 
+def measure_F_p1d_Mpc_from_file(sk_filename,scale_tau,L_Mpc,chunk_size=None,
+            fft_backend_name=None,fft_workers=None):
+    """ Measure 1D power spectrum of delta_F, after rescaling optical depth,
+        streaming chunks of skewers from the HDF5 file with the skewers."""
 
-def measure_F_p1d_Mpc(skewers,scale_tau,L_Mpc):
+    k_Mpc, p1d_Mpc, mF = measure_F_p1d_Mpc_batch_from_file(sk_filename,
+                [scale_tau],L_Mpc,chunk_size=chunk_size,
+                fft_backend_name=fft_backend_name,fft_workers=fft_workers)
+
+    return k_Mpc, p1d_Mpc[0], mF[0]
+
+
+def measure_F_p1d_Mpc(skewers,scale_tau,L_Mpc,
+            fft_backend_name=None,fft_workers=None):
     """ Measure 1D power spectrum of delta_F, after rescaling optical depth. """
 
-    # obtain transmitted flux fraction, after rescaling
-    F = get_transmitted_flux_fraction(skewers,scale_tau)
-    mF = np.mean(F)
-    delta_F = F / mF - 1.0
+    k_Mpc, p1d_Mpc, mF = measure_F_p1d_Mpc_batch(skewers,[scale_tau],L_Mpc,
+                fft_backend_name=fft_backend_name,fft_workers=fft_workers)
 
-    # compute power spectrum of delta_F, in units of Mpc
-    k_Mpc, p1d_Mpc = measure_p1d_Mpc(delta_F, L_Mpc)
+    return k_Mpc, p1d_Mpc[0], mF[0]
 
-    return k_Mpc, p1d_Mpc, mF
 
+def get_flux_moments(tau,scales_tau,chunk_size=None):
+    """ Mean flux <F> and <tau F> for each tau rescaling, where F=exp(-s tau).
+        tau can be any array-like object that supports slicing of skewers."""
 
-def get_box_geometry(grid,L_Mpc):
-    """ Figure out description of the 3D box for input grid of skewers. """
+    scales_tau=np.atleast_1d(np.asarray(scales_tau,dtype=float))
+    n_scales=len(scales_tau)
+    (nspec, npix) = tau.shape
+    if chunk_size is None:
+        chunk_size=get_p1d_chunk_size(npix,n_scales)
 
-    # get box geometry
-    n_xyz=grid.shape
-    n_xy=int(np.sqrt(n_xyz[0]))
-    n_z=n_xyz[1]
-    print('n_xy={}, n_z={}'.format(n_xy,n_z))
-    d_xy = L_Mpc / n_xy
-    d_z = L_Mpc / n_z
-
-    # collect results to return
-    results={'n_xy':n_xy,'n_z':n_z,'d_xy':d_xy,'d_z':d_z}
-
-    # specify wavenumbers in box
-    k_xy = np.fft.fftfreq(n_xy, d=d_xy) * 2. * np.pi
-    k_z = np.fft.fftfreq(n_z, d=d_z) * 2. * np.pi
-    # construct 3D grid of wavenumbers
-    box_kx = k_xy[:,np.newaxis,np.newaxis]
-    box_ky = k_xy[np.newaxis,:,np.newaxis]
-    box_kz = k_z[np.newaxis,np.newaxis,:]
-    box_k = np.sqrt(box_kx**2 + box_ky**2 + box_kz**2)
-    # construct mu in two steps, without NaN warnings
-    box_mu = box_kz/np.ones_like(box_k)
-    box_mu[box_k>0.] /= box_k[box_k>0.]
-    box_mu[box_k == 0.] = np.nan
-
-    results['box_k']=box_k
-    results['box_mu']=box_mu
+    sum_F=np.zeros(n_scales)
+    sum_tau_F=np.zeros(n_scales)
+    for i0 in range(0,nspec,chunk_size):
+        tau_chunk=np.asarray(tau[i0:i0+chunk_size])
+        F=np.exp(-scales_tau[:,np.newaxis,np.newaxis]*tau_chunk)
+        sum_F+=np.sum(F,axis=(1,2))
+        sum_tau_F+=np.sum(F*tau_chunk,axis=(1,2))
 
-    return results
-    
+    return sum_F/(nspec*npix), sum_tau_F/(nspec*npix)
 
-def measure_p3d_Mpc(skewers,scale_tau,L_Mpc,
-            n_k_bins=20,k_Mpc_max=20.0,n_mu_bins=16):
-    """ Compute 3D power spectrum of input grid of skewers. """
 
-    # obtain transmitted flux fraction, after rescaling
-    F = get_transmitted_flux_fraction(skewers,scale_tau=scale_tau)
-    mF = np.mean(F)
-    delta_F = F / mF - 1.0
+def find_scales_tau(tau,target_mF,tol=1e-8,max_iter=50,chunk_size=None,
+            verbose=False):
+    """ Find the tau rescalings that give the target mean flux values,
+        solving for all targets at once with a vectorized Newton iteration.
+        Mean flux is a convex, decreasing function of the scaling, and the
+        starting point -log(target)/<tau> is below the solution (Jensen
+        inequality), so the iteration converges monotonically."""
 
-    # get information about the box geometry
-    box = get_box_geometry(delta_F,L_Mpc)
-    print(time.asctime(),'got box geometry')
+    target_mF=np.atleast_1d(np.asarray(target_mF,dtype=float))
+    if np.any(target_mF <= 0.0) or np.any(target_mF >= 1.0):
+        raise ValueError('target mean flux should be between 0 and 1')
 
-    # collect relevant information 
-    results={'z':skewers.red,'mean_flux':mF,
-                'n_xy':box['n_xy'],'n_z':box['n_z'],
-                'd_xy':box['d_xy'],'d_z':box['d_z'],
-                'n_k_bins':n_k_bins,'k_Mpc_max':k_Mpc_max,'n_mu_bins':n_mu_bins}
+    # mean optical depth, to setup starting point
+    mean_tau=get_flux_moments(tau,[0.0],chunk_size=chunk_size)[1][0]
+    scales_tau=-np.log(target_mF)/mean_tau
 
-    # get Fourier modes
-    norm_fac = 1.0 / delta_F.size
-    modes = np.fft.fftn(delta_F) * norm_fac
-    print(time.asctime(),'got Fourier modes')
+    for it in range(max_iter):
+        mF,mtauF=get_flux_moments(tau,scales_tau,chunk_size=chunk_size)
+        diff=mF-target_mF
+        if verbose:
+            print(it,'scales_tau =',scales_tau,'; mF - target =',diff)
+        if np.all(np.abs(diff) < tol):
+            return scales_tau
+        # d<F>/ds = -<tau F>
+        scales_tau=scales_tau+diff/mtauF
 
-    # get raw power
-    raw_p3d = (np.abs(modes) ** 2)
-
-    # change format and get rid of first mode (k=0)
-    k_box = box['box_k'].flatten()[1:]
-    mu_box = np.absolute(box['box_mu']).flatten()[1:]
-    p3d_box = raw_p3d.flatten()[1:]
-
-    # define k-binning (in 1/Mpc)
-    lnk_max = np.log(k_Mpc_max)
-    # set minimum k to make sure we cover fundamental mode
-    lnk_min = np.log(0.9999*np.min(k_box[k_box > 0.]))
-    lnk_bin_max = lnk_max + (lnk_max-lnk_min)/(n_k_bins-1)
-    lnk_bin_edges = np.linspace(lnk_min,lnk_bin_max,n_k_bins+1)
-    k_bin_edges = np.exp(lnk_bin_edges)
-    # define mu-binning
-    mu_bin_edges = np.linspace(0., 1., n_mu_bins + 1)
-
-    # compute bin averages (not including first mode with k=0, mu=0)
-    binned_p3d = spt.binned_statistic_2d(k_box, mu_box, p3d_box,
-                statistic = 'mean', bins = [k_bin_edges,mu_bin_edges])[0]
-    print(time.asctime(),'got binned power')
-    binned_counts = spt.binned_statistic_2d(k_box,mu_box,p3d_box,
-            statistic='count', bins=[k_bin_edges,mu_bin_edges])[0]
-    print(time.asctime(),'got bin counts')
-    # compute binned values for (k,mu)
-    binned_k = spt.binned_statistic_2d(k_box, mu_box, k_box,
-            statistic = 'mean', bins = [k_bin_edges,mu_bin_edges])[0]
-    print(time.asctime(),'got binned k')
-    binned_mu = spt.binned_statistic_2d(k_box, mu_box, mu_box,
-                    statistic = 'mean', bins = [k_bin_edges,mu_bin_edges])[0]
-    print(time.asctime(),'got binned mu')
+    raise ValueError('find_scales_tau did not converge, diff = '+str(diff))
+
+
+def find_scales_tau_from_file(sk_filename,target_mF,tol=1e-8,max_iter=50,
+            chunk_size=None,verbose=False):
+    """ Find the tau rescalings that give the target mean flux values,
+        streaming chunks of skewers from the HDF5 file with the skewers."""
+
+    with skewers_reader.SkewersReader(sk_filename) as skewers:
+        return find_scales_tau(skewers.tau,target_mF,tol=tol,
+                    max_iter=max_iter,chunk_size=chunk_size,verbose=verbose)
 
+
+def estimate_p3d_memory_MB(nspec,npix):
+    """ Rough estimate of the peak memory (in MB) used by measure_p3d_Mpc
+        for a grid of nspec skewers with npix pixels each. """
+
+    # optical depth, delta_F, rfftn modes, raw power and binning temporaries
+    bytes_per_pixel = 8 + 8 + 8 + 4 + 8
+    return nspec * npix * bytes_per_pixel / 1024**2
+
+
+def get_p3d_results(box,sum_p3d,z,mF,L_Mpc):
+    """ Collect binned P3D (from power summed in bins of box geometry) in a
+        dictionary that can be written to a JSON file """
+
+    binned_p3d, binned_counts, binned_k, binned_mu = box.get_binned_results(
+                sum_p3d)
+
+    # collect relevant information 
+    results={'z':z,'mean_flux':mF,
+                'n_xy':box.n_xy,'n_z':box.n_z,
+                'd_xy':box.d_xy,'d_z':box.d_z,
+                'n_k_bins':box.n_k_bins,'k_Mpc_max':box.k_Mpc_max,
+                'n_mu_bins':box.n_mu_bins}
     # convert to list so that we can use json dump
     results['k_Mpc'] = binned_k.tolist()
     results['mu'] = binned_mu.tolist()
@@ -155,9 +384,329 @@ def measure_p3d_Mpc(skewers,scale_tau,L_Mpc,
     return results
 
 
+def measure_p3d_Mpc(skewers,scale_tau,L_Mpc,
+            n_k_bins=20,k_Mpc_max=20.0,n_mu_bins=16,max_memory_MB=None,
+            fft_backend_name=None,fft_workers=None,verbose=False):
+    """ Compute 3D power spectrum of input grid of skewers.
+        If the grid would not fit in max_memory_MB, read the skewers file
+        in slabs using measure_p3d_Mpc_out_of_core instead. """
+
+    if max_memory_MB is not None:
+        nspec, npix = get_tau_shape(skewers.savefile)
+        if estimate_p3d_memory_MB(nspec,npix) > max_memory_MB:
+            if verbose:
+                print('use out-of-core P3D, memory budget =',max_memory_MB)
+            return measure_p3d_Mpc_out_of_core(skewers.savefile,scale_tau,
+                        L_Mpc,n_k_bins=n_k_bins,k_Mpc_max=k_Mpc_max,
+                        n_mu_bins=n_mu_bins,max_memory_MB=max_memory_MB,
+                        fft_backend_name=fft_backend_name,
+                        fft_workers=fft_workers)
+
+    # obtain transmitted flux fraction, after rescaling
+    delta_F = get_transmitted_flux_fraction(skewers,scale_tau=scale_tau)
+    mF = np.mean(delta_F)
+    # compute delta_F = F / mF - 1 in place, to save memory
+    delta_F /= mF
+    delta_F -= 1.0
+
+    # get information about the box geometry (cached for repeated calls)
+    (nspec, n_z) = delta_F.shape
+    n_xy = int(np.sqrt(nspec))
+    print('n_xy={}, n_z={}'.format(n_xy,n_z))
+    box = p3d_binning.get_p3d_geometry(n_xy,n_z,L_Mpc,n_k_bins=n_k_bins,
+                k_Mpc_max=k_Mpc_max,n_mu_bins=n_mu_bins)
+    print(time.asctime(),'got box geometry')
+
+    # get Fourier modes in half of Fourier space, from the 3D grid of skewers
+    norm_fac = 1.0 / delta_F.size
+    modes = fft_backend.rfftn(delta_F.reshape(n_xy,n_xy,n_z),
+                backend=fft_backend_name,workers=fft_workers)
+    print(time.asctime(),'got Fourier modes')
+
+    # get raw power
+    raw_p3d = (modes.real**2 + modes.imag**2) * norm_fac**2
+    del modes
+
+    # compute bin averages (k=0 mode is below the first bin, and is ignored)
+    sum_p3d = box.bin_power(raw_p3d)
+    print(time.asctime(),'got binned power')
+
+    return get_p3d_results(box,sum_p3d,skewers.red,mF,L_Mpc)
+
+
+def get_tau_shape(sk_filename):
+    """ Shape (nspec, npix) of the optical depth stored in a skewers file """
+
+    with skewers_reader.SkewersReader(sk_filename) as skewers:
+        return skewers.shape
+
+
+def measure_p3d_Mpc_out_of_core(sk_filename,scale_tau,L_Mpc,
+            n_k_bins=20,k_Mpc_max=20.0,n_mu_bins=16,max_memory_MB=1024.0,
+            tmp_dir=None,fft_backend_name=None,fft_workers=None):
+    """ Compute 3D power spectrum for a grid of skewers stored in an HDF5
+        file, without loading the full grid in memory (see
+        measure_p3d_Mpc_out_of_core_batch). """
+
+    return measure_p3d_Mpc_out_of_core_batch(sk_filename,[scale_tau],L_Mpc,
+                n_k_bins=n_k_bins,k_Mpc_max=k_Mpc_max,n_mu_bins=n_mu_bins,
+                max_memory_MB=max_memory_MB,tmp_dir=tmp_dir,
+                fft_backend_name=fft_backend_name,fft_workers=fft_workers)[0]
+
+
+def measure_p3d_Mpc_out_of_core_batch(sk_filename,scales_tau,L_Mpc,
+            n_k_bins=20,k_Mpc_max=20.0,n_mu_bins=16,max_memory_MB=1024.0,
+            tmp_dir=None,fft_backend_name=None,fft_workers=None):
+    """ Compute 3D power spectrum for a grid of skewers stored in an HDF5
+        file, for a list of tau rescalings, without loading the full grid
+        in memory.
+        A first pass reads slabs of skewers (along x), rescales tau, and
+        Fourier transforms along the line of sight and along y. The modes
+        are stored in a memory-mapped file (one per rescaling), transposed
+        to (k_z,x,y), so that a second pass can read slabs of k_z planes,
+        transform along x and accumulate binned power. Since the k=0 mode
+        is ignored, the power of delta_F is that of F/mF, and the mean flux
+        is only needed at the end. The optical depth is read only once for
+        all rescalings, and peak memory is set by max_memory_MB (not by the
+        grid size). Returns a list with the P3D results of each rescaling."""
+
+    import tempfile
+
+    n_scales = len(scales_tau)
+    with skewers_reader.SkewersReader(sk_filename) as skewers:
+        z = skewers.red
+        tau = skewers.tau
+        (nspec, n_z) = tau.shape
+        n_xy = int(np.sqrt(nspec))
+        assert n_xy**2 == nspec, 'skewers do not form a square grid'
+        n_kz = n_z//2+1
+
+        # memory-mapped Fourier modes, transposed to (k_z,x,y)
+        tmp_files = []
+        modes = []
+        for itau in range(n_scales):
+            tmp_files.append(tempfile.NamedTemporaryFile(suffix='.dat',
+                        dir=tmp_dir))
+            modes.append(np.memmap(tmp_files[itau],dtype=np.complex128,
+                        mode='w+',shape=(n_kz,n_xy,n_xy)))
+
+        # first pass: slabs of x planes, transform along z and along y
+        bytes_per_x_plane = n_xy * n_z * (8 + 8 + 16 + 16)
+        n_x_slab = max(1,int(max_memory_MB*1024**2/bytes_per_x_plane))
+        sum_F = np.zeros(n_scales)
+        for ix0 in range(0,n_xy,n_x_slab):
+            ix1 = min(n_xy,ix0+n_x_slab)
+            tau_slab = np.asarray(tau[ix0*n_xy:ix1*n_xy],dtype=np.float64)
+            for itau,scale_tau in enumerate(scales_tau):
+                F = np.exp(-scale_tau*tau_slab)
+                sum_F[itau] += np.sum(F)
+                slab = fft_backend.rfft(F.reshape(ix1-ix0,n_xy,n_z),axis=2,
+                            backend=fft_backend_name,workers=fft_workers)
+                del F
+                slab = fft_backend.fft(slab,axis=1,backend=fft_backend_name,
+                            workers=fft_workers)
+                modes[itau][:,ix0:ix1,:] = slab.transpose(2,0,1)
+                del slab
+            del tau_slab
+        for itau in range(n_scales):
+            modes[itau].flush()
+        print(time.asctime(),'got Fourier modes along y and z')
+
+    mF = sum_F / (nspec*n_z)
+
+    # geometry without storing the bin index of the full box
+    box = p3d_binning.P3DGeometry(n_xy,n_z,L_Mpc,n_k_bins=n_k_bins,
+                k_Mpc_max=k_Mpc_max,n_mu_bins=n_mu_bins,store_index=False)
+
+    # second pass: slabs of k_z planes, transform along x and bin power
+    bytes_per_z_plane = n_xy * n_xy * (16 + 16 + 8 + 8 + 8 + 8 + 4)
+    n_z_slab = max(1,int(max_memory_MB*1024**2/bytes_per_z_plane))
+    results = []
+    for itau in range(n_scales):
+        norm_fac = 1.0 / (nspec*n_z*mF[itau])
+        sum_p3d = np.zeros(box.n_bins)
+        for iz0 in range(0,n_kz,n_z_slab):
+            iz1 = min(n_kz,iz0+n_z_slab)
+            slab = fft_backend.fft(modes[itau][iz0:iz1],axis=1,
+                        backend=fft_backend_name,workers=fft_workers)
+            # back to (x,y,k_z) order, as used in the box geometry
+            raw_p3d = ((slab.real**2 + slab.imag**2).transpose(1,2,0)
+                        * norm_fac**2)
+            del slab
+            bin_index = box.get_bin_index(z_slice=slice(iz0,iz1))
+            sum_p3d += box.bin_power(raw_p3d,bin_index=bin_index,
+                        weights_z=box.weights_z[iz0:iz1])
+        results.append(get_p3d_results(box,sum_p3d,z,mF[itau],L_Mpc))
+    del modes
+    for tmp_file in tmp_files:
+        tmp_file.close()
+    print(time.asctime(),'got binned power')
+
+    return results
+
+
+def measure_tau_p1d_p3d_Mpc(tau,scale_tau,z,L_Mpc,n_k_bins=20,
+            k_Mpc_max=20.0,n_mu_bins=16,fft_backend_name=None,
+            fft_workers=None,group_weights=None,cov_method=None):
+    """ Measure 1D and 3D power spectra of delta_F for an optical depth
+        array (in memory) at redshift z, after rescaling it, computing the
+        flux and the line-of-sight FFT only once.
+        Returns k_Mpc, p1d_Mpc, mF, the dictionary with P3D results and the
+        P1D covariance (None if group_weights is not set). """
+
+    # obtain transmitted flux fraction, after rescaling
+    F = np.exp(-scale_tau*tau)
+    (nspec, n_z) = F.shape
+    F_skewer = np.sum(F,axis=1)
+    sum_F = np.sum(F_skewer)
+
+    # Fourier transform along the line of sight
+    modes = fft_backend.rfft(F,axis=1,backend=fft_backend_name,
+                workers=fft_workers)
+    del F
+    print(time.asctime(),'got line-of-sight Fourier modes')
+
+    # P1D from line-of-sight modes (power of delta_F, as in P1D functions)
+    power_skewer = modes.real**2 + modes.imag**2
+    sum_power = np.sum(power_skewer,axis=0)
+    p1d_Mpc, mF = normalize_flux_power(np.array([sum_F]),
+                sum_power[np.newaxis,:],nspec,n_z,L_Mpc)
+    k_Mpc = get_p1d_k_Mpc(n_z,L_Mpc)
+
+    # P1D covariance from subgroups of skewers, if needed
+    p1d_cov = None
+    if group_weights is not None:
+        n_groups = group_weights.shape[0]
+        group_sums = {'sum_F':np.zeros((n_groups,1)),
+                    'sum_power':np.zeros((n_groups,1,n_z//2+1)),
+                    'n_skewers':np.sum(group_weights,axis=1,dtype=float)}
+        accumulate_group_power(group_sums,group_weights,
+                    F_skewer[np.newaxis,:],power_skewer[np.newaxis,:,:])
+        p1d_cov = get_p1d_covariance(np.array([sum_F]),sum_power[np.newaxis,:],
+                    group_sums,nspec,n_z,L_Mpc,cov_method)[0]
+    del power_skewer
+    p1d_Mpc = p1d_Mpc[0]
+    mF = mF[0]
+
+    # get information about the box geometry (cached for repeated calls)
+    n_xy = int(np.sqrt(nspec))
+    print('n_xy={}, n_z={}'.format(n_xy,n_z))
+    box = p3d_binning.get_p3d_geometry(n_xy,n_z,L_Mpc,n_k_bins=n_k_bins,
+                k_Mpc_max=k_Mpc_max,n_mu_bins=n_mu_bins)
+
+    # continue with transverse transforms, to get the rfftn of F
+    modes = modes.reshape(n_xy,n_xy,n_z//2+1)
+    modes = fft_backend.fft(modes,axis=1,backend=fft_backend_name,
+                workers=fft_workers)
+    modes = fft_backend.fft(modes,axis=0,backend=fft_backend_name,
+                workers=fft_workers)
+    print(time.asctime(),'got Fourier modes')
+
+    # power of F/mF equals power of delta_F, except for the k=0 mode
+    norm_fac = 1.0 / (nspec*n_z*mF)
+    raw_p3d = (modes.real**2 + modes.imag**2) * norm_fac**2
+    del modes
+
+    # compute bin averages (k=0 mode is below the first bin, and is ignored)
+    sum_p3d = box.bin_power(raw_p3d)
+    print(time.asctime(),'got binned power')
+
+    p3d_results = get_p3d_results(box,sum_p3d,z,mF,L_Mpc)
+
+    return k_Mpc, p1d_Mpc, mF, p3d_results, p1d_cov
+
+
+def measure_F_p1d_p3d_Mpc_batch(skewers,scales_tau,L_Mpc,
+            n_k_bins=20,k_Mpc_max=20.0,n_mu_bins=16,max_memory_MB=None,
+            fft_backend_name=None,fft_workers=None,cov_method=None,
+            n_jk_side=4,n_boot=100,seed=0,verbose=False):
+    """ Measure 1D and 3D power spectra of delta_F for a list of tau
+        rescalings, reading the optical depth only once.
+        If the grid fits in max_memory_MB, tau is read in memory and, for
+        each rescaling, P1D is obtained from the line-of-sight modes, that
+        are then transformed along the transverse directions to get P3D.
+        Otherwise P1D is measured streaming the skewers file once for all
+        rescalings, and P3D with measure_p3d_Mpc_out_of_core_batch.
+        Returns k_Mpc, and lists with p1d_Mpc, mF and the dictionary with
+        P3D results for each rescaling (and P1D covariances if cov_method
+        is set, as in measure_tau_p1d_Mpc_batch)."""
+
+    if max_memory_MB is not None:
+        nspec, npix = get_tau_shape(skewers.savefile)
+        if estimate_p3d_memory_MB(nspec,npix) > max_memory_MB:
+            if verbose:
+                print('use out-of-core P3D, memory budget =',max_memory_MB)
+            p1d_results = measure_F_p1d_Mpc_batch_from_file(
+                        skewers.savefile,scales_tau,L_Mpc,
+                        fft_backend_name=fft_backend_name,
+                        fft_workers=fft_workers,cov_method=cov_method,
+                        n_jk_side=n_jk_side,n_boot=n_boot,seed=seed)
+            p3d_results = measure_p3d_Mpc_out_of_core_batch(skewers.savefile,
+                        scales_tau,L_Mpc,n_k_bins=n_k_bins,
+                        k_Mpc_max=k_Mpc_max,n_mu_bins=n_mu_bins,
+                        max_memory_MB=max_memory_MB,
+                        fft_backend_name=fft_backend_name,
+                        fft_workers=fft_workers)
+            k_Mpc, p1d_Mpc, mF = p1d_results[:3]
+            if cov_method:
+                return (k_Mpc, list(p1d_Mpc), list(mF), p3d_results,
+                            list(p1d_results[3]))
+            return k_Mpc, list(p1d_Mpc), list(mF), p3d_results
+
+    # read optical depth only once, for all rescalings
+    tau = np.asarray(skewers_reader.get_tau_array(skewers),dtype=np.float64)
+    if cov_method:
+        group_weights = get_group_weights(tau.shape[0],cov_method,
+                    n_jk_side=n_jk_side,n_boot=n_boot,seed=seed)
+    else:
+        group_weights = None
+
+    p1d_Mpc = []
+    mF = []
+    p3d_results = []
+    p1d_cov = []
+    for scale_tau in scales_tau:
+        results = measure_tau_p1d_p3d_Mpc(tau,scale_tau,skewers.red,L_Mpc,
+                    n_k_bins=n_k_bins,k_Mpc_max=k_Mpc_max,n_mu_bins=n_mu_bins,
+                    fft_backend_name=fft_backend_name,fft_workers=fft_workers,
+                    group_weights=group_weights,cov_method=cov_method)
+        k_Mpc = results[0]
+        p1d_Mpc.append(results[1])
+        mF.append(results[2])
+        p3d_results.append(results[3])
+        p1d_cov.append(results[4])
+
+    if cov_method:
+        return k_Mpc, p1d_Mpc, mF, p3d_results, p1d_cov
+    return k_Mpc, p1d_Mpc, mF, p3d_results
+
+
+def measure_F_p1d_p3d_Mpc(skewers,scale_tau,L_Mpc,
+            n_k_bins=20,k_Mpc_max=20.0,n_mu_bins=16,max_memory_MB=None,
+            fft_backend_name=None,fft_workers=None,cov_method=None,
+            n_jk_side=4,n_boot=100,seed=0,verbose=False):
+    """ Measure 1D and 3D power spectra of delta_F, after rescaling optical
+        depth, computing the flux and the line-of-sight FFT only once (see
+        measure_F_p1d_p3d_Mpc_batch).
+        Returns k_Mpc, p1d_Mpc, mF and the dictionary with P3D results
+        (and P1D covariance if cov_method is set, as in
+        measure_tau_p1d_Mpc_batch)."""
+
+    results = measure_F_p1d_p3d_Mpc_batch(skewers,[scale_tau],L_Mpc,
+                n_k_bins=n_k_bins,k_Mpc_max=k_Mpc_max,n_mu_bins=n_mu_bins,
+                max_memory_MB=max_memory_MB,fft_backend_name=fft_backend_name,
+                fft_workers=fft_workers,cov_method=cov_method,
+                n_jk_side=n_jk_side,n_boot=n_boot,seed=seed,verbose=verbose)
+
+    return (results[0],)+tuple(result[0] for result in results[1:])
+
+
 def plot_p3d(results,downsample_mu=3,savefig=None):
     """ Make simple plot for measured P3D, for a few mu bins. """
 
+    # import here, only needed when plotting
+    import matplotlib.pyplot as plt
+
     p3d_Mpc=np.array(results['p3d_Mpc'])
     k_Mpc=np.array(results['k_Mpc'])
     mu=np.array(results['mu'])
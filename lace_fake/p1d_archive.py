@@ -0,0 +1,268 @@
+""" Store P1D measurements (from SnapshotAdmin) in binary HDF5 archives.
+
+Each snapshot (one p1d_*.json file) is stored in a group of the archive,
+with all its measurements (temperature models and tau scalings) as columns:
+ - k_Mpc (nk): wavenumbers, shared by all measurements in the snapshot
+ - p1d_Mpc (n,nk), and p1d_cov_Mpc (n,nk,nk) if measured
+ - mF, scale_tau, sim_T0, sim_gamma, ... (n): one value per measurement,
+   with NaN when not available (e.g., kF_Mpc or target_mF)
+ - sk_file (n): skewers file used in each measurement
+ - sk_fingerprint, measure_settings (n): size and time of the skewers file,
+   and settings of the measurement (JSON strings)
+ - p3d/ (optional): binned P3D, with arrays of shape (n,n_k_bins,n_mu_bins)
+Snapshot metadata is stored as attributes of the group (with the list of
+target mean flux values in target_mF_list). An archive can contain a single
+simulation (written snapshot by snapshot by SnapshotAdmin) or a full suite
+(with group names such as sim_pair_0/sim_plus/p1d_5_Ns500_wM0.05_axis1). """
+
+import numpy as np
+import json
+import os
+import contextlib
+
+# one value per measurement, stored as float columns
+P1D_COLUMNS=['mF','scale_tau','target_mF','sim_T0','sim_gamma',
+            'sim_sigT_Mpc','sim_scale_T0','sim_scale_gamma','kF_Mpc']
+# dictionaries with one value per measurement, stored as JSON strings
+JSON_COLUMNS=['sk_fingerprint','measure_settings']
+# binned P3D arrays, with shape (n_k_bins,n_mu_bins) for each measurement
+P3D_ARRAYS=['p3d_Mpc','k_Mpc','mu','counts']
+# scalar metadata of the snapshot, stored as group attributes
+SNAPSHOT_ATTRS=['snap_num','z','n_skewers','width_Mpc','axis']
+
+def get_archive_label(p1d_info,p1d_label='p1d'):
+    """ Default group name for a snapshot, as the name of its JSON file """
+
+    data=p1d_info['snapshot_data']
+    label=p1d_label+'_'+str(data['snap_num'])+'_Ns'+str(data['n_skewers'])
+    label+='_wM'+str(int(1000*data['width_Mpc'])/1000)
+    label+='_axis'+str(int(data.get('axis',1)))
+    return label
+
+
+def get_sim_archive_filename(post_dir,p1d_label='p1d'):
+    """ Archive with all snapshots of a simulation """
+
+    return post_dir+'/'+p1d_label+'_archive.hdf5'
+
+
+@contextlib.contextmanager
+def lock_archive(filename):
+    """ Exclusive lock of an archive (using a lock file next to it), so that
+        processes adding different snapshots do not write it at once """
+
+    import fcntl
+
+    with open(filename+'.lock','w') as lock_file:
+        fcntl.flock(lock_file,fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file,fcntl.LOCK_UN)
+
+
+def write_p1d_group(group,p1d_info,add_p3d=True):
+    """ Write P1D measurements of a snapshot (dictionary as in the
+        p1d_*.json files) in an HDF5 group """
+
+    import h5py
+
+    p1d_data=p1d_info['p1d_data']
+    k_Mpc=np.array(p1d_data[0]['k_Mpc'])
+    for info in p1d_data:
+        if np.shape(info['k_Mpc'])!=k_Mpc.shape:
+            raise ValueError('all P1D in a snapshot should use the same k')
+        if not np.allclose(info['k_Mpc'],k_Mpc):
+            raise ValueError('all P1D in a snapshot should use the same k')
+
+    # metadata of the snapshot
+    data=p1d_info['snapshot_data']
+    for key in SNAPSHOT_ATTRS:
+        if data.get(key) is not None:
+            group.attrs[key]=data[key]
+    group.attrs['snapshot_data']=json.dumps(data)
+    group.attrs['scales_tau']=json.dumps(p1d_info.get('scales_tau'))
+    if p1d_info.get('target_mF'):
+        group.attrs['target_mF_list']=p1d_info['target_mF']
+    if 'cov_method' in p1d_data[0]:
+        group.attrs['cov_method']=p1d_data[0]['cov_method']
+
+    # typed columns, one row per measurement
+    group.create_dataset('k_Mpc',data=k_Mpc)
+    group.create_dataset('p1d_Mpc',
+                data=np.array([info['p1d_Mpc'] for info in p1d_data]))
+    for key in P1D_COLUMNS:
+        values=[info.get(key) for info in p1d_data]
+        values=np.array([np.nan if val is None else val for val in values],
+                    dtype=float)
+        group.create_dataset(key,data=values)
+    group.create_dataset('sk_file',data=[info['sk_file'] for info in p1d_data],
+                dtype=h5py.string_dtype())
+    for key in JSON_COLUMNS:
+        if key in p1d_data[0]:
+            group.create_dataset(key,data=[json.dumps(info[key])
+                        for info in p1d_data],dtype=h5py.string_dtype())
+    if 'p1d_cov_Mpc' in p1d_data[0]:
+        group.create_dataset('p1d_cov_Mpc',
+                    data=np.array([info['p1d_cov_Mpc'] for info in p1d_data]))
+
+    # binned P3D, if measured
+    if add_p3d and 'p3d_data' in p1d_data[0]:
+        p3d_group=group.create_group('p3d')
+        p3d_0=p1d_data[0]['p3d_data']
+        for key in ['n_xy','n_z','d_xy','d_z','n_k_bins','k_Mpc_max',
+                    'n_mu_bins']:
+            p3d_group.attrs[key]=p3d_0[key]
+        for key in P3D_ARRAYS:
+            # JSON stores NaN of empty bins as None (or NaN)
+            values=[info['p3d_data'][key] for info in p1d_data]
+            p3d_group.create_dataset(key,
+                        data=np.array(values,dtype=float))
+        p3d_group.create_dataset('z',
+                    data=[info['p3d_data']['z'] for info in p1d_data])
+
+
+def read_p1d_group(group):
+    """ Read P1D measurements of a snapshot from an HDF5 group.
+        Returns a dictionary with arrays and snapshot metadata. """
+
+    archive={key:group[key][()] for key in ['k_Mpc','p1d_Mpc']+P1D_COLUMNS}
+    archive['sk_file']=group['sk_file'].asstr()[()]
+    for key in JSON_COLUMNS:
+        if key in group:
+            archive[key]=[json.loads(value) for value in group[key].asstr()[()]]
+    if 'p1d_cov_Mpc' in group:
+        archive['p1d_cov_Mpc']=group['p1d_cov_Mpc'][()]
+    for key,value in group.attrs.items():
+        # older archives used target_mF for the list of targets
+        if key in archive:
+            continue
+        if key in ['snapshot_data','scales_tau']:
+            archive[key]=json.loads(value)
+        else:
+            archive[key]=value
+    if 'p3d' in group:
+        p3d_group=group['p3d']
+        archive['p3d']={key:p3d_group[key][()] for key in p3d_group}
+        archive['p3d'].update(p3d_group.attrs)
+
+    return archive
+
+
+def write_p1d_archive(filename,p1d_infos,labels=None,add_p3d=True,mode='w'):
+    """ Write P1D measurements of several snapshots in an HDF5 archive.
+        p1d_infos is a list of dictionaries (as in p1d_*.json files), and
+        labels their group names (by default, names of the JSON files).
+        Use mode='a' to add snapshots to an existing archive (the archive
+        is locked while writing, see lock_archive). """
+
+    import h5py
+
+    if labels is None:
+        labels=[get_archive_label(p1d_info) for p1d_info in p1d_infos]
+    assert len(labels)==len(p1d_infos),'wrong number of labels'
+
+    with lock_archive(filename):
+        with h5py.File(filename,mode) as f:
+            for label,p1d_info in zip(labels,p1d_infos):
+                if label in f:
+                    del f[label]
+                write_p1d_group(f.create_group(label),p1d_info,
+                            add_p3d=add_p3d)
+
+
+def read_p1d_archive(filename,labels=None):
+    """ Read P1D measurements from an HDF5 archive.
+        Returns a dictionary with the measurements of each snapshot (see
+        read_p1d_group), with group names as keys. """
+
+    import h5py
+
+    archive={}
+    with h5py.File(filename,'r') as f:
+        if labels is None:
+            # find all groups with P1D measurements (possibly nested)
+            labels=[]
+            f.visititems(lambda name,obj: labels.append(name)
+                    if isinstance(obj,h5py.Group) and 'p1d_Mpc' in obj
+                    else None)
+        for label in labels:
+            archive[label]=read_p1d_group(f[label])
+
+    return archive
+
+
+def get_p1d_data(archive):
+    """ List of P1D measurements of a snapshot (read with read_p1d_group),
+        in the format of p1d_data in the p1d_*.json files """
+
+    p1d_data=[]
+    for i in range(len(archive['mF'])):
+        info={'k_Mpc':archive['k_Mpc'].tolist(),
+                'p1d_Mpc':archive['p1d_Mpc'][i].tolist()}
+        for key in P1D_COLUMNS:
+            if not np.isnan(archive[key][i]):
+                info[key]=float(archive[key][i])
+        info['sk_file']=archive['sk_file'][i]
+        for key in JSON_COLUMNS:
+            if key in archive:
+                info[key]=archive[key][i]
+        if 'p1d_cov_Mpc' in archive:
+            info['p1d_cov_Mpc']=archive['p1d_cov_Mpc'][i].tolist()
+            info['cov_method']=archive['cov_method']
+        p1d_data.append(info)
+
+    return p1d_data
+
+
+def read_suite_p1d_archive(basedir,p1d_label='p1d',
+            sims=['sim_plus','sim_minus']):
+    """ Read the archives of all simulations in a Latin hypercube suite
+        (written by SnapshotAdmin.write_p1d_archive). Returns a dictionary
+        as read_p1d_archive, with keys such as
+        sim_pair_0/sim_plus/p1d_5_Ns500_wM0.05_axis1. """
+
+    cube_json=basedir+'/latin_hypercube.json'
+    if not os.path.isfile(cube_json):
+        raise ValueError('could not find hypercube '+cube_json)
+    with open(cube_json) as json_data:
+        cube_data=json.load(json_data)
+
+    archive={}
+    for sample in range(cube_data['nsamples']):
+        for sim in sims:
+            sim_label='sim_pair_{}/{}'.format(sample,sim)
+            filename=get_sim_archive_filename(basedir+'/'+sim_label,
+                        p1d_label)
+            if not os.path.isfile(filename):
+                print('no P1D archive in',sim_label)
+                continue
+            for label,snap_archive in read_p1d_archive(filename).items():
+                archive[sim_label+'/'+label]=snap_archive
+
+    return archive
+
+
+def convert_p1d_json(json_files,archive_filename,labels=None,add_p3d=True,
+            base_dir=None):
+    """ Convert p1d_*.json files into a single HDF5 archive.
+        By default, groups are named after the JSON files (relative to
+        base_dir, if provided, to keep simulations apart in a suite). """
+
+    import h5py
+
+    if labels is None:
+        labels=[]
+        for json_file in json_files:
+            if base_dir:
+                label=os.path.relpath(json_file,base_dir)
+            else:
+                label=os.path.basename(json_file)
+            labels.append(os.path.splitext(label)[0])
+
+    # read one JSON file at a time, to keep memory low for large suites
+    with h5py.File(archive_filename,'w') as f:
+        for label,json_file in zip(labels,json_files):
+            with open(json_file) as json_data:
+                p1d_info=json.load(json_data)
+            write_p1d_group(f.create_group(label),p1d_info,add_p3d=add_p3d)
@@ -0,0 +1,233 @@
+""" Bin Fourier modes of a 3D box in (k,mu), computing bin indices once. """
+
+import numpy as np
+from collections import OrderedDict
+
+# maximum memory (in MB) used by cached box geometries, see get_p3d_geometry
+MAX_GEOMETRY_CACHE_MB=2048.0
+_geometry_cache=OrderedDict()
+
+def get_k_bin_edges(k_min,k_Mpc_max,n_k_bins):
+    """ Logarithmic k-bins (in 1/Mpc), making sure we cover k_min """
+
+    lnk_max = np.log(k_Mpc_max)
+    # set minimum k to make sure we cover fundamental mode
+    lnk_min = np.log(0.9999*k_min)
+    lnk_bin_max = lnk_max + (lnk_max-lnk_min)/(n_k_bins-1)
+    lnk_bin_edges = np.linspace(lnk_min,lnk_bin_max,n_k_bins+1)
+    return np.exp(lnk_bin_edges)
+
+
+def get_mu_bin_edges(n_mu_bins):
+    """ Linear bins in mu, between 0 and 1 """
+
+    return np.linspace(0., 1., n_mu_bins + 1)
+
+
+def digitize(x,bin_edges):
+    """ Index of the bin containing each value in x, or -1 if outside.
+        Bins are [left,right), except the last one that includes its right
+        edge, as in scipy.stats.binned_statistic_2d."""
+
+    n_bins=len(bin_edges)-1
+    index=np.searchsorted(bin_edges,x,side='right')-1
+    index[x==bin_edges[-1]]=n_bins-1
+    index[(index<0) | (index>=n_bins)]=-1
+    return index
+
+
+def get_bin_index(k,mu,k_bin_edges,mu_bin_edges):
+    """ Flat index of the (k,mu) bin of each mode. Modes outside the binning
+        (or with NaN values) are assigned to an extra bin, n_k_bins*n_mu_bins,
+        that is dropped after accumulating."""
+
+    n_k_bins=len(k_bin_edges)-1
+    n_mu_bins=len(mu_bin_edges)-1
+    n_bins=n_k_bins*n_mu_bins
+
+    # use the smallest integer type that can store all bins
+    dtype=np.int16 if n_bins < np.iinfo(np.int16).max else np.int32
+
+    ik=digitize(k,k_bin_edges)
+    imu=digitize(mu,mu_bin_edges)
+    index=ik*n_mu_bins+imu
+    index[(ik<0) | (imu<0)]=n_bins
+
+    return index.astype(dtype)
+
+
+def accumulate_bins(index,n_bins,values=None,weights=None):
+    """ Sum of values (times weights) in each bin, dropping the extra bin.
+        If values is None, count the (weighted) number of modes instead."""
+
+    # weights can be broadcast, e.g., to weight planes of a 3D box
+    if weights is not None:
+        weights=np.broadcast_to(weights,np.shape(index))
+    if values is None:
+        values=weights
+    elif weights is not None:
+        values=values*weights
+    index=np.ravel(index)
+    if values is not None:
+        values=np.ravel(values)
+    sums=np.bincount(index,weights=values,minlength=n_bins+1)
+    return sums[:n_bins].astype(float)
+
+
+class P3DGeometry(object):
+    """Compact description of the (k,mu) binning of the non-redundant half
+        of Fourier space (k_z >= 0) of a box of skewers, as used by rfftn.
+        Each mode is stored as a small integer bin index, and the averages
+        of k and mu in each bin (that only depend on geometry) are computed
+        once when setting up the object."""
+
+    def __init__(self,n_xy,n_z,L_Mpc,n_k_bins=20,k_Mpc_max=20.0,n_mu_bins=16,
+                store_index=True):
+        """Setup geometry of a box with n_xy x n_xy skewers of n_z pixels.
+            If store_index is False, the bin index is not kept in memory and
+            needs to be computed for each slab with get_bin_index."""
+
+        self.n_xy=n_xy
+        self.n_z=n_z
+        self.L_Mpc=L_Mpc
+        self.d_xy=L_Mpc/n_xy
+        self.d_z=L_Mpc/n_z
+        self.n_k_bins=n_k_bins
+        self.k_Mpc_max=k_Mpc_max
+        self.n_mu_bins=n_mu_bins
+        self.n_bins=n_k_bins*n_mu_bins
+
+        # wavenumbers in box (only k_z >= 0 along line of sight)
+        self.k_xy=np.fft.fftfreq(n_xy,d=self.d_xy)*2.*np.pi
+        self.k_z=np.fft.rfftfreq(n_z,d=self.d_z)*2.*np.pi
+
+        # planes k_z=0 and k_z=Nyquist (for even n_z) are not duplicated
+        self.weights_z=2.0*np.ones_like(self.k_z)
+        self.weights_z[0]=1.0
+        if n_z % 2 == 0:
+            self.weights_z[-1]=1.0
+
+        # smallest non-zero wavenumber in the box
+        k_min=min(np.min(np.abs(self.k_xy[self.k_xy != 0.]),initial=np.inf),
+                    np.min(self.k_z[self.k_z > 0.],initial=np.inf))
+        self.k_bin_edges=get_k_bin_edges(k_min,k_Mpc_max,n_k_bins)
+        self.mu_bin_edges=get_mu_bin_edges(n_mu_bins)
+
+        # compact bin index for each mode, and binned values of k and mu
+        if store_index:
+            self.bin_index=self.get_bin_index()
+        else:
+            self.bin_index=None
+        self.counts=np.zeros(self.n_bins)
+        sum_k=np.zeros(self.n_bins)
+        sum_mu=np.zeros(self.n_bins)
+        for ix in range(n_xy):
+            if store_index:
+                index=self.bin_index[ix]
+            else:
+                index=self.get_bin_index(slice(ix,ix+1))[0]
+            k,mu=self.get_k_mu(slice(ix,ix+1))
+            self.counts+=accumulate_bins(index,self.n_bins,
+                        weights=self.weights_z)
+            sum_k+=accumulate_bins(index,self.n_bins,k[0],self.weights_z)
+            sum_mu+=accumulate_bins(index,self.n_bins,mu[0],self.weights_z)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            self.binned_k=sum_k/self.counts
+            self.binned_mu=sum_mu/self.counts
+
+
+    def get_k_mu(self,x_slice=slice(None),z_slice=slice(None)):
+        """Wavenumber and mu for a slab of modes (k=0 mode has mu=NaN)"""
+
+        box_kx=self.k_xy[x_slice,np.newaxis,np.newaxis]
+        box_ky=self.k_xy[np.newaxis,:,np.newaxis]
+        box_kz=self.k_z[np.newaxis,np.newaxis,z_slice]
+        box_k=np.sqrt(box_kx**2+box_ky**2+box_kz**2)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            box_mu=box_kz/box_k
+
+        return box_k,box_mu
+
+
+    def get_bin_index(self,x_slice=slice(None),z_slice=slice(None)):
+        """Compact (k,mu) bin index for a slab of modes, computed one
+            k_x plane at a time to avoid large temporary arrays"""
+
+        x_range=range(self.n_xy)[x_slice]
+        n_z_modes=len(range(len(self.k_z))[z_slice])
+        index=np.empty((len(x_range),self.n_xy,n_z_modes),
+                    dtype=np.int16 if self.n_bins < np.iinfo(np.int16).max
+                    else np.int32)
+        for i,ix in enumerate(x_range):
+            k,mu=self.get_k_mu(slice(ix,ix+1),z_slice)
+            index[i]=get_bin_index(k[0],mu[0],self.k_bin_edges,
+                        self.mu_bin_edges)
+
+        return index
+
+
+    def nbytes(self):
+        """Memory (in bytes) used by the geometry"""
+
+        if self.bin_index is None:
+            return 0
+        return self.bin_index.nbytes
+
+
+    def bin_power(self,raw_p3d,bin_index=None,weights_z=None):
+        """Sum power in (k,mu) bins, using the pre-computed bin index.
+            If provided, bin_index and weights_z describe a slab of modes."""
+
+        if bin_index is None:
+            bin_index=self.bin_index
+        if weights_z is None:
+            weights_z=self.weights_z
+
+        return accumulate_bins(bin_index,self.n_bins,raw_p3d,weights_z)
+
+
+    def get_binned_results(self,sum_power):
+        """Bin averages of power, k and mu, and mode counts, with shape
+            (n_k_bins,n_mu_bins) and NaN in empty bins"""
+
+        with np.errstate(invalid='ignore',divide='ignore'):
+            binned_p3d=sum_power/self.counts
+
+        shape=(self.n_k_bins,self.n_mu_bins)
+        return (binned_p3d.reshape(shape),self.counts.reshape(shape),
+                self.binned_k.reshape(shape),self.binned_mu.reshape(shape))
+
+
+def get_p3d_geometry(n_xy,n_z,L_Mpc,n_k_bins=20,k_Mpc_max=20.0,n_mu_bins=16,
+            max_cache_MB=None):
+    """Return P3DGeometry for this box and binning, reusing a cached one if
+        possible. Least recently used geometries are dropped from the cache
+        when the total memory exceeds max_cache_MB."""
+
+    if max_cache_MB is None:
+        max_cache_MB=MAX_GEOMETRY_CACHE_MB
+
+    key=(n_xy,n_z,float(L_Mpc),n_k_bins,float(k_Mpc_max),n_mu_bins)
+    if key in _geometry_cache:
+        _geometry_cache.move_to_end(key)
+        return _geometry_cache[key]
+
+    geometry=P3DGeometry(n_xy,n_z,L_Mpc,n_k_bins=n_k_bins,
+                k_Mpc_max=k_Mpc_max,n_mu_bins=n_mu_bins)
+    _geometry_cache[key]=geometry
+
+    # drop oldest geometries (but never the one we just computed)
+    max_bytes=max_cache_MB*1024**2
+    while len(_geometry_cache) > 1:
+        total_bytes=sum(geo.nbytes() for geo in _geometry_cache.values())
+        if total_bytes <= max_bytes:
+            break
+        _geometry_cache.popitem(last=False)
+
+    return geometry
+
+
+def clear_geometry_cache():
+    """Remove all cached box geometries"""
+
+    _geometry_cache.clear()
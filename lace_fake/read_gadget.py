@@ -1,8 +1,10 @@
 """Read MP-Gadget configuration file. File addapted from code by Simeon Bird."""
 
+import os
 import numpy as np
 import configobj
 import validate
+from collections import OrderedDict
 
 # define variables and default values in Gadget
 Gadget_configspec = """
@@ -16,6 +18,17 @@ Nmesh = integer(default=1)
     MNum = float(min=0, default=0)
     MNut = float(min=0, default=0)""".split('\n') 
 
+# define variables and default values in GenIC (box size only)
+GenIC_configspec = """
+BoxSize = float(min=0)
+HubbleParam = float(0,2)
+UnitLength_in_cm = float(default=3.085678e21)""".split('\n')
+
+# parsed configurations, keyed by (paramfile,mtime), most recent last
+_sim_config_cache=OrderedDict()
+# maximum number of configurations kept in memory
+MAX_SIM_CONFIGS=256
+
 def _check_gadget_config(config):
     """Check that the MP-Gadget config file is sensible."""
     vtor = validate.Validator()
@@ -44,8 +57,21 @@ def snapshot_redshifts(config):
 
 
 def redshifts_from_paramfile(paramfile, verbose=False):
-    config=read_gadget_paramfile(paramfile, verbose)
-    return snapshot_redshifts(config)
+    return get_simulation_config(paramfile, verbose).zs
+
+
+def L_Mpc_from_genic_paramfile(genic_file, verbose=False):
+    """Box size (in Mpc) from a GenIC parameter file"""
+
+    config = configobj.ConfigObj(infile=genic_file,configspec=GenIC_configspec,
+                    file_error=True)
+    config.validate(validate.Validator())
+    # box size in internal units (kpc/h by default)
+    L_hMpc = config['BoxSize']*config['UnitLength_in_cm']/3.085678e24
+    L_Mpc = L_hMpc/config['HubbleParam']
+    if verbose:
+        print('box size L = {:.3f} Mpc'.format(L_Mpc))
+    return L_Mpc
 
 
 def _build_cosmology_params_class(config):
@@ -111,19 +137,7 @@ def _build_cosmology_params_camb(config):
 def class_from_gadget(paramfile, verbose=False):
     """Parse a Gadget parameter file and returns a dictionary to setup CLASS"""
 
-    # read Gadget configuration file, and store information
-    config = configobj.ConfigObj(infile=paramfile,configspec=Gadget_configspec, 
-            file_error=True)
-    # check file is healthy
-    _check_gadget_config(config)
-    if verbose:
-        print('successfully read healthy configuration file')
-
-    # rename parameters to be used in CLASS
-    params = _build_cosmology_params_class(config)
-    if verbose:
-        print('translated parameters to CLASS format')
-
+    params = get_simulation_config(paramfile, verbose).class_params()
     if verbose:
         print('params',params)
 
@@ -133,21 +147,65 @@ def class_from_gadget(paramfile, verbose=False):
 def camb_from_gadget(paramfile, verbose=False):
     """Parse a Gadget parameter file and returns a dictionary to setup CAMB"""
 
-    # read Gadget configuration file, and store information
-    config = configobj.ConfigObj(infile=paramfile,configspec=Gadget_configspec, 
-            file_error=True)
-    # check file is healthy
-    _check_gadget_config(config)
-    if verbose:
-        print('successfully read healthy configuration file')
-
-    # rename parameters to be used in CAMB
-    params = _build_cosmology_params_camb(config)
-    if verbose:
-        print('translated parameters to CAMB format')
-
+    params = get_simulation_config(paramfile, verbose).camb_params()
     if verbose:
         print('params',params)
 
     return params
 
+
+class SimulationConfig(object):
+    """Information about a simulation read from its Gadget parameter file
+        (parsed only once), and from its GenIC parameter file (read the
+        first time the box size is needed)."""
+
+    def __init__(self, paramfile, genic_file=None, verbose=False):
+        self.paramfile = paramfile
+        # by default, GenIC file lives next to the Gadget file
+        if genic_file is None:
+            genic_file = os.path.join(os.path.dirname(paramfile),
+                    'paramfile.genic')
+        self.genic_file = genic_file
+        self.config = read_gadget_paramfile(paramfile, verbose)
+        self.zs = snapshot_redshifts(self.config)
+        self.n_snapshots = len(self.zs)
+        self._camb_params = None
+        self._class_params = None
+        self._L_Mpc = None
+
+    def camb_params(self):
+        """Dictionary to setup CAMB (a copy, can be modified)"""
+        if self._camb_params is None:
+            self._camb_params = _build_cosmology_params_camb(self.config)
+        return dict(self._camb_params)
+
+    def class_params(self):
+        """Dictionary to setup CLASS (a copy, can be modified)"""
+        if self._class_params is None:
+            self._class_params = _build_cosmology_params_class(self.config)
+        return dict(self._class_params)
+
+    @property
+    def L_Mpc(self):
+        """Box size in Mpc, from GenIC file"""
+        if self._L_Mpc is None:
+            self._L_Mpc = L_Mpc_from_genic_paramfile(self.genic_file)
+        return self._L_Mpc
+
+
+def get_simulation_config(paramfile, verbose=False):
+    """SimulationConfig for a Gadget parameter file, reused while the file
+        does not change. Only the MAX_SIM_CONFIGS most recently used
+        configurations are kept."""
+
+    key = (os.path.abspath(paramfile), os.path.getmtime(paramfile))
+    if key in _sim_config_cache:
+        _sim_config_cache.move_to_end(key)
+        return _sim_config_cache[key]
+
+    sim_config = SimulationConfig(paramfile, verbose=verbose)
+    _sim_config_cache[key] = sim_config
+    while len(_sim_config_cache) > MAX_SIM_CONFIGS:
+        _sim_config_cache.popitem(last=False)
+
+    return sim_config
@@ -0,0 +1,63 @@
+import argparse
+import subprocess
+import sys
+import json
+import numpy as np
+
+"""
+Measure the time needed to import lace_fake modules in a fresh Python
+process, as paid by every job in the cluster. Exits with an error if the
+(median) import time is above the budget, or if heavy modules (plotting,
+CAMB, fake_spectra...) are imported at module load.
+"""
+
+# modules that should only be imported when needed
+HEAVY_MODULES=['matplotlib','scipy.stats','scipy.optimize','camb',
+            'fake_spectra','lace','h5py','pyfftw']
+
+# code run in a fresh process, prints import time and heavy modules loaded
+IMPORT_CODE="""
+import sys, time, json
+t0=time.perf_counter()
+import {module}
+dt=time.perf_counter()-t0
+heavy=[name for name in {heavy} if name in sys.modules]
+print(json.dumps({{'time':dt,'heavy':heavy}}))
+"""
+
+# get options from command line
+parser = argparse.ArgumentParser()
+parser.add_argument('--modules', type=str, default='lace_fake.snapshot_admin',
+                help='Comma-separated list of modules to import',required=False)
+parser.add_argument('--max_seconds', type=float, default=0.5,
+                help='Budget for the (median) import time of each module',required=False)
+parser.add_argument('--n_runs', type=int, default=5,
+                help='Number of fresh processes used to time each import',required=False)
+args = parser.parse_args()
+
+failed=[]
+for module in args.modules.split(','):
+    code=IMPORT_CODE.format(module=module,heavy=HEAVY_MODULES)
+    times=[]
+    heavy=set()
+    for irun in range(args.n_runs):
+        output=subprocess.run([sys.executable,'-c',code],check=True,
+                    capture_output=True,text=True).stdout
+        # only the last line is ours, modules might print other things
+        result=json.loads(output.strip().split('\n')[-1])
+        times.append(result['time'])
+        heavy.update(result['heavy'])
+    median=np.median(times)
+    print('import {}: median {:.3f} s, min {:.3f} s, max {:.3f} s'.format(
+                module,median,min(times),max(times)))
+    if heavy:
+        print('heavy modules imported by',module,':',sorted(heavy))
+        failed.append(module)
+    elif median > args.max_seconds:
+        print('import time above budget of {:.3f} s'.format(args.max_seconds))
+        failed.append(module)
+
+if failed:
+    sys.exit('import benchmark failed for '+','.join(failed))
+
+print('DONE')
@@ -0,0 +1,33 @@
+import argparse
+import glob
+import os
+import time
+# our modules below
+from lace_fake import p1d_archive
+
+"""
+Script to collect all p1d_*.json files of a simulation (or of a full suite)
+into a single binary HDF5 archive, that is much faster to read.
+"""
+
+# get options from command line
+parser = argparse.ArgumentParser()
+parser.add_argument('--basedir', type=str, help='Path to simulation (or suite)',required=True)
+parser.add_argument('--archive', type=str, help='Name of output HDF5 archive',required=True)
+parser.add_argument('--p1d_label', type=str, default='p1d', help='String identifying P1D measurement and / or tau scaling.',required=False)
+parser.add_argument('--no_p3d', action='store_true', help='Do not store P3D measurements',required=False)
+args = parser.parse_args()
+
+# look for JSON files with P1D in all post-processing directories
+pattern=args.basedir+'/**/'+args.p1d_label+'_*.json'
+json_files=sorted(glob.glob(pattern,recursive=True))
+print('found {} JSON files with P1D'.format(len(json_files)))
+if len(json_files)==0:
+    raise ValueError('no JSON files matching '+pattern)
+
+t0=time.time()
+p1d_archive.convert_p1d_json(json_files,args.archive,add_p3d=not args.no_p3d,
+            base_dir=args.basedir)
+print('wrote {} in {:.2f} seconds'.format(args.archive,time.time()-t0))
+
+print('DONE')
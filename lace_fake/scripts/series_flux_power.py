@@ -1,17 +1,16 @@
-import numpy as np
 import configargparse
-import os
 import json
+import sys
 # our modules below
-from lace_fake import snapshot_admin
-from lace_fake import extract_skewers
-from lace_fake import read_gadget
+from lace_fake import suite_flux_power
 
 """
 Script will run the final step of the postprocessing, the calculation of the
-p1d from the spectra files, done in series. This part is relatively fast
-and doesn't need to be done across multiple jobs in parallel. Also saves
-us spamming the queue with thousands of jobs
+p1d from the spectra files, for all simulations in a suite. This part is
+relatively fast and doesn't need to be done across multiple jobs. Each
+snapshot is an independent task, and tasks are run in a local pool of
+processes, longest first. Also saves us spamming the queue with thousands
+of jobs
 """
 
 # get options from command line
@@ -20,66 +19,46 @@ parser.add_argument('-c', '--config', required=False, is_config_file=True, help=
 parser.add_argument('--basedir', type=str, help='Path to simulation suite',required=True)
 parser.add_argument('--n_skewers', type=int, default=10, help='Number of skewers per side',required=False)
 parser.add_argument('--scales_tau', type=str, default='1.0', help='Comma-separated list of optical depth scalings to use.',required=False)
+parser.add_argument('--target_mF', type=str, default=None, help='Comma-separated list of target mean flux values (overrides scales_tau).',required=False)
 parser.add_argument('--width_Mpc', type=float, default=0.1, help='Cell width (in Mpc)',required=False)
+parser.add_argument('--axis', type=int, default=None, help='Axis used to extract skewers (1,2,3)',required=False)
+parser.add_argument('--zmax', type=float, default=None, help='Measure p1d for snapshots below this redshift',required=False)
 parser.add_argument('--p1d_label', type=str, default=None, help='String identifying P1D measurement and / or tau scaling.',required=False)
+parser.add_argument('--add_p3d', action='store_true', help='Measure also 3D P(k)',required=False)
+parser.add_argument('--p3d_max_memory_MB', type=float, default=None, help='Memory budget for P3D, measured out-of-core if grid does not fit',required=False)
+parser.add_argument('--cov_method', type=str, default=None, help='Also compute P1D covariance (jackknife, bootstrap)',required=False)
+parser.add_argument('--incremental', action='store_true', help='Reuse P1D from previous run, measuring only the missing ones',required=False)
+parser.add_argument('--write_archive', action='store_true', help='Add measured power also to a binary HDF5 archive for each simulation',required=False)
+parser.add_argument('--n_workers', type=int, default=1, help='Number of processes used to run the tasks',required=False)
 args = parser.parse_args()
 
-print(args.scales_tau)
-
-scales_tau=[float(scale) for scale in args.scales_tau[1:-1].split(',')]
-
+# config files might use brackets around the list
+scales_tau=[float(scale) for scale in args.scales_tau.strip('[]').split(',')]
 print('will scale tau by',scales_tau)
 
-# read information about the hypercube
-cube_json=args.basedir+"/latin_hypercube.json"
-if not os.path.isfile(cube_json):
-    raise ValueError('could not find hypercube '+cube_json)
-
-with open(cube_json) as json_data:
-    cube_data = json.load(json_data)
-
-# get number of samples in the hyper-cube
-nsamples=cube_data['nsamples']
+if args.target_mF is not None:
+    target_mF=[float(mF) for mF in args.target_mF.strip('[]').split(',')]
+    print('will rescale tau to get mean flux',target_mF)
+else:
+    target_mF=None
 
-# for each sample, compute p1d 
-for sample in range(nsamples):
-    # full path to folder for this particular simulation pair
-    sim_dir=args.basedir+'/sim_pair_'+str(sample)
-    for sim in ['sim_plus','sim_minus']:
-        pair_dir=sim_dir+"/"+sim
-        skewers_dir=pair_dir+'/output/skewers/'
-    
-        # get redshifts / snapshots Gadget parameter file 
-        paramfile=pair_dir+'/paramfile.gadget'
-        zs=read_gadget.redshifts_from_paramfile(paramfile)
-        Nsnap=len(zs)
-        ## Loop over snapshots
-        for snap in range(Nsnap):
-            # try to read information about filtering length in simulation
-            kF_json=pair_dir+'/filtering_length.json'
-            if os.path.isfile(kF_json):
-                # read json file with filtering data
-                with open(kF_json) as json_data:
-                    kF_data = json.load(json_data)
-                kF_Mpc=kF_data['kF_Mpc'][snap]
-                print('read kF_Mpc =',kF_Mpc)
-            else:
-                kF_Mpc=None
+# one task per snapshot, for all simulations in the suite
+tasks=suite_flux_power.get_suite_tasks(args.basedir,n_skewers=args.n_skewers,
+            width_Mpc=args.width_Mpc,zmax=args.zmax,axis=args.axis)
 
-            # read file containing information of all temperature rescalings in snapshot
-            snap_filename=skewers_dir+'/'+extract_skewers.get_snapshot_json_filename(
-                        num=snap,n_skewers=args.n_skewers,
-                        width_Mpc=args.width_Mpc)
-            
-            # create an object that will deal with all skewers in the snapshot
-            snapshot=snapshot_admin.SnapshotAdmin(snap_filename,
-                                scales_tau=scales_tau,
-                                kF_Mpc=kF_Mpc)
+timings,failed=suite_flux_power.run_tasks(tasks,scales_tau=scales_tau,
+            target_mF=target_mF,add_p3d=args.add_p3d,
+            p3d_max_memory_MB=args.p3d_max_memory_MB,
+            cov_method=args.cov_method,p1d_label=args.p1d_label,
+            incremental=args.incremental,write_archive=args.write_archive,
+            n_workers=args.n_workers)
 
-            # measure flux power for all tau scalings, for all temperature scalings
-            archive_p1d=snapshot.get_all_flux_power(pair_dir)
+# keep track of time used by each task
+timings_json=args.basedir+'/flux_power_timings.json'
+with open(timings_json,'w') as json_file:
+    json.dump({'timings':timings,'failed':failed},json_file)
 
-            # write all measured power in a JSON file
-            snapshot.write_p1d_json(p1d_label=args.p1d_label)
+if failed:
+    sys.exit('{} tasks failed'.format(len(failed)))
 
 print('DONE')
@@ -11,6 +11,7 @@ parser = configargparse.ArgumentParser()
 parser.add_argument('-c', '--config', required=False, is_config_file=True, help='config file path')
 parser.add_argument('--basedir', type=str, help='Base directory to simulation suite (crashes if it does not exist)', required=True)
 parser.add_argument('--kmax_Mpc', type=float,default=15.0, help='Fit pressure smoothing for k < kmax_Mpc', required=False)
+parser.add_argument('--n_gauss_newton', type=int,default=5, help='Gauss-Newton steps to polish the closed-form fits', required=False)
 parser.add_argument('--show_plots', action='store_true', help='Plot measured power and best fit filtering length',required=False)
 parser.add_argument('--verbose', action='store_true', help='Print runtime information',required=False)
 
@@ -38,7 +39,8 @@ if not os.path.isfile(cube_json):
     print('could not find hypercube '+cube_json)
     print('assuming you passed a single simulation to analyze')
     filtering_length.fit_filtering_length(basedir,kmax_Mpc=kmax_Mpc,
-                        write_json=True,show_plots=show_plots,verbose=verbose)
+                        write_json=True,show_plots=show_plots,verbose=verbose,
+                        n_gauss_newton=args.n_gauss_newton)
     exit()
 
 with open(cube_json) as json_data:
@@ -50,16 +52,17 @@ if verbose:
 # get number of samples in the hyper-cube
 nsamples=cube_data['nsamples']
 
-# for each sample, extract skewers for each snapshot
+# collect all simulations in the suite
+simdirs=[]
 for sample in range(nsamples):
     # full path to folder for this particular simulation pair
     pair_dir=basedir+'/sim_pair_'+str(sample)
-    if verbose:
-        print('compute pressure history pair in',pair_dir)
-
     for sim in ['sim_plus','sim_minus']:
-        simdir=pair_dir+'/'+sim
-        filtering_length.fit_filtering_length(simdir,kmax_Mpc=kmax_Mpc,
-                        write_json=True,show_plots=show_plots,verbose=verbose)
+        simdirs.append(pair_dir+'/'+sim)
+
+# fit pressure history of all snapshots in all simulations at once
+filtering_length.fit_filtering_length_suite(simdirs,kmax_Mpc=kmax_Mpc,
+                write_json=True,show_plots=show_plots,verbose=verbose,
+                n_gauss_newton=args.n_gauss_newton)
 
 
@@ -0,0 +1,58 @@
+import os
+import sys
+import json
+import configargparse
+from lace_fake import read_gadget
+from lace_fake import flux_real_genpk
+
+"""
+Run Keir's modified GenPK on all snapshots of all sims in a specified
+LH suite, in a local pool of GenPk processes (instead of a SLURM job per
+snapshot). Failed runs are retried, and a summary is written to the suite.
+"""
+
+# get options from command line
+parser = configargparse.ArgumentParser()
+parser.add_argument('-c', '--config', required=False, is_config_file=True, help='config file path')
+parser.add_argument('--basedir', type=str, help='Base directory to simulation suite (crashes if it does not exist)', required=True)
+parser.add_argument('--genpk_full_path', type=str, default='/home/chrisp/Codes/GenPK_Keir/gen-pk', help='Path to GenPk executable', required=False)
+parser.add_argument('--n_workers', type=int, default=4, help='Number of GenPk processes running at once', required=False)
+parser.add_argument('--max_retries', type=int, default=1, help='Number of times to retry failed snapshots', required=False)
+parser.add_argument('--timeout', type=float, default=None, help='Maximum time (in seconds) for each GenPk run', required=False)
+parser.add_argument('--verbose', action='store_true', help='Print runtime information',required=False)
+
+args = parser.parse_args()
+
+basedir=args.basedir
+
+# read information about the hypercube
+cube_json=basedir+'/latin_hypercube.json'
+if not os.path.isfile(cube_json):
+    raise ValueError('could not find hypercube '+cube_json)
+
+with open(cube_json) as json_data:
+    cube_data = json.load(json_data)
+
+# one task per snapshot, for all simulations in the suite
+tasks=[]
+for sample in range(cube_data['nsamples']):
+    pair_dir=basedir+'/sim_pair_'+str(sample)
+    for sim in ['sim_plus','sim_minus']:
+        simdir=pair_dir+'/'+sim
+        paramfile=simdir+'/paramfile.gadget'
+        Nsnap=read_gadget.get_simulation_config(paramfile).n_snapshots
+        tasks+=[(simdir,snap) for snap in range(Nsnap)]
+
+results,failed=flux_real_genpk.run_genpk_tasks(tasks,args.genpk_full_path,
+            n_workers=args.n_workers,max_retries=args.max_retries,
+            timeout=args.timeout,verbose=args.verbose)
+
+# keep track of runs
+summary_json=basedir+'/genpk_summary.json'
+with open(summary_json,'w') as json_file:
+    json.dump({'results':results,'failed':failed},json_file)
+
+if failed:
+    sys.exit('GenPk failed for {} snapshots'.format(len(failed)))
+
+print('DONE')
@@ -38,6 +38,13 @@ parser.add_argument(
     help="Comma-separated list of optical depth scalings to use.",
     required=False,
 )
+parser.add_argument(
+    "--target_mF",
+    type=str,
+    default=None,
+    help="Comma-separated list of target mean flux values (overrides scales_tau).",
+    required=False,
+)
 parser.add_argument(
     "--p1d_label",
     type=str,
@@ -51,6 +58,39 @@ parser.add_argument(
     help="Compute also P3D from skewers grid",
     required=False,
 )
+parser.add_argument(
+    "--n_workers",
+    type=int,
+    default=None,
+    help="Number of processes used to measure temperature models",
+    required=False,
+)
+parser.add_argument(
+    "--cov_method",
+    type=str,
+    default=None,
+    help="Also compute P1D covariance (jackknife, bootstrap)",
+    required=False,
+)
+parser.add_argument(
+    "--p3d_max_memory_MB",
+    type=float,
+    default=None,
+    help="Memory budget for P3D, measured out-of-core if grid does not fit",
+    required=False,
+)
+parser.add_argument(
+    "--incremental",
+    action="store_true",
+    help="Reuse P1D from previous run, measuring only the missing ones",
+    required=False,
+)
+parser.add_argument(
+    "--write_archive",
+    action="store_true",
+    help="Add measured power also to the binary HDF5 archive of the simulation",
+    required=False,
+)
 parser.add_argument(
     "--verbose", action="store_true", help="Print runtime information", required=False
 )
@@ -66,6 +106,13 @@ scales_tau = [float(scale) for scale in args.scales_tau.split(",")]
 if verbose:
     print("will scale tau by", scales_tau)
 
+if args.target_mF is not None:
+    target_mF = [float(mF) for mF in args.target_mF.split(",")]
+    if verbose:
+        print("will rescale tau to get mean flux", target_mF)
+else:
+    target_mF = None
+
 # try to read information about filtering length in simulation
 kF_json = post_dir + "/filtering_length.json"
 if os.path.isfile(kF_json):
@@ -95,16 +142,35 @@ if verbose:
 
 # create an object that will deal with all skewers in the snapshot
 snapshot = snapshot_admin.SnapshotAdmin(
-    snap_filename, scales_tau=scales_tau, kF_Mpc=kF_Mpc, post_dir=post_dir, axis=axis
+    snap_filename,
+    scales_tau=scales_tau,
+    kF_Mpc=kF_Mpc,
+    post_dir=post_dir,
+    axis=axis,
+    target_mF=target_mF,
 )
 Nsk = len(snapshot.data["sk_files"])
 if verbose:
     print("snapshot has {} temperature rescalings".format(Nsk))
 
+# read measurements from previous run, if needed
+if args.incremental:
+    previous_p1d_data = snapshot.load_p1d_json(p1d_label=args.p1d_label)
+else:
+    previous_p1d_data = None
+
 # measure flux power for all tau scalings, for all temperature scalings
-archive_p1d = snapshot.get_all_flux_power(add_p3d=args.add_p3d)
+archive_p1d = snapshot.get_all_flux_power(
+    add_p3d=args.add_p3d,
+    p3d_max_memory_MB=args.p3d_max_memory_MB,
+    cov_method=args.cov_method,
+    n_workers=args.n_workers,
+    previous_p1d_data=previous_p1d_data,
+)
 
 # write all measured power in a JSON file
 snapshot.write_p1d_json(p1d_label=args.p1d_label)
+if args.write_archive:
+    snapshot.write_p1d_archive(p1d_label=args.p1d_label)
 
 print("DONE")
@@ -16,6 +16,10 @@ parser.add_argument('--n_skewers', type=int, default=10, help='Number of skewers
 parser.add_argument('--width_Mpc', type=float, default=0.1, help='Cell width (in Mpc)',required=False)
 parser.add_argument('--scales_T0', type=str, default='1.0', help='Comma-separated list of T0 scalings to use.',required=False)
 parser.add_argument('--scales_gamma', type=str, default='1.0', help='Comma-separated list of gamma scalings to use.',required=False)
+parser.add_argument('--particle_cache', action='store_true', help='Keep particle data in memory, shared by all temperature rescalings',required=False)
+parser.add_argument('--max_cache_MB', type=float, default=None, help='Memory budget to keep particle data shared by rescalings (default 4096)',required=False)
+parser.add_argument('--n_workers', type=int, default=None, help='Number of processes used to extract temperature rescalings',required=False)
+parser.add_argument('--td_fraction', type=float, default=None, help='Fit temperature-density relation on this fraction of particles',required=False)
 parser.add_argument('--verbose', action='store_true', help='Print runtime information',required=False)
 args = parser.parse_args()
 
@@ -27,6 +31,10 @@ info=extract_skewers.rescale_write_skewers_z(raw_dir=args.raw_dir,
             num=args.snap_num,n_skewers=args.n_skewers,
             width_Mpc=args.width_Mpc,
             axis=args.axis,
-            scales_T0=scales_T0,scales_gamma=scales_gamma)
+            scales_T0=scales_T0,scales_gamma=scales_gamma,
+            reuse_particle_data=args.particle_cache,
+            max_cache_MB=args.max_cache_MB,
+            n_workers=args.n_workers,
+            td_fraction=args.td_fraction)
 
 print('DONE')
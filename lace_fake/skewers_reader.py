@@ -0,0 +1,104 @@
+""" Read optical depth of skewers from the HDF5 files written by fake_spectra
+(see extract_skewers.get_skewers_snapshot), without setting up a full
+fake_spectra.spectra.Spectra object. """
+
+import numpy as np
+import os
+
+# dataset with the optical depth of Lyman alpha
+TAU_DATASET='tau/H/1/1215'
+
+class SkewersReader(object):
+    """Minimal, read-only access to the optical depth stored in a skewers
+        file. The optical depth is memory-mapped when the dataset is stored
+        contiguously (as written by fake_spectra), otherwise it is read
+        lazily from the HDF5 dataset. In both cases it can be sliced in
+        chunks of skewers, without loading the full array in memory."""
+
+    def __init__(self,sk_filename,use_memmap=True):
+        """Open skewers file, and read header information"""
+
+        import h5py
+
+        self.savefile=sk_filename
+        self.file=h5py.File(sk_filename,'r')
+
+        # header information (box in kpc/h, as in fake_spectra)
+        header=self.file['Header'].attrs
+        self.red=float(header['redshift'])
+        self.box=float(header['box'])
+        self.hubble=float(header['hubble'])
+        if 'Hz' in header:
+            self.Hz=float(header['Hz'])
+        else:
+            self.Hz=None
+
+        dataset=self.file[TAU_DATASET]
+        self.nspec,self.npix=dataset.shape
+        self.shape=dataset.shape
+
+        # offset is None for chunked or compressed datasets
+        offset=dataset.id.get_offset()
+        if use_memmap and offset is not None:
+            self.tau=np.memmap(sk_filename,mode='r',dtype=dataset.dtype,
+                        shape=dataset.shape,offset=offset)
+        else:
+            self.tau=dataset
+
+
+    def get_tau(self,elem='H',ion=1,line=1215):
+        """Optical depth of all skewers, loaded in memory (as in Spectra).
+            Only Lyman alpha is available."""
+
+        if (elem,ion,line)!=('H',1,1215):
+            raise ValueError('only Lyman alpha optical depth available')
+
+        return np.array(self.tau[:],dtype=float)
+
+
+    def get_tau_chunk(self,i0,i1):
+        """Optical depth of skewers i0 to i1 (excluded)"""
+
+        return np.asarray(self.tau[i0:i1],dtype=float)
+
+
+    def iter_tau_chunks(self,chunk_size):
+        """Iterate over chunks of chunk_size skewers, returning the index of
+            the first skewer and the optical depth in the chunk"""
+
+        for i0 in range(0,self.nspec,chunk_size):
+            yield i0, self.get_tau_chunk(i0,i0+chunk_size)
+
+
+    def close(self):
+        """Close HDF5 file (memory-mapped optical depth is not usable)"""
+
+        self.tau=None
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self,*args):
+        self.close()
+
+
+def get_tau_array(skewers):
+    """Optical depth from a skewers object, as an array that can be sliced
+        in chunks of skewers. For a SkewersReader this is the lazily-read
+        (or memory-mapped) array, otherwise it is read with get_tau."""
+
+    if isinstance(skewers,SkewersReader):
+        return skewers.tau
+
+    return skewers.get_tau(elem='H', ion=1, line=1215)
+
+
+def get_skewers_fingerprint(sk_filename):
+    """Size and modification time of a skewers file, used to check whether
+        measurements from a previous run can be reused"""
+
+    stat=os.stat(sk_filename)
+    return {'size':stat.st_size,'mtime':stat.st_mtime}
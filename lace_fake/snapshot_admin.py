@@ -2,19 +2,183 @@ import numpy as np
 import sys
 import os
 import json
-import fake_spectra.spectra as spec
-from lace.setup_simulations import read_genic
+import time
 from lace_fake import measure_flux_power as powF
+from lace_fake import fft_backend
+from lace_fake import skewers_reader
+from lace_fake import p1d_archive
+from lace_fake import read_gadget
+
+
+def measure_sk_model_flux_power(sk_model,settings):
+    """Measure flux power for all tau scalings of a temperature model.
+        sk_model contains the skewers file and the temperature rescaling,
+        settings the options shared by all models (see get_all_flux_power).
+        Defined at module level so that it can run in a process pool."""
+
+    sk_file=sk_model['sk_file']
+    skewers_dir=settings['skewers_dir']
+    L_Mpc=settings['L_Mpc']
+    target_mF=settings['target_mF']
+    add_p3d=settings['add_p3d']
+    cov_method=settings['cov_method']
+    # store size and time of skewers file, to reuse measurements later
+    sk_fingerprint=skewers_reader.get_skewers_fingerprint(
+                skewers_dir+'/'+sk_file)
+
+    if add_p3d:
+        # open skewers from HDF5 file (optical depth is read when needed)
+        skewers=skewers_reader.SkewersReader(skewers_dir+'/'+sk_file)
+        # find tau scalings that give target mean flux, if needed
+        if target_mF:
+            scales_tau=powF.find_scales_tau(skewers.tau,target_mF,
+                    chunk_size=settings['p1d_chunk_size']).tolist()
+        else:
+            scales_tau=settings['scales_tau']
+        # measure P1D and P3D for all tau scalings, reading tau only once
+        # and sharing the line-of-sight FFT
+        results=powF.measure_F_p1d_p3d_Mpc_batch(skewers,scales_tau,
+                L_Mpc=L_Mpc,n_k_bins=settings['n_k_bins'],
+                k_Mpc_max=settings['k_Mpc_max'],
+                n_mu_bins=settings['n_mu_bins'],
+                max_memory_MB=settings['p3d_max_memory_MB'],
+                fft_workers=settings['fft_workers'],
+                cov_method=cov_method,n_jk_side=settings['n_jk_side'],
+                n_boot=settings['n_boot'])
+        k,p1d,mF,p3d=results[:4]
+        if cov_method:
+            p1d_cov=results[4]
+        skewers.close()
+    else:
+        sk_path=skewers_dir+'/'+sk_file
+        # find tau scalings that give target mean flux, if needed
+        if target_mF:
+            scales_tau=powF.find_scales_tau_from_file(sk_path,target_mF,
+                    chunk_size=settings['p1d_chunk_size']).tolist()
+        else:
+            scales_tau=settings['scales_tau']
+        # stream skewers from HDF5 file, for all tau scalings
+        results=powF.measure_F_p1d_Mpc_batch_from_file(sk_path,scales_tau,
+                L_Mpc=L_Mpc,chunk_size=settings['p1d_chunk_size'],
+                fft_workers=settings['fft_workers'],cov_method=cov_method,
+                n_jk_side=settings['n_jk_side'],n_boot=settings['n_boot'])
+        k,p1d,mF=results[:3]
+        if cov_method:
+            p1d_cov=results[3]
+
+    # loop over tau scalings
+    sk_p1d=[]
+    for itau,scale_tau in enumerate(scales_tau):
+        info_p1d={'k_Mpc':k.tolist(),'p1d_Mpc':p1d[itau].tolist(),
+                'mF':mF[itau]}
+        info_p1d['scale_tau']=scale_tau
+        if target_mF:
+            info_p1d['target_mF']=target_mF[itau]
+        if cov_method:
+            info_p1d['p1d_cov_Mpc']=p1d_cov[itau].tolist()
+            info_p1d['cov_method']=cov_method
+        # add information about skewers and temperature rescaling
+        info_p1d.update(sk_model)
+        info_p1d['sk_fingerprint']=sk_fingerprint
+        info_p1d['measure_settings']=get_measure_settings(settings)
+        if settings['kF_Mpc'] is not None:
+            info_p1d['kF_Mpc']=settings['kF_Mpc']
+        # add also P3D, if measured
+        if add_p3d:
+            info_p1d['p3d_data']=p3d[itau]
+
+        sk_p1d.append(info_p1d)
+
+    return sk_p1d
+
+
+def get_measure_settings(settings):
+    """Settings (other than skewers file and tau scaling) that change the
+        measured power, stored with each measurement so that it is only
+        reused if they have not changed"""
+
+    measure_settings={'L_Mpc':settings['L_Mpc']}
+    if settings['cov_method']=='jackknife':
+        measure_settings['n_jk_side']=settings['n_jk_side']
+    elif settings['cov_method']=='bootstrap':
+        measure_settings['n_boot']=settings['n_boot']
+    if settings['add_p3d']:
+        for key in ['n_k_bins','k_Mpc_max','n_mu_bins']:
+            measure_settings[key]=settings[key]
+
+    return measure_settings
+
+
+def get_p1d_key(info_p1d,target_mF):
+    """Identify measurement within a temperature model, by its target mean
+        flux (if rescaling to target_mF) or by its tau scaling"""
+
+    if target_mF:
+        return info_p1d.get('target_mF')
+    return info_p1d['scale_tau']
+
+
+def get_reusable_flux_power(previous_p1d_data,sk_model,settings):
+    """Find measurements of a temperature model in previous_p1d_data that
+        can be reused: same skewers file (unchanged since measured), same
+        options (P3D, covariance, box size and binning, see
+        get_measure_settings) and same tau scaling or target mean flux.
+        Returns a dictionary of reusable measurements (keyed as get_p1d_key)
+        and the settings to measure the missing ones (None if all present)."""
+
+    sk_file=sk_model['sk_file']
+    target_mF=settings['target_mF']
+    sk_fingerprint=skewers_reader.get_skewers_fingerprint(
+                settings['skewers_dir']+'/'+sk_file)
+    measure_settings=get_measure_settings(settings)
+
+    reusable={}
+    for info_p1d in previous_p1d_data:
+        if info_p1d['sk_file']!=sk_file:
+            continue
+        if info_p1d.get('sk_fingerprint')!=sk_fingerprint:
+            continue
+        if ('p3d_data' in info_p1d)!=settings['add_p3d']:
+            continue
+        if info_p1d.get('cov_method')!=settings['cov_method']:
+            continue
+        if info_p1d.get('measure_settings')!=measure_settings:
+            continue
+        if bool(target_mF)!=('target_mF' in info_p1d):
+            continue
+        # filtering length might have been measured after the previous run
+        info_p1d=dict(info_p1d)
+        info_p1d.pop('kF_Mpc',None)
+        if settings['kF_Mpc'] is not None:
+            info_p1d['kF_Mpc']=settings['kF_Mpc']
+        reusable[get_p1d_key(info_p1d,target_mF)]=info_p1d
+
+    # measure only tau scalings (or target mean flux) not present
+    if target_mF:
+        missing=[mF for mF in target_mF if mF not in reusable]
+        missing_settings=dict(settings,target_mF=missing)
+    else:
+        missing=[scale for scale in settings['scales_tau']
+                    if scale not in reusable]
+        missing_settings=dict(settings,scales_tau=missing)
+    if len(missing)==0:
+        return reusable, None
+
+    return reusable, missing_settings
+
 
 class SnapshotAdmin(object):
     """Book-keeping of all elements related to a snapshot.
         For now, it reads pre-computed skewers, for different temperatures."""
 
-    def __init__(self,snap_json,scales_tau=None,kF_Mpc=None,post_dir=None,axis=None):
+    def __init__(self,snap_json,scales_tau=None,kF_Mpc=None,post_dir=None,axis=None,
+                target_mF=None):
         """Setup from JSON file with information about skewers extracted.
             One can also specify tau rescalings, and (optionally) provide
             the measured filtering length.
-            If post_dir is provided, use it as postprocessing directory."""
+            If post_dir is provided, use it as postprocessing directory.
+            If target_mF is provided, for each temperature model use the tau
+            rescalings that give these mean flux values (ignore scales_tau)."""
 
         # read snapshot information from file (including temperature scalings)
         with open(snap_json) as json_data:
@@ -47,65 +211,137 @@ class SnapshotAdmin(object):
         self.NT = len(self.data['sim_T0'])
 
         # store number of optical depth rescalings we want to do
-        if scales_tau:
-            self.scales_tau=scales_tau
+        if target_mF:
+            self.target_mF=list(target_mF)
+            self.scales_tau=None
         else:
-            self.scales_tau=[1.0]
+            self.target_mF=None
+            if scales_tau:
+                self.scales_tau=scales_tau
+            else:
+                self.scales_tau=[1.0]
 
 
-    def get_all_flux_power(self,add_p3d=False):
-        """Loop over all skewers, and return flux power for each"""
+    def get_all_flux_power(self,add_p3d=False,p3d_max_memory_MB=None,
+                p1d_chunk_size=None,cov_method=None,n_jk_side=4,n_boot=100,
+                n_workers=None,previous_p1d_data=None,fft_workers=None,
+                n_k_bins=20,k_Mpc_max=20.0,n_mu_bins=16):
+        """Loop over all skewers, and return flux power for each.
+            P3D is binned in n_k_bins (up to k_Mpc_max) and n_mu_bins.
+            If p3d_max_memory_MB is set, P3D of grids that would not fit in
+            this memory budget is measured out-of-core.
+            If P3D is not needed, P1D is measured streaming chunks of
+            p1d_chunk_size skewers from the files.
+            If cov_method is 'jackknife' (n_jk_side^2 regions) or 'bootstrap'
+            (n_boot realizations), store also the covariance of P1D.
+            If n_workers > 1, temperature models are measured in a pool of
+            n_workers processes (each with a share of the FFT threads), so
+            that at most n_workers skewer grids are loaded at once.
+            If previous_p1d_data is provided (e.g., from load_p1d_json),
+            measurements with unchanged skewers files and settings are
+            reused, and only the missing ones are computed.
+            fft_workers sets the number of FFT threads (when n_workers=1)."""
 
         post_dir=self.data['post_dir']
-        genic_file=post_dir+'/paramfile.genic'
-        L_Mpc=read_genic.L_Mpc_from_paramfile(genic_file,verbose=True)
-        skewers_dir=self.data['skewers_dir']
-        snap_num=self.data['snap_num']
+        # box size from GenIC file (parsed once per simulation)
+        sim_config=read_gadget.get_simulation_config(post_dir+'/paramfile.gadget')
+        L_Mpc=sim_config.L_Mpc
+        print('box size L = {:.3f} Mpc'.format(L_Mpc))
+
+        # settings shared by all temperature models
+        settings={'skewers_dir':self.data['skewers_dir'],'L_Mpc':L_Mpc,
+                'scales_tau':self.scales_tau,'target_mF':self.target_mF,
+                'kF_Mpc':self.data.get('kF_Mpc'),'add_p3d':add_p3d,
+                'p3d_max_memory_MB':p3d_max_memory_MB,
+                'p1d_chunk_size':p1d_chunk_size,'cov_method':cov_method,
+                'n_jk_side':n_jk_side,'n_boot':n_boot,
+                'fft_workers':fft_workers,'n_k_bins':n_k_bins,
+                'k_Mpc_max':k_Mpc_max,'n_mu_bins':n_mu_bins}
 
         # will loop over all temperature models in snapshot
         Nsk=len(self.data['sk_files'])
+        sk_models=[]
+        for isk in range(Nsk):
+            sk_model={'sk_file':self.data['sk_files'][isk]}
+            for key in ['sim_T0','sim_gamma','sim_sigT_Mpc','sim_scale_T0',
+                        'sim_scale_gamma']:
+                sk_model[key]=self.data[key][isk]
+            sk_models.append(sk_model)
+
+        # figure out which measurements are already available
+        reusable=[]
+        to_measure=[]
+        for isk,sk_model in enumerate(sk_models):
+            if previous_p1d_data:
+                sk_reusable,sk_settings=get_reusable_flux_power(
+                        previous_p1d_data,sk_model,settings)
+            else:
+                sk_reusable,sk_settings={},settings
+            reusable.append(sk_reusable)
+            if sk_settings is not None:
+                to_measure.append((isk,sk_settings))
+        if previous_p1d_data:
+            print('reuse {} measurements, measure {} temperature models'.format(
+                    sum(len(sk_reusable) for sk_reusable in reusable),
+                    len(to_measure)))
+
         # collect all measured powers, with information about skewers
-        p1d_data=[]
+        measured={}
+        n_jobs=len(to_measure)
+        if n_workers is None or n_workers<=1 or n_jobs<=1:
+            for isk,sk_settings in to_measure:
+                measured[isk]=measure_sk_model_flux_power(sk_models[isk],
+                        sk_settings)
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            n_workers=min(n_workers,n_jobs)
+            # share the FFT threads available between processes
+            n_threads=fft_backend.get_fft_workers()
+            for isk,sk_settings in to_measure:
+                sk_settings['fft_workers']=max(1,n_threads//n_workers)
+            print(time.asctime(),'measure',n_jobs,'temperature models with',
+                    n_workers,'processes')
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                # map returns results in the order of the temperature models
+                for (isk,sk_settings),sk_p1d in zip(to_measure,executor.map(
+                            measure_sk_model_flux_power,
+                            [sk_models[isk] for isk,_ in to_measure],
+                            [sk_settings for _,sk_settings in to_measure])):
+                    print(time.asctime(),'done',sk_models[isk]['sk_file'])
+                    measured[isk]=sk_p1d
 
+        # merge new and reused measurements, in the requested order
+        p1d_data=[]
         for isk in range(Nsk):
-            sk_file=self.data['sk_files'][isk]
-            sim_T0=self.data['sim_T0'][isk]
-            sim_gamma=self.data['sim_gamma'][isk]
-            sim_sigT_Mpc=self.data['sim_sigT_Mpc'][isk]
-            sim_scale_T0=self.data['sim_scale_T0'][isk]
-            sim_scale_gamma=self.data['sim_scale_gamma'][isk]
-
-            # read skewers from HDF5 file
-            skewers=spec.Spectra(snap_num,base="NA",cofm=None,axis=None,
-                    savedir=skewers_dir,savefile=sk_file,res=None,
-                    reload_file=False,load_snapshot=False,quiet=False)
-
-            # loop over tau scalings
-            for scale_tau in self.scales_tau:
-                k,p1d,mF=powF.measure_F_p1d_Mpc(skewers,scale_tau,L_Mpc=L_Mpc)
-                info_p1d={'k_Mpc':k.tolist(),'p1d_Mpc':p1d.tolist(),'mF':mF}
-                info_p1d['scale_tau']=scale_tau
-                # add information about skewers and temperature rescaling
-                info_p1d['sk_file']=sk_file
-                info_p1d['sim_T0']=sim_T0
-                info_p1d['sim_gamma']=sim_gamma
-                info_p1d['sim_sigT_Mpc']=sim_sigT_Mpc
-                info_p1d['sim_scale_T0']=sim_scale_T0
-                info_p1d['sim_scale_gamma']=sim_scale_gamma
-                if 'kF_Mpc' in self.data:
-                    info_p1d['kF_Mpc'] = self.data['kF_Mpc']
-                # try to add also P3D
-                if add_p3d:
-                    # being lazy for now
-                    info_p3d=powF.measure_p3d_Mpc(skewers,scale_tau,L_Mpc=L_Mpc)
-                    info_p1d['p3d_data']=info_p3d
-
-                p1d_data.append(info_p1d)
+            sk_p1d=dict(reusable[isk])
+            for info_p1d in measured.get(isk,[]):
+                sk_p1d[get_p1d_key(info_p1d,self.target_mF)]=info_p1d
+            for key in (self.target_mF or self.scales_tau):
+                p1d_data.append(sk_p1d[key])
 
         self.p1d_data=p1d_data
         return p1d_data
 
 
+    def load_p1d_json(self,p1d_label=None):
+        """ Read P1D measured in a previous run (from write_p1d_json), to be
+            reused in get_all_flux_power. Returns empty list if no file. """
+
+        if p1d_label is None:
+            p1d_label='p1d'
+
+        filename=self.data['post_dir']+'/'+self.get_p1d_json_filename(p1d_label)
+        if not os.path.isfile(filename):
+            print('no previous P1D in',filename)
+            return []
+
+        print('read previous P1D from',filename)
+        with open(filename) as json_data:
+            p1d_info=json.load(json_data)
+
+        return p1d_info['p1d_data']
+
+
     def get_p1d_json_filename(self,p1d_label):
         """Use metadata information to figure filename for JSON with P1D"""
 
@@ -136,10 +372,44 @@ class SnapshotAdmin(object):
             print('computing P1D before writing JSON file')
             self.get_all_flux_power()
 
+        json_file = open(filename,"w")
+        json.dump(self.get_p1d_info(),json_file)
+        json_file.close()
+
+
+    def get_p1d_info(self):
+        """ Dictionary with snapshot information and all measured P1D """
+
         p1d_info={'snapshot_data':self.data, 'scales_tau':self.scales_tau,
                     'p1d_data': self.p1d_data}
+        if self.target_mF:
+            p1d_info['target_mF']=self.target_mF
 
-        json_file = open(filename,"w")
-        json.dump(p1d_info,json_file)
-        json_file.close()
+        return p1d_info
+
+
+    def write_p1d_archive(self,p1d_label=None,archive_filename=None):
+        """ Add P1D measured in all post-processing to a binary HDF5 archive
+            (see p1d_archive), in a group named as the JSON file. By default
+            use a single archive for all snapshots of the simulation, in the
+            post-processing directory. If the snapshot is already in the
+            archive, it is replaced. """
+
+        if p1d_label is None:
+            p1d_label='p1d'
+
+        json_filename=self.get_p1d_json_filename(p1d_label)
+        label=os.path.splitext(json_filename)[0]
+        if archive_filename is None:
+            archive_filename=p1d_archive.get_sim_archive_filename(
+                        self.data['post_dir'],p1d_label)
+        print('will add snapshot',label,'to P1D archive',archive_filename)
+
+        # make sure we have already computed P1D
+        if not self.p1d_data:
+            print('computing P1D before writing archive')
+            self.get_all_flux_power()
+
+        p1d_archive.write_p1d_archive(archive_filename,[self.get_p1d_info()],
+                    labels=[label],mode='a')
 
@@ -0,0 +1,180 @@
+""" Measure flux power for all snapshots in a suite of simulations, as
+independent tasks distributed in a local pool of processes. """
+
+import numpy as np
+import os
+import json
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+# our modules
+from lace_fake import read_gadget
+from lace_fake import extract_skewers
+from lace_fake import fft_backend
+
+def read_kF_Mpc(post_dir):
+    """ Filtering length (in 1/Mpc) of each snapshot in a simulation,
+        or None if it has not been measured """
+
+    kF_json=post_dir+'/filtering_length.json'
+    if not os.path.isfile(kF_json):
+        return None
+
+    with open(kF_json) as json_data:
+        kF_data = json.load(json_data)
+    return kF_data['kF_Mpc']
+
+
+def get_skewers_dir(post_dir,axis=None):
+    """ Directory with skewers, as used in SnapshotAdmin """
+
+    if axis is None:
+        return post_dir+'/skewers/'
+    return post_dir+'/skewers_{}/'.format(axis)
+
+
+def get_sim_tasks(post_dir,n_skewers,width_Mpc,zmax=None,axis=None,
+            label=None):
+    """ List of tasks (one per snapshot with skewers) in a simulation.
+        Each task is a dictionary, with an estimate of its cost given by
+        the total size of its skewer files. """
+
+    if label is None:
+        label=post_dir
+
+    # get redshifts / snapshots Gadget parameter file
+    paramfile=post_dir+'/paramfile.gadget'
+    zs=read_gadget.get_simulation_config(paramfile).zs
+    # read filtering length only once per simulation
+    kF_Mpc=read_kF_Mpc(post_dir)
+    skewers_dir=get_skewers_dir(post_dir,axis)
+
+    tasks=[]
+    for snap,z in enumerate(zs):
+        if zmax is not None and z >= zmax:
+            continue
+        snap_json=skewers_dir+extract_skewers.get_snapshot_json_filename(
+                    num=snap,n_skewers=n_skewers,width_Mpc=width_Mpc)
+        if not os.path.isfile(snap_json):
+            print('no skewers for snapshot',snap,'in',post_dir)
+            continue
+        with open(snap_json) as json_data:
+            sk_files=json.load(json_data)['sk_files']
+        cost=0
+        for sk_file in sk_files:
+            sk_path=skewers_dir+'/'+sk_file
+            if os.path.isfile(sk_path):
+                cost+=os.path.getsize(sk_path)
+        task={'label':'{} snap {}'.format(label,snap),'post_dir':post_dir,
+                'snap_num':snap,'snap_json':snap_json,'axis':axis,
+                'cost':cost}
+        if kF_Mpc is not None:
+            task['kF_Mpc']=kF_Mpc[snap]
+        else:
+            task['kF_Mpc']=None
+        tasks.append(task)
+
+    return tasks
+
+
+def get_suite_tasks(basedir,n_skewers,width_Mpc,zmax=None,axis=None,
+            sims=['sim_plus','sim_minus']):
+    """ List of tasks for all simulations in a Latin hypercube suite """
+
+    # read information about the hypercube
+    cube_json=basedir+'/latin_hypercube.json'
+    if not os.path.isfile(cube_json):
+        raise ValueError('could not find hypercube '+cube_json)
+
+    with open(cube_json) as json_data:
+        cube_data = json.load(json_data)
+
+    tasks=[]
+    for sample in range(cube_data['nsamples']):
+        for sim in sims:
+            label='sim_pair_{}/{}'.format(sample,sim)
+            tasks+=get_sim_tasks(basedir+'/'+label,n_skewers,width_Mpc,
+                        zmax=zmax,axis=axis,label=label)
+
+    return tasks
+
+
+def run_flux_power_task(task,settings):
+    """ Measure flux power for all skewers in a snapshot, and write results.
+        settings contains options shared by all tasks (see run_tasks).
+        Defined at module level so that it can run in a process pool. """
+
+    # import here to keep this module light for the parent process
+    from lace_fake import snapshot_admin
+
+    t0=time.time()
+    snapshot=snapshot_admin.SnapshotAdmin(task['snap_json'],
+                scales_tau=settings['scales_tau'],kF_Mpc=task['kF_Mpc'],
+                post_dir=task['post_dir'],axis=task['axis'],
+                target_mF=settings['target_mF'])
+    if settings['incremental']:
+        previous_p1d_data=snapshot.load_p1d_json(
+                    p1d_label=settings['p1d_label'])
+    else:
+        previous_p1d_data=None
+    snapshot.get_all_flux_power(add_p3d=settings['add_p3d'],
+                p3d_max_memory_MB=settings['p3d_max_memory_MB'],
+                cov_method=settings['cov_method'],
+                fft_workers=settings['fft_workers'],
+                previous_p1d_data=previous_p1d_data)
+    snapshot.write_p1d_json(p1d_label=settings['p1d_label'])
+    if settings['write_archive']:
+        snapshot.write_p1d_archive(p1d_label=settings['p1d_label'])
+
+    return time.time()-t0
+
+
+def run_tasks(tasks,scales_tau=None,target_mF=None,add_p3d=False,
+            p3d_max_memory_MB=None,cov_method=None,p1d_label=None,
+            incremental=False,write_archive=False,n_workers=1):
+    """ Run all tasks in a pool of n_workers processes, longest first (as
+        estimated from the size of the skewer files) to balance the load.
+        FFT threads are shared between processes.
+        Returns the time (in seconds) used by each task, and the labels of
+        the tasks that failed. """
+
+    settings={'scales_tau':scales_tau,'target_mF':target_mF,
+            'add_p3d':add_p3d,'p3d_max_memory_MB':p3d_max_memory_MB,
+            'cov_method':cov_method,'p1d_label':p1d_label,
+            'incremental':incremental,'write_archive':write_archive}
+    n_workers=max(1,min(n_workers,len(tasks)))
+    settings['fft_workers']=max(1,fft_backend.get_fft_workers()//n_workers)
+
+    # longest tasks first
+    order=np.argsort([-task['cost'] for task in tasks],kind='stable')
+    tasks=[tasks[i] for i in order]
+    n_tasks=len(tasks)
+    print(time.asctime(),'run {} tasks with {} processes'.format(n_tasks,
+                n_workers))
+
+    timings={}
+    failed=[]
+    t0=time.time()
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures={executor.submit(run_flux_power_task,task,settings):task
+                    for task in tasks}
+        for i,future in enumerate(as_completed(futures)):
+            label=futures[future]['label']
+            try:
+                timings[label]=future.result()
+            except Exception:
+                print(time.asctime(),'task',label,'failed')
+                traceback.print_exc()
+                failed.append(label)
+                continue
+            print(time.asctime(),'[{}/{}] {} done in {:.1f} s'.format(i+1,
+                        n_tasks,label,timings[label]))
+
+    elapsed=time.time()-t0
+    total=sum(timings.values())
+    print(time.asctime(),'finished {} tasks in {:.1f} s'.format(len(timings),
+                elapsed),'(sum of task times {:.1f} s)'.format(total))
+    if failed:
+        print(len(failed),'tasks failed:',failed)
+
+    return timings, failed
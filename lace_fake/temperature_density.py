@@ -1,12 +1,24 @@
-import fake_spectra.tempdens as tdr
+import numpy as np
 from lace_fake import read_gadget
+from lace_fake import thermal_cache
 
-def compute_TDR(simdir,zmax=20):
-    """Measure temperature-density relation for all snapshots above zmax"""
+# Gadget internal units (cgs), used if not present in snapshot header
+GADGET_UNITS={'UnitLength_in_cm':3.085678e21,'UnitMass_in_g':1.989e43,
+            'UnitVelocity_in_cm_per_s':1.e5}
+# Newton constant in cgs
+G_CGS=6.6738e-8
+
+def compute_TDR(simdir,zmax=20,fraction=None,post_dir=None,**fit_kwargs):
+    """Measure temperature-density relation for all snapshots below zmax.
+        If post_dir is set, results are stored in its thermal cache, and
+        snapshots already in the cache (and unchanged) are not fitted.
+        If fraction is set, fit a subsample of particles (see
+        fit_td_subsample, that also takes fit_kwargs)."""
 
     paramfile=simdir+'/paramfile.gadget'
-    zs=read_gadget.redshifts_from_paramfile(paramfile)
-    Nsnap=len(zs)
+    sim_config=read_gadget.get_simulation_config(paramfile)
+    zs=sim_config.zs
+    Nsnap=sim_config.n_snapshots
 
     # store information to write to file later
     thermal_snap=[]
@@ -16,7 +28,8 @@ def compute_TDR(simdir,zmax=20):
     for num in range(Nsnap):
         z=zs[num]
         if z < zmax:
-            T0,gamma=tdr.fit_td_rel_plot(num,simdir+'/output',plot=False)
+            T0,gamma=thermal_cache.get_thermal_state(simdir,post_dir,num,
+                        fraction=fraction,**fit_kwargs)
             thermal_snap.append(num)
             thermal_z.append(z)
             thermal_T0.append(T0)
@@ -25,6 +38,186 @@ def compute_TDR(simdir,zmax=20):
     thermal_info={'number':thermal_snap,'z':thermal_z,'T0':thermal_T0,
             'gamma':thermal_gamma}
     thermal_info['zmax']=zmax
+    thermal_info['fraction']=fraction
 
     return thermal_info
 
+
+def get_mean_baryon_density(snap,omegab):
+    """Mean (comoving) baryon density in the internal units of the snapshot"""
+
+    units={}
+    for key,value in GADGET_UNITS.items():
+        try:
+            units[key]=float(snap.get_header_attr(key))
+        except (KeyError,OSError):
+            units[key]=value
+
+    # Hubble constant (for h=1) and Newton constant in internal units
+    unit_time=units['UnitLength_in_cm']/units['UnitVelocity_in_cm_per_s']
+    H0=1.e7/3.085678e24*unit_time
+    G=G_CGS*units['UnitMass_in_g']/units['UnitLength_in_cm']**3*unit_time**2
+    rho_crit=3.0*H0**2/(8.0*np.pi*G)
+
+    return omegab*rho_crit
+
+
+def read_td_subsample(simdir,num,fraction=0.1,stratified=False,seed=0,
+            ldens_min=-1.0,ldens_max=0.0,n_strata=10):
+    """Read log10 of overdensity and temperature for a reproducible subsample
+        of gas particles. Each particle is selected independently with
+        probability fraction (not whole segments, since segments are
+        spatially coherent and would bias the fit and its bootstrap
+        uncertainties). Note that this still reads density and temperature
+        of all particles, one segment at a time: the subsample saves memory
+        and fitting time, not I/O.
+        If stratified, particles in the fitting range of log-overdensity are
+        selected so that each of n_strata bins has a similar number of them.
+        Returns log-overdensity, log-temperature and the weight of each
+        particle (inverse of its selection probability)."""
+
+    import fake_spectra.abstractsnapshot as absn
+
+    if not 0 < fraction <= 1:
+        raise ValueError('fraction should be in (0,1]')
+
+    snap=absn.AbstractSnapshotFactory(num,simdir+'/output/',Tscale=1.0,
+                gammascale=1.0)
+    config=read_gadget.get_simulation_config(simdir+'/paramfile.gadget').config
+    rho_bar=get_mean_baryon_density(snap,config['OmegaBaryon'])
+
+    # select particles independently, from all segments
+    rng=np.random.default_rng(seed)
+    n_segments=snap.get_n_segments()
+
+    ldens=[]
+    ltemp=[]
+    weights=[]
+    strata_edges=np.linspace(ldens_min,ldens_max,n_strata+1)
+    for segment in range(n_segments):
+        seg_ldens=np.log10(snap.get_data(0,"Density",segment=segment)/rho_bar)
+        if stratified:
+            # same expected number of particles in each density stratum
+            in_range=(seg_ldens>=ldens_min) & (seg_ldens<ldens_max)
+            strata=np.clip(np.digitize(seg_ldens,strata_edges)-1,0,
+                        n_strata-1)
+            counts=np.bincount(strata[in_range],minlength=n_strata)
+            n_target=fraction*np.sum(counts)/n_strata
+            with np.errstate(divide='ignore'):
+                rates=np.minimum(1.0,n_target/counts)
+            prob=np.where(in_range,rates[strata],0.0)
+        else:
+            prob=np.full(len(seg_ldens),fraction)
+        keep=rng.random(len(seg_ldens)) < prob
+        seg_temp=snap.get_temp(0,segment=segment)
+        ldens.append(seg_ldens[keep])
+        ltemp.append(np.log10(seg_temp[keep]))
+        weights.append(1.0/prob[keep])
+
+    return np.concatenate(ldens), np.concatenate(ltemp), np.concatenate(weights)
+
+
+def fit_td_relation(ldens,ltemp,weights=None,ldens_min=-1.0,ldens_max=0.0,
+            ltemp_max=5.0):
+    """Weighted least-squares fit of log10(T) = log10(T0) + (gamma-1) delta,
+        with delta the log10 of the overdensity, using diffuse gas
+        (ldens_min < delta < ldens_max, log10(T) < ltemp_max).
+        This is not the estimator of fake_spectra (fit_td_rel_plot): use
+        compare_td_fits to check that both agree for a simulation.
+        weights can be an array with shape (n_fits,n_particles), to do
+        several fits at once. Returns T0 and gamma (arrays if needed)."""
+
+    mask=(ldens>ldens_min) & (ldens<ldens_max) & (ltemp<ltemp_max)
+    x=ldens[mask]
+    y=ltemp[mask]
+    if weights is None:
+        w=np.ones_like(x)
+    else:
+        w=np.asarray(weights)[...,mask]
+
+    # closed-form solution from weighted sums
+    S=np.sum(w,axis=-1)
+    Sx=w@x
+    Sy=w@y
+    Sxx=w@(x*x)
+    Sxy=w@(x*y)
+    slope=(S*Sxy-Sx*Sy)/(S*Sxx-Sx**2)
+    intercept=(Sy-slope*Sx)/S
+
+    return 10**intercept, 1.0+slope
+
+
+def fit_td_subsample(simdir,num,fraction=0.1,stratified=False,n_boot=100,
+            seed=0,max_rel_err_T0=None,max_err_gamma=None,ldens_min=-1.0,
+            ldens_max=0.0,ltemp_max=5.0,verbose=False):
+    """Fit temperature-density relation on a subsample of gas particles
+        (see read_td_subsample and fit_td_relation), with uncertainties from
+        n_boot bootstrap resamplings (Poisson weights) of the subsample.
+        Particles are selected independently, so they are also resampled
+        independently. If max_rel_err_T0 (relative) or max_err_gamma are
+        set and the uncertainties are larger, refit using all particles
+        (with the same estimator, so that results do not depend on which
+        fits were refined).
+        Returns a dictionary with T0, gamma and their uncertainties."""
+
+    cuts={'ldens_min':ldens_min,'ldens_max':ldens_max,'ltemp_max':ltemp_max}
+    ldens,ltemp,weights=read_td_subsample(simdir,num,fraction=fraction,
+                stratified=stratified,seed=seed,ldens_min=ldens_min,
+                ldens_max=ldens_max)
+    T0,gamma=fit_td_relation(ldens,ltemp,weights,**cuts)
+
+    # bootstrap resamplings, in batches to limit memory
+    rng=np.random.default_rng(seed+1)
+    T0_boot=[]
+    gamma_boot=[]
+    batch=max(1,min(n_boot,int(2**24//max(1,len(ldens)))))
+    for i0 in range(0,n_boot,batch):
+        n=min(batch,n_boot-i0)
+        boot_weights=rng.poisson(1.0,size=(n,len(ldens)))*weights
+        T0_b,gamma_b=fit_td_relation(ldens,ltemp,boot_weights,**cuts)
+        T0_boot.append(T0_b)
+        gamma_boot.append(gamma_b)
+    sigma_T0=float(np.std(np.concatenate(T0_boot),ddof=1))
+    sigma_gamma=float(np.std(np.concatenate(gamma_boot),ddof=1))
+
+    fit={'T0':float(T0),'gamma':float(gamma),'sigma_T0':sigma_T0,
+            'sigma_gamma':sigma_gamma,'fraction':fraction,
+            'stratified':stratified,'n_particles':len(ldens),'refined':False}
+    if verbose:
+        print('subsample fit: T0 = {:.1f} +/- {:.1f} ; gamma = {:.4f} +/- {:.4f}'
+                .format(T0,sigma_T0,gamma,sigma_gamma))
+
+    # refine with all particles, if uncertainties are too large
+    refine=False
+    if max_rel_err_T0 is not None and sigma_T0 > max_rel_err_T0*T0:
+        refine=True
+    if max_err_gamma is not None and sigma_gamma > max_err_gamma:
+        refine=True
+    if refine:
+        if verbose:
+            print('uncertainty too large, fit all particles')
+        ldens,ltemp,weights=read_td_subsample(simdir,num,fraction=1.0,
+                    seed=seed)
+        T0,gamma=fit_td_relation(ldens,ltemp,**cuts)
+        fit.update({'T0':float(T0),'gamma':float(gamma),'sigma_T0':None,
+                'sigma_gamma':None,'n_particles':len(ldens),'refined':True})
+
+    return fit
+
+
+def compare_td_fits(simdir,num,fraction=0.1,**fit_kwargs):
+    """Compare the subsample fit (see fit_td_subsample, that also takes
+        fit_kwargs) with the full fit of fake_spectra in a snapshot.
+        Returns a dictionary with both fits, and their differences in units
+        of the bootstrap uncertainties."""
+
+    import fake_spectra.tempdens as tdr
+
+    sub=fit_td_subsample(simdir,num,fraction=fraction,**fit_kwargs)
+    T0,gamma=tdr.fit_td_rel_plot(num,simdir+'/output/',plot=False)
+    comparison={'subsample':sub,'T0':float(T0),'gamma':float(gamma)}
+    if sub['sigma_T0']:
+        comparison['pull_T0']=(sub['T0']-T0)/sub['sigma_T0']
+        comparison['pull_gamma']=(sub['gamma']-gamma)/sub['sigma_gamma']
+
+    return comparison
@@ -0,0 +1,146 @@
+""" Store the temperature-density relation (T0, gamma) measured in each
+snapshot of a simulation, so that the expensive fit over all gas particles
+is only done once. The cache is stored in the post-processing directory
+(the raw simulation is only read), with one JSON file per snapshot that
+includes a fingerprint of the snapshot files and the settings of the fit. """
+
+import os
+import json
+
+def get_thermal_cache_dir(post_dir):
+    """ Directory storing the thermal state of all snapshots in a simulation """
+
+    return post_dir+'/thermal_cache/'
+
+
+def get_thermal_cache_filename(post_dir,num):
+    """ File storing the thermal state of a snapshot. Using one file per
+        snapshot, runs fitting different snapshots never overwrite each
+        other's results. """
+
+    snap_tag=str(num).rjust(3,'0')
+    return get_thermal_cache_dir(post_dir)+'thermal_'+snap_tag+'.json'
+
+
+def get_snapshot_fingerprint(raw_dir,num):
+    """ Number of files, total size and latest modification time of the
+        files of a snapshot, to check that it has not changed """
+
+    snap_tag=str(num).rjust(3,'0')
+    snap_dir=os.path.join(raw_dir,'output','PART_'+snap_tag)
+    if not os.path.isdir(snap_dir):
+        raise ValueError('could not find snapshot '+snap_dir)
+
+    n_files=0
+    size=0
+    mtime=0.0
+    for root,dirs,files in os.walk(snap_dir):
+        for filename in files:
+            stat=os.stat(os.path.join(root,filename))
+            n_files+=1
+            size+=stat.st_size
+            mtime=max(mtime,stat.st_mtime)
+
+    return {'n_files':n_files,'size':size,'mtime':mtime}
+
+
+def read_thermal_entry(post_dir,num):
+    """ Cached thermal state of a snapshot, or None if there is none """
+
+    filename=get_thermal_cache_filename(post_dir,num)
+    if not os.path.isfile(filename):
+        return None
+
+    with open(filename) as json_data:
+        return json.load(json_data)
+
+
+def write_thermal_entry(post_dir,num,entry):
+    """ Store thermal state of a snapshot. The file is replaced atomically,
+        so that other runs never read a partial file. """
+
+    filename=get_thermal_cache_filename(post_dir,num)
+    os.makedirs(os.path.dirname(filename),exist_ok=True)
+    tmp_filename=filename+'.tmp.'+str(os.getpid())
+    with open(tmp_filename,'w') as json_file:
+        json.dump(entry,json_file)
+    os.replace(tmp_filename,filename)
+
+
+def get_fit_settings(fit_kwargs):
+    """ All settings of a subsample fit (see
+        temperature_density.fit_td_subsample), with defaults for those not
+        in fit_kwargs, so that cached fits are only reused for the same
+        settings """
+
+    import inspect
+    from lace_fake import temperature_density
+
+    signature=inspect.signature(temperature_density.fit_td_subsample)
+    settings={}
+    for name,param in signature.parameters.items():
+        if name in ['simdir','num','fraction','verbose']:
+            continue
+        settings[name]=fit_kwargs.get(name,param.default)
+    unknown=set(fit_kwargs)-set(settings)
+    if unknown:
+        raise ValueError('unknown fit settings '+str(sorted(unknown)))
+
+    return settings
+
+
+def get_thermal_entry(raw_dir,post_dir,num,fraction=None,verbose=False,
+            **fit_kwargs):
+    """ Temperature-density relation of a snapshot (in raw_dir), read from
+        the thermal cache (in post_dir) if the snapshot has not changed, or
+        fitted (and stored in the cache) otherwise. If post_dir is None,
+        always fit and do not store the result. If fraction is set, fit only a subsample of
+        particles (see temperature_density.fit_td_subsample, that also
+        takes fit_kwargs). Fits to the full sample are always reused, while
+        subsample fits are only reused for the same fraction and settings.
+        Returns a dictionary with T0, gamma (and their uncertainties, for
+        subsample fits). """
+
+    fingerprint=get_snapshot_fingerprint(raw_dir,num)
+    if fraction is None:
+        fit_settings=None
+    else:
+        fit_settings=get_fit_settings(fit_kwargs)
+    if post_dir is None:
+        entry=None
+    else:
+        entry=read_thermal_entry(post_dir,num)
+    if entry is not None and entry['fingerprint']==fingerprint:
+        if entry.get('fraction') is None or (entry['fraction']==fraction
+                    and entry.get('fit_settings')==fit_settings):
+            if verbose:
+                print('read thermal state of snapshot',num,'from cache')
+            return entry
+
+    if verbose:
+        print('fit thermal state of snapshot',num)
+    if fraction is None:
+        import fake_spectra.tempdens as tdr
+        T0,gamma=tdr.fit_td_rel_plot(num,raw_dir+'/output/',plot=False)
+        entry={'T0':float(T0),'gamma':float(gamma)}
+    else:
+        from lace_fake import temperature_density
+        entry=temperature_density.fit_td_subsample(raw_dir,num,
+                    fraction=fraction,verbose=verbose,**fit_kwargs)
+        entry['fit_settings']=fit_settings
+    entry['fingerprint']=fingerprint
+    if post_dir is not None:
+        write_thermal_entry(post_dir,num,entry)
+
+    return entry
+
+
+def get_thermal_state(raw_dir,post_dir,num,fraction=None,verbose=False,
+            **fit_kwargs):
+    """ Temperature-density relation (T0, gamma) of a snapshot, using the
+        thermal cache (see get_thermal_entry) """
+
+    entry=get_thermal_entry(raw_dir,post_dir,num,fraction=fraction,
+                verbose=verbose,**fit_kwargs)
+
+    return entry['T0'], entry['gamma']
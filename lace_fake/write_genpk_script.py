@@ -43,8 +43,9 @@ def write_genpk_scripts_in_sim(simdir,time,verbose):
 
     # get redshifts / snapshots Gadget parameter file 
     paramfile=simdir+'/paramfile.gadget'
-    zs=read_gadget.redshifts_from_paramfile(paramfile)
-    Nsnap=len(zs)
+    sim_config=read_gadget.get_simulation_config(paramfile)
+    zs=sim_config.zs
+    Nsnap=sim_config.n_snapshots
 
     for snap in range(Nsnap):
         # figure out if GenPk was already computed
@@ -74,8 +74,9 @@ def write_p1d_scripts_in_sim(post_dir,n_skewers,width_Mpc,
 
     # get redshifts / snapshots Gadget parameter file 
     paramfile=post_dir+'/paramfile.gadget'
-    zs=read_gadget.redshifts_from_paramfile(paramfile)
-    Nsnap=len(zs)
+    sim_config=read_gadget.get_simulation_config(paramfile)
+    zs=sim_config.zs
+    Nsnap=sim_config.n_snapshots
 
     for snap in range(Nsnap):
         z=zs[snap]
@@ -68,8 +68,9 @@ def write_skewer_scripts_in_sim(simdir,n_skewers,width_Mpc,
 
     # get redshifts / snapshots Gadget parameter file 
     paramfile=simdir+'/paramfile.gadget'
-    zs=read_gadget.redshifts_from_paramfile(paramfile)
-    Nsnap=len(zs)
+    sim_config=read_gadget.get_simulation_config(paramfile)
+    zs=sim_config.zs
+    Nsnap=sim_config.n_snapshots
 
     for snap in range(Nsnap):
         z=zs[snap]
@@ -0,0 +1,47 @@
+import numpy as np
+from lace_fake import filtering_length
+
+
+def get_spectrum(A=2.0,n=2.5,kF=6.0,k_max=20.0,nk=60,noise=0.0,seed=0):
+    k=np.linspace(k_max/nk,k_max,nk)
+    P=filtering_length.power_spectrum_model(k,A,n,kF)
+    rng=np.random.default_rng(seed)
+    return k, P*(1+noise*rng.standard_normal(nk))
+
+
+def test_batch_matches_curve_fit():
+    from scipy.optimize import curve_fit
+
+    spectra=[get_spectrum(kF=kF,noise=0.02,seed=i)
+                for i,kF in enumerate([4.0,6.0,9.0])]
+    fits=filtering_length.fit_filtering_length_batch(
+                [k for k,P in spectra],[P for k,P in spectra],15.0)
+    for i,(k,P) in enumerate(spectra):
+        fit=k<15.0
+        opt,cov=curve_fit(filtering_length.power_spectrum_model,k[fit],
+                    P[fit],p0=(fits['A'][i],fits['n'][i],fits['kF_Mpc'][i]))
+        assert np.allclose(opt,[fits['A'][i],fits['n'][i],fits['kF_Mpc'][i]],
+                    rtol=1e-4)
+        assert np.allclose(np.sqrt(np.diag(cov)),
+                    np.sqrt(np.diag(fits['covariance'][i])),rtol=1e-2)
+
+
+def test_zero_power_above_kmax():
+    k,P=get_spectrum()
+    # empty bins above kmax, and k=0 bin, are not fitted
+    P[-3:]=0.0
+    k=np.concatenate([[0.0],k])
+    P=np.concatenate([[0.0],P])
+    fits=filtering_length.fit_filtering_length_batch([k],[P],15.0)
+    assert np.allclose(fits['kF_Mpc'],6.0)
+    assert np.allclose(fits['n'],2.5)
+    assert np.all(np.isfinite(fits['covariance']))
+
+
+def test_short_spectrum():
+    k,P=get_spectrum()
+    fits=filtering_length.fit_filtering_length_batch([k,k[:3],k],
+                [P,P[:3],P],15.0)
+    assert np.allclose(fits['kF_Mpc'][[0,2]],6.0)
+    assert np.isnan(fits['kF_Mpc'][1])
+    assert np.all(np.isnan(fits['covariance'][1]))
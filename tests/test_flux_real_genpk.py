@@ -0,0 +1,87 @@
+import os
+import sys
+from lace_fake import flux_real_genpk
+
+# stand-in for GenPk: writes a valid power spectrum, except for snapshot 1
+# (fails with broken output on the first call) and snapshot 2 (always
+# writes output with NaN, but returns zero)
+STUB_GENPK="""#!{python}
+import sys, os
+import numpy as np
+snap_dir=sys.argv[sys.argv.index('-i')+1]
+out_dir=sys.argv[sys.argv.index('-o')+1]
+tag=os.path.basename(snap_dir.rstrip('/'))
+out_file=os.path.join(out_dir,'PK-by-'+tag)
+flag=os.path.join(out_dir,'.failed_'+tag)
+if tag.endswith('001') and not os.path.exists(flag):
+    open(flag,'w').close()
+    open(out_file,'w').write('garbage\\n')
+    sys.stderr.write('boom\\n')
+    sys.exit(3)
+if tag.endswith('002'):
+    open(out_file,'w').write('1 nan\\n')
+    sys.exit(0)
+k=np.arange(1,50.)
+np.savetxt(out_file,np.array([k,1.0/k]).T)
+print('done',tag)
+"""
+
+
+def get_stub_genpk(tmp_path):
+    stub=tmp_path/'gen-pk'
+    stub.write_text(STUB_GENPK.format(python=sys.executable))
+    os.chmod(stub,0o755)
+    return str(stub)
+
+
+def test_run_genpk_tasks(tmp_path):
+    genpk=get_stub_genpk(tmp_path)
+    simdir=str(tmp_path/'sim')
+    tasks=[(simdir,snap) for snap in range(4)]
+
+    results,failed=flux_real_genpk.run_genpk_tasks(tasks,genpk,n_workers=2,
+                max_retries=1)
+    # snapshot 1 succeeds on retry, snapshot 2 never has valid output
+    assert failed==[(simdir,2)]
+    assert len(results)==4
+    for snap in [0,1,3]:
+        assert flux_real_genpk.validate_genpk_output(simdir,snap)
+    # broken output is removed
+    assert not os.path.exists(flux_real_genpk.flux_real_genpk_filename(
+                simdir,2))
+
+    # snapshots with valid output are not run again
+    results,failed=flux_real_genpk.run_genpk_tasks(tasks,genpk,n_workers=2,
+                max_retries=0)
+    assert [(result['simdir'],result['snap_num']) for result in results]==[
+                (simdir,2)]
+    assert failed==[(simdir,2)]
+
+
+def test_no_retries(tmp_path):
+    genpk=get_stub_genpk(tmp_path)
+    simdir=str(tmp_path/'sim')
+    results,failed=flux_real_genpk.run_genpk_tasks([(simdir,1)],genpk,
+                max_retries=0)
+    assert failed==[(simdir,1)]
+    assert results[0]['returncode']==3
+    assert 'boom' in results[0]['stderr']
+
+
+def test_missing_executable(tmp_path):
+    simdir=str(tmp_path/'sim')
+    results,failed=flux_real_genpk.run_genpk_tasks([(simdir,0)],
+                str(tmp_path/'no-gen-pk'),max_retries=0)
+    assert failed==[(simdir,0)]
+    assert results[0]['returncode'] is None
+
+
+def test_timeout(tmp_path):
+    stub=tmp_path/'slow-gen-pk'
+    stub.write_text('#!{}\nimport time\ntime.sleep(10)\n'.format(sys.executable))
+    os.chmod(stub,0o755)
+    simdir=str(tmp_path/'sim')
+    results,failed=flux_real_genpk.run_genpk_tasks([(simdir,0)],str(stub),
+                max_retries=0,timeout=0.5)
+    assert failed==[(simdir,0)]
+    assert 'timeout' in results[0]['stderr']
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from lace_fake import flux_real_power
+
+
+def measure_single_mode(n_mesh,scheme,k_mode,amplitude=0.1):
+    """ Particles in a regular lattice (two per cell and side) carry a flux
+        1 + amplitude * cos(k_mode x), that has total power amplitude^2/2
+        (in units of the box volume) in the bin of |k_mode|. Returns the
+        relative error in that power, and the fraction leaked to other
+        bins. """
+
+    grid=(np.arange(2*n_mesh)+0.5)/(2*n_mesh)
+    pos=np.stack(np.meshgrid(grid,grid,grid,indexing='ij'),axis=-1)
+    pos=pos.reshape(-1,3)
+    flux=1.0+amplitude*np.cos(2.0*np.pi*(pos@np.asarray(k_mode,dtype=float)))
+    mass=np.ones(len(pos))
+
+    mass_mesh=np.zeros((n_mesh,n_mesh,n_mesh))
+    flux_mesh=np.zeros((n_mesh,n_mesh,n_mesh))
+    flux_real_power.assign_to_mesh([mass_mesh,flux_mesh],pos,
+                [mass,mass*flux],1.0,scheme)
+    flux_mesh/=mass_mesh
+    delta=flux_mesh/np.mean(flux_mesh)-1.0
+    k,power,counts=flux_real_power.measure_mesh_power(delta,scheme=scheme,
+                fft_backend_name='numpy')
+
+    expected=0.5*amplitude**2
+    # bins start at |k|=1, and have width one
+    k_bin=int(np.rint(np.sqrt(np.sum(np.square(k_mode)))))-1
+    measured=power[k_bin]*counts[k_bin]
+    leak=(np.sum(power*counts)-measured)/expected
+    return abs(measured/expected-1.0), leak
+
+
+@pytest.mark.parametrize('scheme,rtol',[('ngp',0.05),('cic',0.05),
+            ('tsc',0.005)])
+@pytest.mark.parametrize('k_mode',[(3,2,0),(1,1,1),(0,0,5)])
+def test_single_mode(scheme,rtol,k_mode):
+    rel_err,leak=measure_single_mode(32,scheme,k_mode)
+    assert rel_err<rtol
+    assert leak<rtol
+
+
+def test_mass_conservation():
+    rng=np.random.default_rng(0)
+    pos=rng.uniform(0,10.0,size=(1000,3))
+    mass=rng.uniform(0.5,1.5,size=1000)
+    for scheme in flux_real_power.ASSIGNMENT_ORDER:
+        mesh=np.zeros((8,8,8))
+        flux_real_power.assign_to_mesh([mesh],pos,[mass],10.0,scheme)
+        assert np.isclose(mesh.sum(),mass.sum())
@@ -0,0 +1,45 @@
+import json
+import numpy as np
+from lace_fake import measure_flux_power
+from lace_fake import skewers_reader
+
+
+def write_skewers(filename,n_xy=8,npix=32,dtype=np.float32,seed=0):
+    """ Skewers file with random optical depth, as written by fake_spectra """
+
+    import h5py
+
+    rng=np.random.default_rng(seed)
+    tau=rng.lognormal(mean=-1.0,sigma=1.0,size=(n_xy*n_xy,npix))
+    with h5py.File(filename,'w') as f:
+        header=f.create_group('Header')
+        header.attrs['redshift']=3.0
+        header.attrs['box']=20000.0
+        header.attrs['hubble']=0.7
+        f.create_dataset(skewers_reader.TAU_DATASET,data=tau.astype(dtype))
+
+
+def test_float32_skewers_in_memory_and_out_of_core(tmp_path):
+    filename=str(tmp_path/'skewers.hdf5')
+    write_skewers(filename)
+    scales_tau=[0.5,1.0]
+    results={}
+    for max_memory_MB in [None,1e-6]:
+        with skewers_reader.SkewersReader(filename) as skewers:
+            results[max_memory_MB]=\
+                        measure_flux_power.measure_F_p1d_p3d_Mpc_batch(
+                        skewers,scales_tau,L_Mpc=30.0,n_k_bins=4,k_Mpc_max=5.0,
+                        n_mu_bins=2,max_memory_MB=max_memory_MB)
+
+    k_in,p1d_in,mF_in,p3d_in=results[None]
+    k_out,p1d_out,mF_out,p3d_out=results[1e-6]
+    # mean flux should be stored as JSON
+    json.dumps(list(mF_in)+list(mF_out))
+    for mF in mF_in+mF_out:
+        assert np.asarray(mF).dtype==np.float64
+    assert np.allclose(k_in,k_out)
+    assert np.allclose(mF_in,mF_out,rtol=1e-12)
+    assert np.allclose(p1d_in,p1d_out,rtol=1e-10)
+    for p3d_a,p3d_b in zip(p3d_in,p3d_out):
+        assert np.allclose(p3d_a['p3d_Mpc'],p3d_b['p3d_Mpc'],rtol=1e-10,
+                    equal_nan=True)
@@ -0,0 +1,62 @@
+import numpy as np
+from lace_fake import p1d_archive
+
+
+def get_p1d_info(n_models=2,target_mF=[0.7,0.4],nk=5):
+    """ Fake P1D measurements of a snapshot, as in p1d_*.json files """
+
+    k_Mpc=np.linspace(0.1,1.0,nk).tolist()
+    p1d_data=[]
+    for isk in range(n_models):
+        for mF in target_mF:
+            p1d_data.append({'k_Mpc':k_Mpc,
+                    'p1d_Mpc':(mF*(1+isk)*np.ones(nk)).tolist(),
+                    'mF':mF+1e-4,'scale_tau':0.9+0.1*isk,'target_mF':mF,
+                    'sim_T0':1.0e4*(1+isk),'sim_gamma':1.5,
+                    'sim_sigT_Mpc':0.1,'sim_scale_T0':1.0+isk,
+                    'sim_scale_gamma':1.0,'sk_file':'skewers_{}.hdf5'.format(isk),
+                    'sk_fingerprint':{'size':100+isk,'mtime':1.5e9+isk},
+                    'measure_settings':{'L_Mpc':20.0,'n_jk_side':4},
+                    'p1d_cov_Mpc':np.eye(nk).tolist(),
+                    'cov_method':'jackknife'})
+    snapshot_data={'snap_num':5,'z':3.0,'n_skewers':10,'width_Mpc':0.05,
+            'axis':1,'sk_files':['skewers_0.hdf5','skewers_1.hdf5']}
+    return {'snapshot_data':snapshot_data,'scales_tau':None,
+            'p1d_data':p1d_data,'target_mF':target_mF}
+
+
+def test_round_trip(tmp_path):
+    p1d_info=get_p1d_info()
+    filename=str(tmp_path/'archive.hdf5')
+    p1d_archive.write_p1d_archive(filename,[p1d_info])
+    archive=p1d_archive.read_p1d_archive(filename)
+    label=p1d_archive.get_archive_label(p1d_info)
+    assert list(archive.keys())==[label]
+
+    # one target_mF per measurement, list of targets stored separately
+    assert len(archive[label]['target_mF'])==4
+    assert np.allclose(archive[label]['target_mF_list'],[0.7,0.4])
+
+    p1d_data=p1d_archive.get_p1d_data(archive[label])
+    assert len(p1d_data)==len(p1d_info['p1d_data'])
+    for read,written in zip(p1d_data,p1d_info['p1d_data']):
+        assert set(read.keys())==set(written.keys())
+        for key in written:
+            if isinstance(written[key],str) or isinstance(written[key],dict):
+                assert read[key]==written[key]
+            else:
+                assert np.allclose(read[key],written[key])
+
+
+def test_append_snapshots(tmp_path):
+    filename=str(tmp_path/'archive.hdf5')
+    for snap_num in range(3):
+        p1d_info=get_p1d_info()
+        p1d_info['snapshot_data']['snap_num']=snap_num
+        p1d_archive.write_p1d_archive(filename,[p1d_info],mode='a')
+    # rewriting a snapshot replaces it
+    p1d_archive.write_p1d_archive(filename,[p1d_info],mode='a')
+
+    archive=p1d_archive.read_p1d_archive(filename)
+    assert sorted(archive.keys())==['p1d_{}_Ns10_wM0.05_axis1'.format(snap)
+                for snap in range(3)]
@@ -0,0 +1,46 @@
+import os
+import numpy as np
+import pytest
+from lace_fake import temperature_density
+
+
+def get_particles(T0=1.5e4,gamma=1.6,n_part=200000,scatter=0.05,seed=0):
+    """ Synthetic gas particles following a power-law temperature-density
+        relation, plus hot gas (outside of the fitting range) """
+
+    rng=np.random.default_rng(seed)
+    ldens=rng.uniform(-1.5,2.0,size=n_part)
+    ltemp=np.log10(T0)+(gamma-1)*ldens+scatter*rng.standard_normal(n_part)
+    hot=rng.random(n_part)<0.1
+    ltemp[hot]=rng.uniform(5.0,7.0,size=np.sum(hot))
+    return ldens, ltemp
+
+
+def test_fit_td_relation():
+    ldens,ltemp=get_particles()
+    T0,gamma=temperature_density.fit_td_relation(ldens,ltemp)
+    assert np.isclose(T0,1.5e4,rtol=2e-3)
+    assert np.isclose(gamma,1.6,atol=2e-3)
+
+
+def test_fit_td_relation_batch():
+    ldens,ltemp=get_particles(n_part=10000)
+    rng=np.random.default_rng(1)
+    weights=rng.poisson(1.0,size=(5,len(ldens)))*1.0
+    T0,gamma=temperature_density.fit_td_relation(ldens,ltemp,weights)
+    for i in range(5):
+        T0_i,gamma_i=temperature_density.fit_td_relation(ldens,ltemp,
+                    weights[i])
+        assert np.isclose(T0[i],T0_i)
+        assert np.isclose(gamma[i],gamma_i)
+
+
+@pytest.mark.skipif('LACE_FAKE_TEST_SIMDIR' not in os.environ,
+            reason='needs a simulation in LACE_FAKE_TEST_SIMDIR')
+def test_agreement_with_fake_spectra():
+    pytest.importorskip('fake_spectra')
+    simdir=os.environ['LACE_FAKE_TEST_SIMDIR']
+    num=int(os.environ.get('LACE_FAKE_TEST_SNAP',0))
+    comparison=temperature_density.compare_td_fits(simdir,num,fraction=0.1)
+    assert abs(comparison['pull_T0'])<3
+    assert abs(comparison['pull_gamma'])<3